@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+import web.fancyindex
+
+import fake
+
+def populate(dirname, entries):
+	for i in range(entries):
+		with open(os.path.join(dirname, 'file{:06d}.txt'.format(i)), 'wb') as file:
+			file.write(b'a' * (i % 4096))
+
+		#Spread modification times over a couple of days
+		os.utime(os.path.join(dirname, 'file{:06d}.txt'.format(i)), (i * 7, i * 7))
+
+	#Settle the directory itself so cached scans of it are kept
+	os.utime(dirname, (0, 0))
+
+def render(handler, resource='/'):
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource=resource, groups=(resource,), handler=handler)
+
+	status, response = request.handler.respond()
+
+	if not isinstance(response, str):
+		response = response.read().decode(web.default_encoding)
+
+	return response
+
+def bench(handler, repeat, resource='/'):
+	times = []
+
+	for i in range(repeat):
+		start = time.perf_counter()
+		render(handler, resource)
+		times.append(time.perf_counter() - start)
+
+	return min(times), sorted(times)[len(times) // 2]
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='benchmark rendering of fancyindex directory listings')
+	parser.add_argument('-n', '--entries', default=10000, type=int, dest='entries', help='number of files in the directory (default: 10000)')
+	parser.add_argument('-r', '--repeat', default=10, type=int, dest='repeat', help='number of renders per case (default: 10)')
+
+	args = parser.parse_args()
+
+	dirname = tempfile.mkdtemp()
+
+	try:
+		populate(dirname, args.entries)
+
+		cases = [
+			('html', web.fancyindex.new(dirname), '/'),
+			('html cached scan', web.fancyindex.new(dirname, cache=web.fancyindex.DirCache(ttl=3600)), '/'),
+		]
+
+		print('{:<20} {:>12} {:>12}'.format('case', 'best (ms)', 'median (ms)'))
+
+		for name, route, resource in cases:
+			handler = list(route.values())[0]
+
+			best, median = bench(handler, args.repeat, resource)
+
+			print('{:<20} {:>12.2f} {:>12.2f}'.format(name, best * 1000, median * 1000))
+	finally:
+		shutil.rmtree(dirname)
@@ -0,0 +1,276 @@
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web
+import web.fancyindex
+import web.file
+
+class TinyHandler(web.HTTPHandler):
+	def do_get(self):
+		return 200, 'ok'
+
+class NullAccessLog(web.HTTPLog):
+	#Format access log lines as usual but drop them so the terminal isn't measured
+	def access_write(self, string):
+		pass
+
+class Client(object):
+	def __init__(self, address, timeout=30):
+		self.connection = socket.create_connection(address, timeout)
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+		self.rfile = self.connection.makefile('rb', -1)
+
+	def send(self, requests):
+		self.connection.sendall(b''.join(requests))
+
+	def read_response(self):
+		status_line = self.rfile.readline()
+		if not status_line:
+			raise ConnectionError('connection closed by server')
+
+		status = int(status_line.split()[1])
+
+		length = None
+		chunked = False
+		close = False
+
+		while True:
+			line = self.rfile.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+
+			name, colon, value = line.decode('latin-1').partition(':')
+			name = name.strip().lower()
+			value = value.strip()
+
+			if name == 'content-length':
+				length = int(value)
+			elif name == 'transfer-encoding' and value.lower() == 'chunked':
+				chunked = True
+			elif name == 'connection' and value.lower() == 'close':
+				close = True
+
+		if chunked:
+			while True:
+				size = int(self.rfile.readline().split(b';')[0], 16)
+				self.rfile.read(size + 2)
+				if size == 0:
+					break
+		elif length:
+			self.rfile.read(length)
+
+		return status, close
+
+	def close(self):
+		self.rfile.close()
+		self.connection.close()
+
+def build_request(method, resource, headers=None, body=b''):
+	head = method + ' ' + resource + ' HTTP/1.1\r\nHost: localhost\r\n'
+
+	for name, value in (headers or {}).items():
+		head += name + ': ' + value + '\r\n'
+
+	if body or method == 'PUT':
+		head += 'Content-Length: ' + str(len(body)) + '\r\n'
+
+	return head.encode('latin-1') + b'\r\n' + body
+
+def percentile(latencies, fraction):
+	if not latencies:
+		return None
+
+	return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def run_case(address, requests, connections, duration, pipeline):
+	deadline = time.perf_counter() + duration
+
+	results = []
+	results_lock = threading.Lock()
+
+	def load(num):
+		latencies = []
+		errors = 0
+
+		#Each connection cycles through its own list of requests
+		requests_conn = requests(num)
+		index = 0
+
+		client = Client(address)
+
+		try:
+			while time.perf_counter() < deadline:
+				batch = []
+				for i in range(pipeline):
+					batch.append(requests_conn[index % len(requests_conn)])
+					index += 1
+
+				start = time.perf_counter()
+				client.send(batch)
+
+				for i in range(len(batch)):
+					status, close = client.read_response()
+					latencies.append(time.perf_counter() - start)
+
+					if status >= 500:
+						errors += 1
+
+				#Reconnect if the server did not keep the connection alive
+				if close:
+					client.close()
+					client = Client(address)
+		except (OSError, ValueError):
+			errors += 1
+		finally:
+			client.close()
+
+		with results_lock:
+			results.append((latencies, errors))
+
+	threads = [threading.Thread(target=load, args=(i,)) for i in range(connections)]
+
+	start = time.perf_counter()
+
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	elapsed = time.perf_counter() - start
+
+	latencies = sorted(latency for latencies_conn, errors in results for latency in latencies_conn)
+	errors = sum(errors for latencies_conn, errors in results)
+
+	def ms(value):
+		return None if value is None else round(value * 1000, 3)
+
+	return {
+		'requests': len(latencies),
+		'errors': errors,
+		'rps': round(len(latencies) / elapsed, 1),
+		'p50_ms': ms(percentile(latencies, 0.5)),
+		'p99_ms': ms(percentile(latencies, 0.99)),
+		'p999_ms': ms(percentile(latencies, 0.999)),
+	}
+
+def make_cases(dirname, file_size, upload_size, entries):
+	files = os.path.join(dirname, 'files')
+	index = os.path.join(dirname, 'index')
+	uploads = os.path.join(dirname, 'uploads')
+
+	os.mkdir(files)
+	os.mkdir(index)
+	os.mkdir(uploads)
+
+	with open(os.path.join(files, 'large.bin'), 'wb') as file:
+		file.write(os.urandom(file_size))
+
+	for i in range(entries):
+		with open(os.path.join(index, 'file{:06d}.txt'.format(i)), 'wb') as file:
+			file.write(b'a' * (i % 4096))
+
+	routes = {'/tiny': TinyHandler}
+	routes.update(web.file.new(files, '/files'))
+	routes.update(web.fancyindex.new(index, '/index'))
+	routes.update(web.file.new(uploads, '/uploads', modify=True))
+
+	upload_body = b'a' * upload_size
+
+	cases = {
+		'tiny': lambda num: [build_request('GET', '/tiny')],
+		'file': lambda num: [build_request('GET', '/files/large.bin')],
+		'range': lambda num: [build_request('GET', '/files/large.bin', {'Range': 'bytes=' + str(offset) + '-' + str(offset + 4095)}) for offset in range(0, file_size - 4096, max(4096, file_size // 16))],
+		'fancyindex': lambda num: [build_request('GET', '/index/')],
+		#Each connection uploads to its own file so the uploads don't contend on a resource lock
+		'upload': lambda num: [build_request('PUT', '/uploads/upload' + str(num), body=upload_body)],
+		'error': lambda num: [build_request('GET', '/missing/' + str(i)) for i in range(16)],
+	}
+
+	return routes, cases
+
+def compare(results, baseline, tolerance):
+	regressions = []
+
+	print('{:<12} {:>12} {:>12} {:>9} {:>12} {:>12} {:>9}'.format('case', 'rps', 'base rps', 'change', 'p99 (ms)', 'base p99', 'change'), file=sys.stderr)
+
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+
+		base = baseline[name]
+
+		rps_change = (result['rps'] - base['rps']) / base['rps'] * 100 if base['rps'] else 0
+		p99_change = (result['p99_ms'] - base['p99_ms']) / base['p99_ms'] * 100 if base['p99_ms'] and result['p99_ms'] is not None else 0
+
+		print('{:<12} {:>12.1f} {:>12.1f} {:>+8.1f}% {:>12.3f} {:>12.3f} {:>+8.1f}%'.format(name, result['rps'], base['rps'], rps_change, result['p99_ms'] or 0, base['p99_ms'] or 0, p99_change), file=sys.stderr)
+
+		if rps_change < -tolerance or p99_change > tolerance:
+			regressions.append(name)
+
+	return regressions
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='load test an in-process HTTPServer and report throughput and latency as JSON')
+	parser.add_argument('cases', nargs='*', metavar='case', help='cases to run (default: all)')
+	parser.add_argument('-c', '--connections', default=8, type=int, dest='connections', help='number of concurrent keepalive connections (default: 8)')
+	parser.add_argument('-d', '--duration', default=5, type=float, dest='duration', help='seconds to run each case (default: 5)')
+	parser.add_argument('-p', '--pipeline', default=1, type=int, dest='pipeline', help='number of requests to pipeline per connection (default: 1)')
+	parser.add_argument('-t', '--threads', default=8, type=int, dest='threads', help='number of server worker threads (default: 8)')
+	parser.add_argument('--file-size', default=1048576, type=int, dest='file_size', help='size in bytes of the downloaded file (default: 1048576)')
+	parser.add_argument('--upload-size', default=65536, type=int, dest='upload_size', help='size in bytes of each upload (default: 65536)')
+	parser.add_argument('--entries', default=1000, type=int, dest='entries', help='number of files in the listed directory (default: 1000)')
+	parser.add_argument('-o', '--output', dest='output', help='write results as JSON to this file as well as stdout')
+	parser.add_argument('-b', '--baseline', dest='baseline', help='compare results against a JSON file from a previous run')
+	parser.add_argument('--tolerance', default=10, type=float, dest='tolerance', help='percent of rps or p99 regression allowed against the baseline (default: 10)')
+
+	args = parser.parse_args()
+
+	dirname = tempfile.mkdtemp()
+
+	try:
+		routes, cases = make_cases(dirname, args.file_size, args.upload_size, args.entries)
+
+		for name in args.cases:
+			if name not in cases:
+				parser.error('unknown case ' + name + ' (choose from ' + ', '.join(cases) + ')')
+
+		httpd = web.HTTPServer(('localhost', 0), routes, num_threads=args.threads, max_threads=args.threads, log=NullAccessLog(None, None))
+		httpd.start()
+
+		try:
+			results = {}
+			for name in args.cases or cases:
+				results[name] = run_case(httpd.server_address, cases[name], args.connections, args.duration, args.pipeline)
+		finally:
+			httpd.close()
+	finally:
+		shutil.rmtree(dirname)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+
+	print(output)
+
+	if args.output:
+		with open(args.output, 'w') as file:
+			file.write(output + '\n')
+
+	if args.baseline:
+		with open(args.baseline, 'r') as file:
+			baseline = json.load(file)
+
+		regressions = compare(results, baseline, args.tolerance)
+
+		if regressions:
+			print('regressed: ' + ', '.join(regressions), file=sys.stderr)
+			sys.exit(1)
@@ -0,0 +1,236 @@
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from web import web, file
+
+import fake
+
+request_bytes = (
+	'GET /static/css/site.css HTTP/1.1\r\n'
+	'Host: localhost:8080\r\n'
+	'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0\r\n'
+	'Accept: text/css,*/*;q=0.1\r\n'
+	'Accept-Language: en-US,en;q=0.5\r\n'
+	'Accept-Encoding: gzip, deflate\r\n'
+	'Referer: http://localhost:8080/\r\n'
+	'Connection: keep-alive\r\n'
+	'Cache-Control: max-age=0\r\n'
+	'\r\n'
+).encode(web.http_encoding)
+
+header_lines = [line + '\r\n' for line in request_bytes.decode(web.http_encoding).split('\r\n')[1:-2]]
+
+body_bytes = b'a' * 4096
+body_stream_size = 65536
+
+class NullAccessLog(fake.FakeHTTPLog):
+	#Format access log lines as usual but drop them so the log doesn't grow between operations
+	def access_write(self, string):
+		pass
+
+def parse(server):
+	def run():
+		socket = fake.FakeSocket(request_bytes)
+
+		request = web.HTTPRequest(socket, ('127.0.0.1', 1337), server)
+		request.response = fake.FakeHTTPResponse(socket, ('127.0.0.1', 1337), server, request)
+
+		request.handle()
+
+	return run
+
+def headers_add():
+	headers = web.HTTPHeaders()
+
+	for line in header_lines:
+		headers.add(line)
+
+def headers_set():
+	headers = web.HTTPHeaders()
+
+	headers.set('Content-Type', 'text/html; charset=utf-8')
+	headers.set('Content-Length', '4096')
+	headers.set('Last-Modified', 'Thu, 01 Jan 1970 00:00:00 GMT')
+	headers.set('Accept-Ranges', 'bytes')
+	headers.set('Server', web.server_version)
+	headers.set('Date', 'Thu, 01 Jan 1970 00:00:00 GMT')
+
+def headers_iter(headers):
+	def run():
+		for header in headers:
+			header.encode(web.http_encoding)
+
+	return run
+
+def normpath():
+	file.normpath('/static/./css/../css//images/../../js/app.min.js')
+
+def respond(server, response):
+	class Handler(web.HTTPHandler):
+		def do_get(self):
+			if callable(response):
+				return 200, response()
+
+			return 200, response
+
+	def run():
+		request = fake.FakeHTTPRequest(fake.FakeSocket(), ('127.0.0.1', 1337), server, handler=Handler, response=web.HTTPResponse)
+		request.response.handle()
+
+	return run
+
+def make_cases():
+	server = fake.FakeHTTPServer(routes={ '/static/css/site.css': fake.FakeHTTPHandler }, log=NullAccessLog(None, None))
+
+	#Match the request against the last of many routes
+	routes = dict(('/route' + str(i) + '/(.*)', fake.FakeHTTPHandler) for i in range(100))
+	routes['/static/css/site.css'] = fake.FakeHTTPHandler
+	server_routes = fake.FakeHTTPServer(routes=routes)
+
+	headers = web.HTTPHeaders()
+	for line in header_lines:
+		headers.add(line)
+
+	return {
+		'parse': parse(server),
+		'parse_100_routes': parse(server_routes),
+		'headers_add': headers_add,
+		'headers_set': headers_set,
+		'headers_iter': headers_iter(headers),
+		'normpath': normpath,
+		'response_bytes': respond(server, body_bytes),
+		'response_chunked': respond(server, lambda: io.BytesIO(b'a' * body_stream_size)),
+	}
+
+def time_case(run, number, repeat):
+	best = None
+
+	gc.disable()
+	try:
+		for i in range(repeat):
+			start = time.perf_counter()
+			for j in range(number):
+				run()
+			elapsed = time.perf_counter() - start
+
+			if best is None or elapsed < best:
+				best = elapsed
+	finally:
+		gc.enable()
+
+	return best / number * 1e9
+
+def trace_case(run, number):
+	#Warm up caches so only steady state allocations are counted
+	run()
+
+	tracemalloc.start()
+	try:
+		peak = 0
+
+		gc.collect()
+		before = tracemalloc.take_snapshot()
+		for i in range(number):
+			tracemalloc.reset_peak()
+			current = tracemalloc.get_traced_memory()[0]
+			run()
+			peak += tracemalloc.get_traced_memory()[1] - current
+
+		#Collect reference cycles so only live blocks are compared
+		gc.collect()
+		after = tracemalloc.take_snapshot()
+	finally:
+		tracemalloc.stop()
+
+	#Blocks still allocated after running indicate a leak or unbounded cache
+	retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+
+	return peak / number, retained / number
+
+def run_cases(cases, number, repeat, trace_number):
+	results = {}
+
+	for name, run in cases.items():
+		ns_op = time_case(run, number, repeat)
+		bytes_op, blocks_op = trace_case(run, trace_number)
+
+		results[name] = {
+			'ns_op': round(ns_op, 1),
+			'peak_bytes_op': round(bytes_op, 1),
+			'retained_blocks_op': round(blocks_op, 3),
+		}
+
+		print('{:<20} {:>12.1f} ns/op {:>12.1f} B/op {:>9.3f} blocks/op'.format(name, ns_op, bytes_op, blocks_op), file=sys.stderr)
+
+	return results
+
+def compare(results, baseline, tolerance):
+	regressions = []
+
+	print('{:<20} {:>12} {:>12} {:>9}'.format('case', 'ns/op', 'base ns/op', 'change'), file=sys.stderr)
+
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+
+		base = baseline[name]
+
+		change = (result['ns_op'] - base['ns_op']) / base['ns_op'] * 100 if base['ns_op'] else 0
+
+		print('{:<20} {:>12.1f} {:>12.1f} {:>+8.1f}%'.format(name, result['ns_op'], base['ns_op'], change), file=sys.stderr)
+
+		if change > tolerance or result['peak_bytes_op'] > base['peak_bytes_op'] * (1 + tolerance / 100):
+			regressions.append(name)
+
+	return regressions
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(description='microbenchmark request parsing, headers, routing and response serialization')
+	parser.add_argument('cases', nargs='*', metavar='case', help='cases to run (default: all)')
+	parser.add_argument('-n', '--number', default=2000, type=int, dest='number', help='number of operations per timing (default: 2000)')
+	parser.add_argument('-r', '--repeat', default=5, type=int, dest='repeat', help='number of timings to take the best of (default: 5)')
+	parser.add_argument('--trace-number', default=200, type=int, dest='trace_number', help='number of operations to trace allocations over (default: 200)')
+	parser.add_argument('-o', '--output', dest='output', help='write results as JSON to this file as well as stdout')
+	parser.add_argument('-b', '--baseline', dest='baseline', help='compare results against a JSON file from a previous run')
+	parser.add_argument('--tolerance', default=10, type=float, dest='tolerance', help='percent of ns/op or B/op regression allowed against the baseline (default: 10)')
+
+	args = parser.parse_args()
+
+	cases = make_cases()
+
+	for name in args.cases:
+		if name not in cases:
+			parser.error('unknown case ' + name + ' (choose from ' + ', '.join(cases) + ')')
+
+	if args.cases:
+		cases = dict((name, cases[name]) for name in args.cases)
+
+	results = run_cases(cases, args.number, args.repeat, args.trace_number)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+
+	print(output)
+
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			output_file.write(output + '\n')
+
+	if args.baseline:
+		with open(args.baseline, 'r') as baseline_file:
+			baseline = json.load(baseline_file)
+
+		regressions = compare(results, baseline, args.tolerance)
+
+		if regressions:
+			print('regressed: ' + ', '.join(regressions), file=sys.stderr)
+			sys.exit(1)
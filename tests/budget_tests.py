@@ -0,0 +1,191 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import tracemalloc
+
+from web import web, file
+
+import fake
+
+from nose.tools import with_setup, nottest
+
+test_message = 'More test time!'
+
+test_file_size = 262144
+
+#Set by setup_budget
+test_dir = None
+baseline = None
+
+#Only count memory allocated by the server itself and not by other threads of the test run
+trace_filters = [ tracemalloc.Filter(True, os.path.join(os.path.dirname(web.__file__), '*')) ]
+
+class TracingSocket(fake.CountingSocket):
+	def __init__(self, sock):
+		fake.CountingSocket.__init__(self, sock)
+
+		self.peak = 0
+
+	def send(self, data):
+		#Sample memory on each send since that is where the response is fully built
+		snapshot = tracemalloc.take_snapshot().filter_traces(trace_filters)
+		self.peak = max(self.peak, sum(trace.size for trace in snapshot.traces))
+
+		return fake.CountingSocket.send(self, data)
+
+class Handler(web.HTTPHandler):
+	def do_get(self):
+		return 200, test_message
+
+class EmptyHandler(web.HTTPHandler):
+	def do_get(self):
+		return 204, ''
+
+def setup_budget():
+	global test_dir, baseline
+
+	test_dir = tempfile.mkdtemp() + '/'
+
+	with open(test_dir + 'test', 'wb') as test_file:
+		test_file.write(os.urandom(test_file_size))
+	with open(test_dir + 'large', 'wb') as test_file:
+		test_file.write(os.urandom(test_file_size * 4))
+
+	#Warm up one-time caches like the mimetypes database so they don't count against a single request
+	test(b'GET /files/test HTTP/1.1\r\n\r\n')
+
+	#Budget memory against the least a request costs on this machine and interpreter rather than fixed sizes
+	baseline = min(test(b'GET /empty HTTP/1.1\r\nHost: localhost\r\n\r\n')[1] for i in range(3))
+
+def teardown_budget():
+	shutil.rmtree(test_dir)
+
+@nottest
+def test(request, keepalive=False):
+	routes = { '/': Handler, '/empty': EmptyHandler }
+	routes.update(file.new(test_dir, '/files'))
+
+	server = fake.FakeHTTPServer(routes=routes)
+
+	#Use a real TCP connection so the counts match what a server socket would do
+	listener = socket.socket()
+	listener.bind(('localhost', 0))
+	listener.listen(1)
+
+	client = socket.create_connection(listener.getsockname())
+	server_sock, client_address = listener.accept()
+	listener.close()
+
+	connection = TracingSocket(server_sock)
+
+	received = bytearray()
+
+	def reader():
+		#Receive into a single buffer so the reader's allocations don't count against the request
+		buffer = bytearray(65536)
+
+		while True:
+			length = client.recv_into(buffer)
+			if not length:
+				break
+
+			if not received:
+				received.extend(buffer[:length])
+
+	reader_thread = threading.Thread(target=reader)
+	reader_thread.start()
+
+	client.sendall(request)
+
+	request_obj = web.HTTPRequest(connection, client_address, server, 5)
+
+	tracemalloc.start()
+	try:
+		request_obj.handle(keepalive)
+	finally:
+		tracemalloc.stop()
+
+	request_obj.close()
+	server_sock.close()
+
+	reader_thread.join()
+	client.close()
+
+	return connection, connection.peak, bytes(received)
+
+@with_setup(setup_budget, teardown_budget)
+def test_get_small():
+	connection, peak, received = test(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+	assert received.startswith(b'HTTP/1.1 200 OK\r\n')
+
+	#Status line, four headers, end of headers, and body
+	assert connection.calls['send'] <= 7
+	assert connection.calls['recv'] <= 1
+	assert connection.calls['setsockopt'] <= 1
+
+	assert connection.bytes_sent < 256
+	assert peak < 2 * baseline
+
+@with_setup(setup_budget, teardown_budget)
+def test_head():
+	connection, peak, received = test(b'HEAD / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+	assert received.startswith(b'HTTP/1.1 200 OK\r\n')
+
+	#Same as a GET but without the body
+	assert connection.calls['send'] <= 6
+	assert connection.calls['recv'] <= 1
+	assert connection.calls['setsockopt'] <= 1
+
+	assert connection.bytes_sent < 256
+	assert peak < 2 * baseline
+
+@with_setup(setup_budget, teardown_budget)
+def test_not_found():
+	connection, peak, received = test(b'GET /nothere HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+	assert received.startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+	assert connection.calls['send'] <= 7
+	assert connection.calls['recv'] <= 1
+	assert connection.calls['setsockopt'] <= 1
+
+	assert connection.bytes_sent < 256
+
+	#The error page is rendered on top of the request
+	assert peak < 4 * baseline
+
+@with_setup(setup_budget, teardown_budget)
+def test_get_file():
+	connection, peak, received = test(b'GET /files/test HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+	assert received.startswith(b'HTTP/1.1 200 OK\r\n')
+
+	#Head of the response and one send per chunk of the file
+	assert connection.calls['send'] <= 7 + test_file_size // web.stream_chunk_size
+	assert connection.calls['recv'] <= 1
+	assert connection.calls['setsockopt'] <= 1
+
+	assert connection.bytes_sent < test_file_size + 512
+
+	#The file is streamed through buffers of about a chunk each
+	assert peak < baseline + 4 * web.stream_chunk_size
+
+	#So memory must not grow with its size
+	connection, large_peak, received = test(b'GET /files/large HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+	assert received.startswith(b'HTTP/1.1 200 OK\r\n')
+	assert large_peak < peak + web.stream_chunk_size
+
+@with_setup(setup_budget, teardown_budget)
+def test_keepalive():
+	connection, peak, received = test(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n', keepalive=True)
+
+	#A kept alive connection does not need any more calls and skips the Connection header
+	assert connection.calls['send'] <= 6
+	assert connection.calls['recv'] <= 1
+	assert connection.calls['setsockopt'] <= 1
+	assert connection.calls['settimeout'] <= 1
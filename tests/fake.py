@@ -1,6 +1,8 @@
+import collections
 import io
 import queue
 import re
+import socket
 import threading
 import time
 
@@ -27,6 +29,73 @@ class FakeSocket(object):
 	def makefile(self, mode='r', buffering=None):
 		return io.BytesIO(self.bytes)
 
+class CountingSocket(object):
+	def __init__(self, sock):
+		self.sock = sock
+
+		#Method name -> number of calls
+		self.calls = collections.Counter()
+
+		self.bytes_received = 0
+		self.bytes_sent = 0
+
+	def recv_into(self, buffer, nbytes=0):
+		self.calls['recv'] += 1
+		received = self.sock.recv_into(buffer, nbytes)
+		self.bytes_received += received
+		return received
+
+	def recv(self, bufsize):
+		self.calls['recv'] += 1
+		data = self.sock.recv(bufsize)
+		self.bytes_received += len(data)
+		return data
+
+	def send(self, data):
+		self.calls['send'] += 1
+		sent = self.sock.send(data)
+		self.bytes_sent += sent
+		return sent
+
+	def sendall(self, data):
+		self.calls['send'] += 1
+		self.sock.sendall(data)
+		self.bytes_sent += len(data)
+
+	def setsockopt(self, level, optname, value):
+		self.calls['setsockopt'] += 1
+		self.sock.setsockopt(level, optname, value)
+
+	def settimeout(self, timeout):
+		self.calls['settimeout'] += 1
+		self.sock.settimeout(timeout)
+
+	def gettimeout(self):
+		return self.sock.gettimeout()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def makefile(self, mode='r', buffering=None):
+		#Build the file the way socket.makefile does so reads and writes come back through this wrapper
+		raw = socket.SocketIO(self, mode.replace('b', ''))
+
+		if buffering is None or buffering < 0:
+			buffering = io.DEFAULT_BUFFER_SIZE
+
+		if buffering == 0:
+			return raw
+		elif 'w' in mode:
+			return io.BufferedWriter(raw, buffering)
+		else:
+			return io.BufferedReader(raw, buffering)
+
+	def _decref_socketios(self):
+		pass
+
+	def close(self):
+		self.sock.close()
+
 class FakeHTTPHandler(object):
 	def __init__(self, request, response, groups):
 		self.request = request
@@ -69,7 +138,7 @@ class FakeHTTPResponse(object):
 		self.closed = True
 
 class FakeHTTPRequest(object):
-	def __init__(self, connection, client_address, server, timeout=None, body=None, headers=None, method='GET', resource='/', groups=(), handler=FakeHTTPHandler, handler_args={}, response=FakeHTTPResponse, keepalive_number=0):
+	def __init__(self, connection, client_address, server, timeout=None, body=None, headers=None, method='GET', resource='/', groups=(), handler=FakeHTTPHandler, handler_args={}, response=FakeHTTPResponse, keepalive_number=0, pipelined_number=0):
 		self.connection = connection
 		self.client_address = client_address
 		self.server = server
@@ -97,10 +166,25 @@ class FakeHTTPRequest(object):
 		self.handler = handler(self, self.response, groups, **handler_args)
 
 		self.keepalive_number = keepalive_number
+		self.pipelined_number = pipelined_number
 
 		self.initial_timeout = None
 		self.handled = 0
 
+		self.queued = None
+		self.dequeued = None
+		self.worker = None
+		self.count = 1
+		self.received = None
+
+		self.deadline = None
+		self.idle = False
+
+		self.route = None
+		self.bytes_in = 0
+
+		self.detached = False
+
 	def handle(self, keepalive=False, timeout=None):
 		self.keepalive_number -= 1
 		if self.keepalive_number == 0:
@@ -110,22 +194,34 @@ class FakeHTTPRequest(object):
 		self.initial_timeout = timeout
 		self.handled += 1
 
+	def pipelined(self):
+		self.pipelined_number -= 1
+		return self.pipelined_number >= 0
+
+	def expect_body(self, length):
+		pass
+
+	def timed_out(self):
+		return False
+
 	def close(self):
 		pass
 
 class FakeHTTPLog(web.HTTPLog):
-	def __init__(self, httpd_log, access_log):
+	def __init__(self, httpd_log, access_log, structured=False):
+		self.structured = structured
+
 		self.httpd_log = io.StringIO()
 		self.httpd_log_lock = threading.Lock()
 
 		self.access_log = io.StringIO()
 		self.access_log_lock = threading.Lock()
 
-	def timestamp(self):
+	def timestamp(self, when=None):
 		return '[01/Jan/1970:00:00:00 -0000]'
 
 class FakeHTTPServer(object):
-	def __init__(self, routes={}, error_routes={}, keyfile=None, certfile=None, keepalive=5, timeout=20, num_threads=2, max_threads=6, max_queue=4, poll_interval=0.1, log=None):
+	def __init__(self, routes={}, error_routes={}, keyfile=None, certfile=None, keepalive=5, timeout=20, num_threads=2, max_threads=6, max_queue=4, poll_interval=0.1, log=None, metrics=None, slow_timeout=None, max_pipeline=16, http2=None, ssl_context=None, handshake_timeout=5, sni=None, backlog=128, max_accept=64, defer_accept=None, fastopen=None, recv_buffer=None, send_buffer=None, fd=None, head_timeout=None, min_body_rate=None, max_requests=None, max_connections=None, max_connections_per_ip=None):
 		self.routes = {}
 		for regex, handler in routes.items():
 			self.routes[re.compile('^' + regex + '$')] = handler
@@ -141,11 +237,56 @@ class FakeHTTPServer(object):
 		self.max_queue = max_queue
 		self.poll_interval = poll_interval
 
+		self.max_pipeline = max_pipeline
+
+		self.head_timeout = head_timeout
+		self.min_body_rate = min_body_rate
+		self.max_requests = max_requests
+
+		self.max_connections = max_connections
+		self.max_connections_per_ip = max_connections_per_ip
+		self.connections = {}
+		self.evicted = 0
+		self.refused = 0
+
+		self.request_queue_size = backlog
+		self.max_accept = max_accept
+		self.defer_accept = defer_accept
+		self.fastopen = fastopen
+		self.recv_buffer = recv_buffer
+		self.send_buffer = send_buffer
+
+		self.accepted = 0
+		self.accept_wakeups = 0
+		self.accept_errors = 0
+
 		if log:
 			self.log = log
 		else:
 			self.log = FakeHTTPLog(None, None)
 
+		self.metrics = metrics
+
+		self.http2 = http2
+
+		self.ssl_context = ssl_context
+		self.sni = sni or {}
+		self.sni_contexts = {}
+		self.handshake_timeout = handshake_timeout
+		self.handshake_failures = 0
+		self.handshake_lock = threading.Lock()
+
+		self.draining = False
+
+		self.slow_timeout = slow_timeout
+		self.inflight = {}
+		self.slow_flagged = set()
+		self.slow_requests = 0
+		self.stuck_workers = 0
+
+		self.reaped = set()
+		self.slow_clients = 0
+
 		self.manager_thread = None
 		self.manager_shutdown = False
 
@@ -159,6 +300,18 @@ class FakeHTTPServer(object):
 	def shutdown_request(self, connection):
 		pass
 
+	def mark_idle(self, handler):
+		handler.idle = True
+
+	def mark_busy(self, handler):
+		handler.idle = False
+
+	def untrack(self, connection):
+		pass
+
+	def reap(self):
+		pass
+
 	def manager(self):
 		while not self.manager_shutdown:
 			time.sleep(self.poll_interval)
@@ -21,8 +21,8 @@ test_index_content_type = 'application/json'
 test_string = 'Fancy indexing is fancy'
 
 @nottest
-def test(method, resource, local='tmp', remote='', head='', precontent='', preindex='', postindex='', postcontent='', sortclass=fancyindex.DirEntry):
-	handler = list(fancyindex.new(local, remote, False, head, precontent, preindex, postindex, postcontent, sortclass, test_index_template, test_index_entry, test_index_entry_join, test_index_content_type).values())[0]
+def test(method, resource, local='tmp', remote='', head='', precontent='', preindex='', postindex='', postcontent='', sortclass=fancyindex.DirEntry, stream=False, limit=None):
+	handler = list(fancyindex.new(local, remote, False, head, precontent, preindex, postindex, postcontent, sortclass, test_index_template, test_index_entry, test_index_entry_join, test_index_content_type, stream=stream, limit=limit).values())[0]
 
 	request = fake.FakeHTTPRequest(None, ('', 0), None, method=method, resource=resource, groups=(resource[len(remote):],), handler=handler)
 
@@ -187,6 +187,400 @@ def test_fancyindex_custom_postcontent():
 	assert index['postindex'] == ''
 	assert index['postcontent'] == test_string
 
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_stream():
+	headers, response = test('GET', '/', stream=True)
+
+	#Check status
+	assert response[0] == 200
+
+	#Check that a stream is returned for chunked encoding
+	assert isinstance(response[1], fancyindex.IterStream)
+
+	#Check response
+	index = json.loads(response[1].read().decode('utf-8'))
+	response[1].close()
+
+	assert index['dirname'] == '/'
+	assert len(index['entries']) == len(os.listdir('tmp/'))
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_stream_batches():
+	class BatchHandler(fancyindex.FancyIndexHandler):
+		index_batch_size = 2
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups=('/',), handler=list(fancyindex.new('tmp', '', index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, handler=BatchHandler, stream=True).values())[0])
+
+	response = request.handler.respond()
+
+	#Check that batches are joined correctly
+	index = json.loads(response[1].read().decode('utf-8'))
+
+	assert [entry['name'] for entry in index['entries']] == [str(direntry) for direntry in fancyindex.listdir('tmp/', root=True)]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_limit_offset():
+	dirlist = [str(direntry) for direntry in fancyindex.listdir('tmp/testdir/')]
+
+	headers, response = test('GET', '/testdir/?offset=1&limit=1')
+
+	#Check status
+	assert response[0] == 200
+
+	#Check response
+	index = json.loads(response[1])
+
+	assert index['dirname'] == '/testdir/'
+	assert [entry['name'] for entry in index['entries']] == dirlist[1:2]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_default_limit():
+	dirlist = [str(direntry) for direntry in fancyindex.listdir('tmp/', root=True)]
+
+	headers, response = test('GET', '/', limit=2)
+
+	index = json.loads(response[1])
+
+	assert [entry['name'] for entry in index['entries']] == dirlist[:2]
+
+	headers, response = test('GET', '/?offset=4', limit=2)
+
+	index = json.loads(response[1])
+
+	assert [entry['name'] for entry in index['entries']] == dirlist[4:6]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_bad_limit():
+	for query in ['limit=a', 'offset=a', 'limit=0', 'offset=-1']:
+		try:
+			test('GET', '/?' + query)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == 400
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_pagination():
+	handler = list(fancyindex.new('tmp').values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/?offset=2&limit=2', groups=('/?offset=2&limit=2',), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check for both links
+	assert '<a href="?offset=0&amp;limit=2">Previous</a>' in response[1]
+	assert '<a href="?offset=4&amp;limit=2">Next</a>' in response[1]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups=('/',), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check that there is no pagination without a limit
+	assert 'pagination' not in response[1].split('</table>', 1)[1]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_pagination_query():
+	handler = list(fancyindex.new('tmp').values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=html&offset=2&limit=2', groups=('/?format=html&offset=2&limit=2',), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check that the other parameters are kept
+	assert '<a href="?offset=0&amp;limit=2&amp;format=html">Previous</a>' in response[1]
+	assert '<a href="?offset=4&amp;limit=2&amp;format=html">Next</a>' in response[1]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_unsorted():
+	#Check that unsorted pages are taken lazily in directory order
+	direntries, total = fancyindex.scandir_page('tmp/', root=True, offset=1, limit=2)
+
+	assert not isinstance(direntries, list)
+	assert total == len(os.listdir('tmp/'))
+	assert [str(direntry).rstrip('/') for direntry in direntries] == os.listdir('tmp/')[1:3]
+
+	direntries, total = fancyindex.scandir_page('tmp/testdir/')
+
+	assert total == 2
+	assert [str(direntry) for direntry in direntries] == ['../', 'magic']
+
+	handler = list(fancyindex.new('tmp', index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, stream=True, sort=False).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups=('/',), handler=handler)
+
+	response = request.handler.respond()
+
+	index = json.loads(response[1].read().decode('utf-8'))
+	response[1].close()
+
+	assert [entry['name'].rstrip('/') for entry in index['entries']] == os.listdir('tmp/')
+
+@nottest
+def test_json(resource, headers=None, cache=None):
+	handler = list(fancyindex.new('tmp', cache=cache).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, headers=headers, method='GET', resource=resource, groups=(resource,), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check status
+	assert response[0] == 200
+
+	#Check headers
+	assert request.response.headers.get('Content-Type') == 'application/json'
+	assert request.response.headers.get('Vary') == 'Accept'
+
+	index = json.loads(response[1].read().decode('utf-8'))
+	response[1].close()
+
+	return index
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_json():
+	index = test_json('/?format=json')
+
+	assert index['dirname'] == '/'
+	assert index['total'] == len(os.listdir('tmp/'))
+
+	#Check entries are in the normal order
+	assert [entry['name'] for entry in index['entries']] == [str(direntry).rstrip('/') for direntry in fancyindex.listdir('tmp/', root=True)]
+
+	for entry in index['entries']:
+		path = os.path.join('tmp/', entry['name'])
+
+		assert entry['is_dir'] == os.path.isdir(path)
+		assert entry['mtime'] == os.path.getmtime(path)
+		if entry['is_dir']:
+			assert entry['size'] == None
+		else:
+			assert entry['size'] == os.path.getsize(path)
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_json_accept():
+	request_headers = web.HTTPHeaders()
+	request_headers.set('Accept', 'text/html;q=0.5, application/json')
+
+	index = test_json('/testdir/', headers=request_headers)
+
+	assert index['dirname'] == '/testdir/'
+	assert [entry['name'] for entry in index['entries']] == ['magic']
+
+def test_accepts_json():
+	assert fancyindex.accepts_json('application/json')
+	assert fancyindex.accepts_json('application/json, */*;q=0.1')
+	assert not fancyindex.accepts_json('')
+	assert not fancyindex.accepts_json('text/html, application/json')
+	assert not fancyindex.accepts_json('*/*')
+	assert not fancyindex.accepts_json('application/json;q=0')
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_json_sort():
+	os.utime('tmp/test', (0, 0))
+	with open('tmp/big', 'w') as file:
+		file.write(test_string * 2)
+
+	index = test_json('/?format=json&sort=size&order=desc')
+
+	names = [entry['name'] for entry in index['entries']]
+	assert names[0] == 'big'
+	#Directories have no size and come last
+	assert set(names[-4:]) == set(['testdir', 'tmp', 'Tmp', 'tëst'])
+
+	index = test_json('/?format=json&sort=mtime')
+
+	assert index['entries'][0]['name'] == 'test'
+
+	index = test_json('/?format=json&order=desc')
+
+	assert [entry['name'] for entry in index['entries']] == [str(direntry).rstrip('/') for direntry in reversed(fancyindex.listdir('tmp/', root=True))]
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_sortclass_modified():
+	#Pretend longer names were modified later
+	class NamedEntry(fancyindex.DirEntry):
+		@property
+		def modified(self):
+			return time.localtime(len(self.filename) * 86400)
+
+	handler = list(fancyindex.new('tmp', sortclass=NamedEntry).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=json&sort=mtime', groups=('/?format=json&sort=mtime',), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check that the sortclass modified is used for sorting
+	index = json.loads(response[1].read().decode('utf-8'))
+	response[1].close()
+
+	lengths = [len(entry['name']) + entry['is_dir'] for entry in index['entries']]
+	assert lengths == sorted(lengths)
+	assert index['entries'][-1]['name'] == 'testdir'
+
+	#And for the index
+	headers, response = test('GET', '/', sortclass=NamedEntry)
+
+	index = json.loads(response[1])
+
+	for entry in index['entries']:
+		assert entry['modified'] == fancyindex.human_readable_time(time.localtime(len(entry['name']) * 86400))
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_sortclass_assigned_modified():
+	#Assign modified on the instance like a sortclass could before it was a property
+	class AssignedEntry(fancyindex.DirEntry):
+		def __init__(self, dirname, filename):
+			fancyindex.DirEntry.__init__(self, dirname, filename)
+
+			self.modified = time.localtime(len(self.filename) * 86400)
+
+	handler = list(fancyindex.new('tmp', sortclass=AssignedEntry).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/?format=json&sort=mtime', groups=('/?format=json&sort=mtime',), handler=handler)
+
+	response = request.handler.respond()
+
+	#Check that the assigned modified is used for sorting
+	index = json.loads(response[1].read().decode('utf-8'))
+	response[1].close()
+
+	lengths = [len(entry['name']) + entry['is_dir'] for entry in index['entries']]
+	assert lengths == sorted(lengths)
+
+	#And for the index
+	headers, response = test('GET', '/', sortclass=AssignedEntry)
+
+	index = json.loads(response[1])
+
+	for entry in index['entries']:
+		assert entry['modified'] == fancyindex.human_readable_time(time.localtime(len(entry['name']) * 86400))
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_json_glob():
+	index = test_json('/?format=json&glob=t*&glob=T*&limit=2&offset=1')
+
+	assert index['total'] == 6
+	assert [entry['name'] for entry in index['entries']] == ['Tmp', 'tmp']
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_json_bad_query():
+	handler = list(fancyindex.new('tmp').values())[0]
+
+	for query in ['format=xml', 'format=json&sort=bad', 'format=json&order=bad']:
+		request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/?' + query, groups=('/?' + query,), handler=handler)
+
+		try:
+			request.handler.respond()
+			assert False
+		except web.HTTPError as error:
+			assert error.code == 400
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_cache():
+	cache = fancyindex.DirCache(ttl=60)
+
+	#Settle the directory so its scan is kept
+	old = time.time() - 60
+	os.utime('tmp/', (old, old))
+
+	index = test_json('/?format=json', cache=cache)
+
+	assert index['total'] == 6
+
+	#Check that the scan was cached
+	assert len(cache.scans) == 1
+	direntries = cache.get('tmp/', True)
+	assert cache.get('tmp/', True) is direntries
+
+	#Check that the cache is invalidated when the directory changes
+	with open('tmp/new', 'w') as file:
+		pass
+	os.utime('tmp/', ns=(0, 0))
+
+	index = test_json('/?format=json', cache=cache)
+
+	assert index['total'] == 7
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_fancyindex_cache_invalidation():
+	cache = fancyindex.DirCache(ttl=60)
+
+	handler = list(fancyindex.new('tmp', index_template=test_index_template, index_entry=test_index_entry, index_entry_join=test_index_entry_join, cache=cache).values())[0]
+
+	def names():
+		request = fake.FakeHTTPRequest(None, ('', 0), None, method='GET', resource='/', groups=('/',), handler=handler)
+		return [entry['name'] for entry in json.loads(request.handler.respond()[1])['entries']]
+
+	#Check that a directory that just changed is not cached since another change might not move its mtime
+	names()
+	assert len(cache.scans) == 0
+
+	#Settle the directory so its scan is kept
+	old = time.time() - 60
+	os.utime('tmp/', (old, old))
+
+	assert 'new' not in names()
+	assert len(cache.scans) == 1
+
+	#Check that adding and then removing a file is seen through the cache
+	with open('tmp/new', 'w') as file:
+		pass
+
+	assert 'new' in names()
+
+	os.utime('tmp/', (old, old))
+	names()
+	os.remove('tmp/new')
+
+	assert 'new' not in names()
+
+def test_dircache_eviction():
+	os.mkdir('tmp')
+	os.mkdir('tmp/a')
+	os.mkdir('tmp/b')
+
+	old = time.time() - 60
+	os.utime('tmp/a', (old, old))
+	os.utime('tmp/b', (old, old))
+
+	try:
+		cache = fancyindex.DirCache(size=1)
+
+		cache.get('tmp/a/')
+		cache.get('tmp/b/')
+
+		assert list(cache.scans.keys()) == [('tmp/b/', False, fancyindex.DirEntry)]
+
+		cache.clear()
+
+		assert len(cache.scans) == 0
+	finally:
+		shutil.rmtree('tmp')
+
+@with_setup(setup_fancyindex, teardown_fancyindex)
+def test_listdir_page():
+	dirlist = fancyindex.listdir('tmp/')
+
+	page, total = fancyindex.listdir_page('tmp/', offset=2, limit=3)
+
+	assert total == len(dirlist)
+	assert page == dirlist[2:5]
+
+	page, total = fancyindex.listdir_page('tmp/', root=True, offset=4)
+
+	assert total == len(dirlist) - 1
+	assert page == dirlist[5:]
+
+def test_iterstream():
+	stream = fancyindex.IterStream(['ab', b'', 'cde', b'f'])
+
+	assert stream.read(2) == b'ab'
+	assert stream.read(2) == b'cd'
+	assert stream.read() == b'ef'
+	assert stream.read(1) == b''
+
+	stream.close()
+
+	assert stream.closed
+
 @with_setup(setup_fancyindex, teardown_fancyindex)
 def test_sortclass_trailing_slash():
 	sort_obj = fancyindex.DirEntry('tmp/', 'testdir')
@@ -309,3 +703,46 @@ def test_human_readable_size():
 
 def test_human_readable_time():
 	assert fancyindex.human_readable_time(time.gmtime(0)) == '01-Jan-1970 00:00 GMT'
+
+def test_human_readable_minute():
+	now = time.time()
+
+	assert fancyindex.human_readable_minute(int(now // 60)) == fancyindex.human_readable_time(time.localtime(now))
+
+def test_template_parts():
+	template = fancyindex.compile_template('a{b}c{{d}}{e!r:>4}')
+
+	assert template.parts[0] == 'a'
+	assert template.parts[1].field == 'b'
+	assert template.parts[2] == 'c{d}'
+	assert template.parts[3].field == 'e'
+	assert template.parts[3].conversion == 'r'
+	assert template.parts[3].format_spec == '>4'
+
+	assert template.slots == [template.parts[1], template.parts[3]]
+
+	#Check that templates are only compiled once
+	assert fancyindex.compile_template('a{b}c{{d}}{e!r:>4}') is template
+
+def test_template_renderer():
+	names = ('name', 'size', 'modified')
+	values = ('test', '1.00 B', 'now')
+
+	#Simple templates use the fast path
+	for template_string in ['{name}', '100% {name}{name} {size} {modified}', 'nothing', test_index_entry, fancyindex.index_entry]:
+		render = fancyindex.compile_template(template_string).renderer(names)
+
+		assert render(values) == template_string.format(name='test', size='1.00 B', modified='now')
+
+	#Others fall back to str.format
+	render = fancyindex.compile_template('{name!r} {size:>8}').renderer(names)
+
+	assert render(values) == '\'test\'   1.00 B'
+
+	render = fancyindex.compile_template('{missing}').renderer(names)
+
+	try:
+		render(values)
+		assert False
+	except KeyError:
+		pass
@@ -1,6 +1,9 @@
+import errno
 import stat
 import os
 import shutil
+import threading
+import time
 
 from web import web, file
 
@@ -11,12 +14,12 @@ from nose.tools import with_setup, nottest
 test_string = b'secret test message'
 
 @nottest
-def test(method, resource, body='', headers=web.HTTPHeaders(), handler=None, local='tmp', remote='', dir_index=False, modify=False, return_handler=False):
+def test(method, resource, body='', headers=web.HTTPHeaders(), handler=None, local='tmp', remote='', dir_index=False, modify=False, return_handler=False, fsync=False, reaper=None):
 	if not isinstance(body, bytes):
 		body = body.encode('utf-8')
 
 	if not handler:
-		route = file.new(local, remote, dir_index, modify)
+		route = file.new(local, remote, dir_index, modify, fsync=fsync, reaper=reaper)
 
 		handler = list(route.values())[0]
 
@@ -216,6 +219,27 @@ def test_get_backdir_past_remote():
 	assert response[1] == ''
 
 
+@with_setup(setup_get, teardown_get)
+def test_get_query():
+	headers, response, handler = test('GET', '/test?a=b&c=d', return_handler=True)
+
+	assert handler.filename == 'tmp/test'
+	assert handler.query == {'a': ['b'], 'c': ['d']}
+
+	#Check response
+	assert response[0] == 200
+	assert response[1].read() == test_string
+
+@with_setup(setup_get, teardown_get)
+def test_get_dir_query():
+	headers, response = test('GET', '/testdir?a=b')
+
+	#Check headers
+	assert headers.get('Location') == '/testdir/?a=b'
+
+	#Check resposne
+	assert response[0] == 307
+
 @with_setup(setup_get, teardown_get)
 def test_get_slash_handling():
 	headers, response, handler = test('GET', '/test', local='tmp/', remote='/', return_handler=True)
@@ -315,6 +339,343 @@ def test_put_existing_file():
 	assert response[0] == 200
 	assert response[1].read() == test_string
 
+@with_setup(setup_put, teardown_put)
+def test_put_atomic():
+	os.chmod('tmp/exists', 0o640)
+
+	headers, response = test('PUT', '/exists', body=test_string, modify=True)
+
+	#Check response
+	assert response[0] == 204
+
+	#Check that the mode was kept and no temporary files are left behind
+	assert stat.S_IMODE(os.stat('tmp/exists').st_mode) == 0o640
+	assert sorted(os.listdir('tmp')) == ['exists', 'forbidden']
+
+@with_setup(setup_put, teardown_put)
+def test_put_fsync():
+	headers, response = test('PUT', '/test', body=test_string, modify=True, fsync=True)
+
+	#Check response
+	assert response[0] == 204
+
+	with open('tmp/test', 'rb') as test_file:
+		assert test_file.read() == test_string
+
+@with_setup(setup_put, teardown_put)
+def test_put_large():
+	class MyHandler(file.ModifyFileHandler):
+		filename = 'tmp/test'
+		upload_buffer_size = 7
+
+	body = test_string * 100
+
+	headers, response = test('PUT', '/', body=body, handler=MyHandler)
+
+	#Check response
+	assert response[0] == 204
+
+	with open('tmp/test', 'rb') as test_file:
+		assert test_file.read() == body
+
+@with_setup(setup_put, teardown_put)
+def test_put_short():
+	class MyHandler(file.ModifyFileHandler):
+		filename = 'tmp/exists'
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, body=test_string, method='PUT', resource='/', handler=MyHandler)
+	request.headers.set('Content-Length', str(len(test_string) + 1))
+
+	try:
+		request.handler.respond()
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 400
+
+	#Check that the connection will not be reused
+	assert not request.keepalive
+
+	#Check that nothing was committed
+	assert os.path.getsize('tmp/exists') == 0
+	assert sorted(os.listdir('tmp')) == ['exists', 'forbidden']
+
+@with_setup(setup_put, teardown_put)
+def test_put_bad_length():
+	class MyHandler(file.ModifyFileHandler):
+		filename = 'tmp/test'
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, body=test_string, method='PUT', resource='/', handler=MyHandler)
+	request.headers.set('Content-Length', 'bad')
+
+	try:
+		request.handler.respond()
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 400
+
+	assert not os.path.exists('tmp/test')
+
+@nottest
+def test_range(resource, content_range, body=b'', handler=None):
+	if not handler:
+		handler = list(file.new('tmp', modify=True).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('', 0), None, body=body, method='PUT', resource=resource, groups=(resource,), handler=handler)
+	request.headers.set('Content-Range', content_range)
+	request.headers.set('Content-Length', str(len(body)))
+
+	return request, request.response.headers, request.handler.respond()
+
+@with_setup(setup_put, teardown_put)
+def test_put_range():
+	total = str(len(test_string))
+
+	#Upload the second half first
+	request, headers, response = test_range('/test', 'bytes 10-' + str(len(test_string) - 1) + '/' + total, test_string[10:])
+
+	assert response[0] == 202
+	assert headers.get('Range') == 'bytes=10-' + str(len(test_string) - 1)
+
+	#Nothing is committed until the upload is complete
+	assert not os.path.exists('tmp/test')
+	assert os.path.exists('tmp/.test.partial')
+
+	request, headers, response = test_range('/test', 'bytes */' + total)
+
+	assert response[0] == 202
+	assert headers.get('Range') == 'bytes=10-' + str(len(test_string) - 1)
+
+	request, headers, response = test_range('/test', 'bytes 0-9/' + total, test_string[:10])
+
+	assert response[0] == 204
+
+	#Check that the upload was promoted
+	with open('tmp/test', 'rb') as test_file:
+		assert test_file.read() == test_string
+
+	assert not os.path.exists('tmp/.test.partial')
+	assert 'tmp/test' not in file.partial_uploads
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_nonatomic():
+	request = fake.FakeHTTPRequest(None, ('', 0), None, body=test_string, method='PUT', resource='/test', groups=('/test',), handler=list(file.new('tmp', modify=True).values())[0])
+
+	assert request.handler.nonatomic == web.HTTPHandler.nonatomic
+
+	request.headers.set('Content-Range', 'bytes 0-1/2')
+
+	assert request.handler.nonatomic == True
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_errors():
+	for content_range, body, code in [('bytes 0-1', b'ab', 400), ('bytes 1-0/2', b'', 416), ('bytes 0-2/2', b'abc', 416), ('bytes 0-1/4', b'a', 400)]:
+		try:
+			test_range('/test', content_range, body)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == code
+
+	request, headers, response = test_range('/test', 'bytes 0-1/4', b'ab')
+
+	assert response[0] == 202
+
+	#Check that the total size can not change
+	try:
+		test_range('/test', 'bytes 2-3/5', b'cd')
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 409
+
+	del file.partial_uploads['tmp/test']
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_short():
+	request = fake.FakeHTTPRequest(None, ('', 0), None, body=b'a', method='PUT', resource='/test', groups=('/test',), handler=list(file.new('tmp', modify=True).values())[0])
+	request.headers.set('Content-Range', 'bytes 0-1/2')
+	request.headers.set('Content-Length', '2')
+
+	try:
+		request.handler.respond()
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 400
+
+	#Check that the short range was not recorded
+	assert file.partial_uploads['tmp/test'].ranges == []
+	assert file.partial_uploads['tmp/test'].writers == 0
+
+	del file.partial_uploads['tmp/test']
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_size():
+	#Check that the size is checked before anything is created
+	for handler, total, code in [(list(file.new('tmp', modify=True, max_upload_size=4).values())[0], 5, 413), (None, 100000000000000000000, 507)]:
+		try:
+			test_range('/test', 'bytes 0-0/' + str(total), b'a', handler=handler)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == code
+
+		assert not os.path.exists('tmp/.test.partial')
+		assert 'tmp/test' not in file.partial_uploads
+
+	#And for whole uploads
+	try:
+		test('PUT', '/test', body=test_string, handler=list(file.new('tmp', modify=True, max_upload_size=4).values())[0])
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 413
+
+	assert not os.path.exists('tmp/test')
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_stage_failure():
+	class FullHandler(file.ModifyFileHandler):
+		def preallocate(self, fd, length):
+			raise OSError(errno.ENOSPC, 'No space left on device')
+
+	route = file.new('tmp', handler=FullHandler)
+
+	try:
+		test_range('/test', 'bytes 0-1/2', b'ab', handler=list(route.values())[0])
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 507
+
+	#Check that nothing is left behind
+	assert not os.path.exists('tmp/.test.partial')
+	assert 'tmp/test' not in file.partial_uploads
+
+	#Check that the upload can start over
+	request, headers, response = test_range('/test', 'bytes 0-1/2', b'ab')
+
+	assert response[0] == 204
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_stage_unlocked():
+	staging = threading.Event()
+	release = threading.Event()
+
+	class SlowHandler(file.ModifyFileHandler):
+		def stage(self, upload):
+			staging.set()
+			release.wait(2)
+			super().stage(upload)
+
+	results = []
+	thread = threading.Thread(target=lambda: results.append(test_range('/slow', 'bytes 0-1/2', b'ab', handler=list(file.new('tmp', handler=SlowHandler).values())[0])))
+	thread.start()
+
+	try:
+		assert staging.wait(2)
+
+		#Check that other uploads go on while a staging file is created
+		request, headers, response = test_range('/test', 'bytes 0-1/2', b'ab')
+
+		assert response[0] == 204
+		assert 'tmp/slow' in file.partial_uploads
+	finally:
+		release.set()
+		thread.join()
+
+	assert results[0][2][0] == 204
+
+	with open('tmp/slow', 'rb') as slow_file:
+		assert slow_file.read() == b'ab'
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_expire():
+	request, headers, response = test_range('/test', 'bytes 0-1/4', b'ab')
+
+	assert response[0] == 202
+	assert os.path.exists('tmp/.test.partial')
+
+	#Check that an abandoned upload is forgotten and its staging file removed
+	file.partial_uploads['tmp/test'].touched -= 7200
+
+	request, headers, response = test_range('/other', 'bytes */4')
+
+	assert 'tmp/test' not in file.partial_uploads
+	assert not os.path.exists('tmp/.test.partial')
+
+	#Check that one in use is kept
+	request, headers, response = test_range('/test', 'bytes 0-1/4', b'ab')
+
+	assert file.expire_partial_uploads(3600) == []
+	assert 'tmp/test' in file.partial_uploads
+
+	del file.partial_uploads['tmp/test']
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_reaper_expire():
+	reaper = file.Reaper('tmp/trash', partial_upload_timeout=60, expire_interval=0.05)
+
+	try:
+		reaper.start()
+
+		request, headers, response = test_range('/test', 'bytes 0-1/4', b'ab')
+
+		assert os.path.exists('tmp/.test.partial')
+
+		#Check that the reaper expires an abandoned upload without another upload coming along
+		file.partial_uploads['tmp/test'].touched -= 120
+
+		for i in range(200):
+			if reaper.stats()['uploads_expired']:
+				break
+			time.sleep(0.01)
+
+		assert reaper.stats()['uploads_expired'] == 1
+		assert 'tmp/test' not in file.partial_uploads
+		assert not os.path.exists('tmp/.test.partial')
+	finally:
+		reaper.close()
+
+@with_setup(setup_put, teardown_put)
+def test_put_range_hidden():
+	request, headers, response = test_range('/test', 'bytes 0-1/4', b'ab')
+
+	#Check that the staging file can not be reached
+	for method in ['GET', 'PUT', 'DELETE']:
+		try:
+			test(method, '/.test.partial', modify=True)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == 404
+
+	#Or listed
+	headers, response = test('GET', '/', dir_index=True)
+
+	assert '.test.partial' not in response[1]
+	assert 'exists\n' in response[1]
+
+	assert file.hidden('.test.0123456789ab.upload')
+	assert not file.hidden('.test')
+	assert not file.hidden('test.partial')
+
+	del file.partial_uploads['tmp/test']
+
+def test_partial_upload_ranges():
+	upload = file.PartialUpload('tmp/test', 10)
+
+	upload.add(4, 6)
+	upload.add(0, 2)
+
+	assert upload.ranges == [(0, 2), (4, 6)]
+	assert upload.range_header() == 'bytes=0-1,4-5'
+	assert not upload.complete()
+
+	upload.add(2, 4)
+
+	assert upload.ranges == [(0, 6)]
+
+	upload.add(5, 10)
+
+	assert upload.ranges == [(0, 10)]
+	assert upload.complete()
+
+	assert upload.staging == 'tmp/.test.partial'
+
 @with_setup(setup_put, teardown_put)
 def test_put_forbidden():
 	try:
@@ -439,6 +800,105 @@ def test_delete_dir():
 	except web.HTTPError as error:
 		assert error.code == 404
 
+@with_setup(setup_delete, teardown_delete)
+def test_delete_dir_reaper():
+	os.makedirs('tmp/testdir/a/b')
+	with open('tmp/testdir/a/b/c', 'wb') as test_file:
+		pass
+	with open('tmp/testdir/d', 'wb') as test_file:
+		pass
+	os.symlink('../forbiddendir', 'tmp/testdir/link')
+
+	reaper = file.Reaper('tmp/trash', num_threads=1)
+
+	try:
+		headers, response = test('DELETE', '/testdir/', modify=True, reaper=reaper)
+
+		#Check response
+		assert response[0] == 204
+		assert response[1] == ''
+
+		#Check that it was moved away immediately
+		assert not os.path.exists('tmp/testdir')
+
+		reaper.join()
+
+		#Check that the trash was emptied without following the link
+		assert os.listdir('tmp/trash') == []
+		assert os.path.exists('tmp/forbiddendir')
+
+		stats = reaper.stats()
+		assert stats['pending'] == 0
+		assert stats['removing'] == {}
+		assert stats['trees_discarded'] == 1
+		assert stats['trees_removed'] == 1
+		#The link may be counted as either a file or a directory
+		assert stats['files_removed'] + stats['dirs_removed'] == 6
+		assert stats['dirs_removed'] >= 3
+		assert stats['errors'] == 0
+	finally:
+		reaper.close()
+
+	assert reaper.worker_threads == None
+
+@with_setup(setup_delete, teardown_delete)
+def test_delete_file_reaper():
+	reaper = file.Reaper('tmp/trash')
+
+	headers, response = test('DELETE', '/test', modify=True, reaper=reaper)
+
+	#Check response
+	assert response[0] == 204
+
+	#Check that files are removed directly
+	assert not os.path.exists('tmp/test')
+	assert reaper.worker_threads == None
+
+@with_setup(setup_delete, teardown_delete)
+def test_reaper_bad_trash():
+	#Check that a trash that can't be created fails right away
+	try:
+		file.Reaper('tmp/test/trash')
+		assert False
+	except OSError:
+		pass
+
+	os.makedirs('tmp/testdir/a')
+
+	log = fake.FakeHTTPLog(None, None)
+	reaper = file.Reaper('tmp/trash', log=log)
+
+	try:
+		#Check that deletes fall back to removing inline if the trash stops working
+		os.rmdir('tmp/trash')
+		with open('tmp/trash', 'wb') as trash_file:
+			pass
+
+		headers, response = test('DELETE', '/testdir/', modify=True, reaper=reaper)
+
+		assert response[0] == 204
+		assert not os.path.exists('tmp/testdir')
+
+		assert 'WARN: Removing tmp/testdir without the trash: ' in log.httpd_log.getvalue()
+		assert reaper.stats()['trees_discarded'] == 0
+	finally:
+		reaper.close()
+
+@with_setup(setup_delete, teardown_delete)
+def test_reaper_leftovers():
+	os.makedirs('tmp/trash/leftover/a')
+
+	reaper = file.Reaper('tmp/trash')
+
+	try:
+		reaper.start()
+		reaper.join()
+
+		assert os.listdir('tmp/trash') == []
+		assert reaper.stats()['trees_removed'] == 1
+	finally:
+		reaper.close()
+
 @with_setup(setup_delete, teardown_delete)
 def test_delete_nomodify():
 	try:
@@ -0,0 +1,613 @@
+import socket
+import time
+
+from web import web, http2
+
+import fake
+
+from nose.tools import nottest
+
+preface = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+class TestHandler(web.HTTPHandler):
+	def do_get(self):
+		self.response.headers.set('Content-Type', 'text/plain')
+
+		if self.groups[0] == 'big':
+			return 200, b'a' * 100000
+		elif self.groups[0] == 'stream':
+			return 200, (str(i).encode(web.default_encoding) for i in range(5))
+		elif self.groups[0] == 'detach':
+			return 200, web.Detach(lambda request: None)
+		elif self.groups[0] == 'slow':
+			time.sleep(0.2)
+
+		return 200, 'test ' + self.groups[0] + ' ' + self.request.headers.get('Host', '') + ' ' + self.request.headers.get('Cookie', '')
+
+	def do_post(self):
+		return 200, b'got ' + self.request.headers.get('Content-Length').encode(web.http_encoding) + b' ' + self.request.body
+
+@nottest
+def test_server(multiplexer, **kwargs):
+	httpd = web.HTTPServer(('localhost', 0), {'/(.*)': TestHandler}, log=fake.FakeHTTPLog(None, None), http2=multiplexer, **kwargs)
+	httpd.start()
+
+	return httpd
+
+class TestClient(object):
+	def __init__(self, httpd, settings=[]):
+		self.socket = socket.create_connection(httpd.server_address)
+		self.socket.settimeout(2)
+
+		self.rfile = self.socket.makefile('rb')
+
+		self.encoder = http2.HPACKEncoder()
+		self.decoder = http2.HPACKDecoder()
+
+		self.socket.sendall(preface + http2.build_settings(settings))
+
+	def send(self, *frames):
+		self.socket.sendall(b''.join(frames))
+
+	def request(self, stream_id, method, path, headers=[], end_stream=True):
+		block = self.encoder.encode([(':method', method), (':scheme', 'http'), (':path', path), (':authority', 'localhost')] + headers)
+
+		self.send(http2.build_frame(http2.frame_headers, http2.flag_end_headers | (http2.flag_end_stream if end_stream else 0), stream_id, block))
+
+	def read_frame(self):
+		head = self.rfile.read(9)
+		if len(head) < 9:
+			return None
+
+		length = int.from_bytes(head[:3], 'big')
+
+		return head[3], head[4], int.from_bytes(head[5:9], 'big'), self.rfile.read(length)
+
+	def response(self, stream_id, frames=None):
+		#Read until the stream ends, keeping the header table in step
+		headers = None
+		body = b''
+
+		while True:
+			frame_type, flags, frame_stream_id, payload = self.read_frame()
+
+			if frames is not None:
+				frames.append((frame_type, flags, frame_stream_id, payload))
+
+			if frame_type == http2.frame_headers:
+				decoded = self.decoder.decode(payload)
+			else:
+				decoded = None
+
+			if frame_stream_id != stream_id:
+				continue
+
+			if frame_type == http2.frame_rst_stream:
+				return headers, body, int.from_bytes(payload, 'big')
+
+			if decoded is not None:
+				headers = dict(decoded)
+			elif frame_type == http2.frame_data:
+				body += payload
+
+			if flags & http2.flag_end_stream:
+				return headers, body, None
+
+	def goaway(self):
+		while True:
+			frame = self.read_frame()
+			if frame is None:
+				return None
+
+			frame_type, flags, stream_id, payload = frame
+			if frame_type == http2.frame_goaway:
+				return int.from_bytes(payload[:4], 'big'), int.from_bytes(payload[4:8], 'big')
+
+	def close(self):
+		self.rfile.close()
+		self.socket.close()
+
+@nottest
+def wait_for(condition, timeout=2):
+	end = time.monotonic() + timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+
+def test_integer():
+	#RFC 7541 C.1
+	assert http2.encode_integer(10, 5) == b'\x0a'
+	assert http2.encode_integer(1337, 5) == b'\x1f\x9a\x0a'
+	assert http2.encode_integer(42, 8) == b'\x2a'
+
+	assert http2.decode_integer(b'\x1f\x9a\x0a', 0, 5) == (1337, 3)
+	assert http2.decode_integer(b'\xea', 0, 5) == (10, 1)
+
+	try:
+		http2.decode_integer(b'\x1f\xff\xff\xff\xff\xff\xff', 0, 5)
+		assert False
+	except http2.HPACKError:
+		pass
+
+def test_huffman():
+	#RFC 7541 C.4.1
+	assert http2.huffman_encode(b'www.example.com') == bytes.fromhex('f1e3c2e5f23a6ba0ab90f4ff')
+	assert http2.huffman_decode(bytes.fromhex('f1e3c2e5f23a6ba0ab90f4ff')) == b'www.example.com'
+
+	data = bytes(range(256))
+	assert http2.huffman_decode(http2.huffman_encode(data)) == data
+
+	#Padding longer than 7 bits or not made of ones
+	for encoded in [http2.huffman_encode(b'a') + b'\xff', b'\x00']:
+		try:
+			http2.huffman_decode(encoded)
+			assert False
+		except http2.HPACKError:
+			pass
+
+def test_decode():
+	decoder = http2.HPACKDecoder()
+
+	#RFC 7541 C.3
+	assert decoder.decode(bytes.fromhex('828684410f7777772e6578616d706c652e636f6d')) == [(':method', 'GET'), (':scheme', 'http'), (':path', '/'), (':authority', 'www.example.com')]
+	assert decoder.size == 57
+
+	assert decoder.decode(bytes.fromhex('828684be58086e6f2d6361636865')) == [(':method', 'GET'), (':scheme', 'http'), (':path', '/'), (':authority', 'www.example.com'), ('cache-control', 'no-cache')]
+	assert decoder.size == 110
+
+	assert decoder.decode(bytes.fromhex('828785bf400a637573746f6d2d6b65790c637573746f6d2d76616c7565')) == [(':method', 'GET'), (':scheme', 'https'), (':path', '/index.html'), (':authority', 'www.example.com'), ('custom-key', 'custom-value')]
+	assert decoder.size == 164
+	assert list(decoder.table) == [('custom-key', 'custom-value'), ('cache-control', 'no-cache'), (':authority', 'www.example.com')]
+
+	#Size updates only at the start and only as large as allowed
+	for block in [bytes.fromhex('823f00'), bytes.fromhex('3fe21f')]:
+		try:
+			decoder.decode(block)
+			assert False
+		except http2.HPACKError:
+			pass
+
+	decoder.decode(bytes.fromhex('20'))
+	assert decoder.size == 0
+	assert not decoder.table
+
+def test_encode():
+	encoder = http2.HPACKEncoder()
+	decoder = http2.HPACKDecoder()
+
+	headers = [(':status', '200'), ('content-type', 'text/plain'), ('content-length', '4'), ('server', 'test')]
+
+	first = encoder.encode(headers)
+	assert decoder.decode(first) == headers
+
+	#Indexed the second time except for content-length
+	second = encoder.encode(headers)
+	assert decoder.decode(second) == headers
+	assert len(second) < len(first)
+	assert len(encoder.table) == 2
+
+	#Size changes are sent before the next block
+	encoder.resize(0)
+	encoder.resize(256)
+	assert encoder.encode(headers).startswith(http2.encode_integer(0, 5, 0x20) + http2.encode_integer(256, 5, 0x20))
+	assert encoder.resized is None
+
+def test_get():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'GET', '/hello', [('cookie', 'a=1'), ('cookie', 'b=2')])
+		headers, body, error = client.response(1)
+
+		assert headers[':status'] == '200'
+		assert headers['content-type'] == 'text/plain'
+		assert headers['content-length'] == str(len(body))
+		assert 'connection' not in headers
+		assert body == b'test hello localhost a=1; b=2'
+
+		#Check that the connection is reused and doesn't hold a worker thread
+		client.request(3, 'GET', '/again')
+		assert client.response(3)[1] == b'test again localhost '
+
+		wait_for(lambda: httpd.inflight == {})
+		assert httpd.inflight == {}
+		assert len(multiplexer.sessions) == 1
+
+		client.close()
+
+		wait_for(lambda: not multiplexer.sessions)
+		assert not multiplexer.sessions
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_head_options():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		frames = []
+		client.request(1, 'HEAD', '/hello')
+		headers, body, error = client.response(1, frames)
+
+		#Headers alone end the stream
+		assert headers[':status'] == '200'
+		assert body == b''
+		assert frames[-1][0] == http2.frame_headers
+		assert frames[-1][1] & http2.flag_end_stream
+
+		client.request(3, 'OPTIONS', '/hello')
+		headers, body, error = client.response(3)
+
+		assert headers[':status'] == '204'
+		assert headers['allow']
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_concurrent():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer, num_threads=4)
+
+	try:
+		client = TestClient(httpd)
+
+		#The slow stream does not hold up the others
+		client.request(1, 'GET', '/slow')
+		client.request(3, 'GET', '/fast')
+		client.request(5, 'GET', '/stream')
+
+		frames = []
+		headers, body, error = client.response(1, frames)
+
+		assert body == b'test slow localhost '
+
+		stream_ids = [stream_id for frame_type, flags, stream_id, payload in frames if frame_type == http2.frame_headers]
+		assert stream_ids[-1] == 1
+		assert set(stream_ids) == {1, 3, 5}
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_stream():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'GET', '/stream')
+		headers, body, error = client.response(1)
+
+		#No chunked encoding over HTTP/2
+		assert 'transfer-encoding' not in headers
+		assert body == b'01234'
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_post():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'POST', '/', [('content-length', '8')], end_stream=False)
+		client.send(http2.build_frame(http2.frame_data, 0, 1, b'test'), http2.build_frame(http2.frame_data, http2.flag_end_stream, 1, b'data'))
+		assert client.response(1)[1] == b'got 8 testdata'
+
+		#Without a Content-Length, the body is collected first and padding is left out
+		client.request(3, 'POST', '/', end_stream=False)
+		client.send(http2.build_frame(http2.frame_data, http2.flag_padded, 3, b'\x02test\x00\x00'), http2.build_frame(http2.frame_data, http2.flag_end_stream, 3, b'data'))
+		assert client.response(3)[1] == b'got 8 testdata'
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_post_too_large():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'POST', '/', [('content-length', str(web.max_request_size + 1))], end_stream=False)
+		headers, body, error = client.response(1)
+
+		assert headers[':status'] == '413'
+
+		#The client is told to stop sending the body
+		frame_type, flags, stream_id, payload = client.read_frame()
+		assert frame_type == http2.frame_rst_stream
+		assert int.from_bytes(payload, 'big') == http2.error_none
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_flow_control():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd, [(http2.setting_initial_window_size, 1000)])
+
+		client.request(1, 'GET', '/big')
+
+		#Only the window is sent until the client asks for more
+		received = 0
+		while received < 1000:
+			frame_type, flags, stream_id, payload = client.read_frame()
+			if frame_type == http2.frame_headers:
+				client.decoder.decode(payload)
+			elif frame_type == http2.frame_data:
+				received += len(payload)
+
+		assert received == 1000
+
+		#A ping gets answered while the stream waits
+		client.send(http2.build_frame(http2.frame_ping, 0, 0, b'12345678'))
+		assert client.read_frame() == (http2.frame_ping, http2.flag_ack, 0, b'12345678')
+
+		client.send(http2.build_window_update(1, 99000), http2.build_window_update(0, 99000))
+		headers, body, error = client.response(1)
+
+		assert len(body) == 99000
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_ping_settings():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.send(http2.build_frame(http2.frame_ping, 0, 0, b'12345678'))
+
+		frames = []
+		while True:
+			frame = client.read_frame()
+			frames.append(frame[:2])
+			if frame[0] == http2.frame_ping:
+				break
+
+		assert frame == (http2.frame_ping, http2.flag_ack, 0, b'12345678')
+
+		#Server settings and acknowledgement of the client's
+		assert (http2.frame_settings, 0) in frames
+		assert (http2.frame_settings, http2.flag_ack) in frames
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_reset():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd, [(http2.setting_initial_window_size, 1000)])
+
+		#A reset stream stops waiting on its window
+		client.request(1, 'GET', '/big')
+		wait_for(lambda: httpd.inflight)
+		client.send(http2.build_rst_stream(1, http2.error_cancel))
+
+		wait_for(lambda: httpd.inflight == {})
+		assert httpd.inflight == {}
+
+		#The connection still works
+		client.request(3, 'GET', '/after')
+		assert client.response(3)[1] == b'test after localhost '
+
+		#Malformed requests reset just the stream
+		client.send(http2.build_frame(http2.frame_headers, http2.flag_end_headers | http2.flag_end_stream, 5, client.encoder.encode([(':method', 'GET'), (':path', '/'), (':scheme', 'http'), ('Upper', 'case')])))
+		assert client.response(5)[2] == http2.error_protocol
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_errors():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		for frame, code in [
+			#Even stream id
+			(http2.build_frame(http2.frame_headers, http2.flag_end_headers, 2, b'\x82'), http2.error_protocol),
+			#Data on the connection
+			(http2.build_frame(http2.frame_data, 0, 0, b'test'), http2.error_protocol),
+			#Empty window update
+			(http2.build_window_update(0, 0), http2.error_protocol),
+			#Frame larger than allowed
+			(http2.build_frame(http2.frame_data, 0, 1, b'a' * 16385), http2.error_frame_size),
+			#Bad header block
+			(http2.build_frame(http2.frame_headers, http2.flag_end_headers, 1, b'\xff\xff\xff'), http2.error_compression),
+			#Server push from the client
+			(http2.build_frame(http2.frame_push_promise, http2.flag_end_headers, 1, b'\x00\x00\x00\x02'), http2.error_protocol),
+		]:
+			client = TestClient(httpd)
+			client.send(frame)
+
+			assert client.goaway()[1] == code
+			assert client.read_frame() is None
+
+			client.close()
+
+		#Frames before settings
+		client = socket.create_connection(httpd.server_address)
+		client.settimeout(2)
+		client.sendall(preface + http2.build_frame(http2.frame_ping, 0, 0, b'12345678'))
+
+		rfile = client.makefile('rb')
+		assert rfile.read().endswith(http2.build_goaway(0, http2.error_protocol))
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_detach():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		#Handing off a stream is not possible so it is an error
+		client.request(1, 'GET', '/detach')
+		assert client.response(1)[0][':status'] == '500'
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_goaway():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		#Open streams finish before the connection closes
+		client.request(1, 'GET', '/slow')
+		client.send(http2.build_goaway(0, http2.error_none))
+
+		assert client.response(1)[1] == b'test slow localhost '
+		assert client.read_frame() is None
+
+		client.close()
+
+		wait_for(lambda: not multiplexer.sessions)
+		assert not multiplexer.sessions
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_shutdown():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'GET', '/hello')
+		client.response(1)
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+	#Check that connections are told the server is going away
+	assert client.goaway() == (1, http2.error_none)
+	assert client.read_frame() is None
+
+	assert not multiplexer.is_running()
+
+	client.close()
+
+def test_drain():
+	multiplexer = http2.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client = TestClient(httpd)
+
+		client.request(1, 'GET', '/slow')
+		wait_for(lambda: httpd.inflight)
+
+		#Stopping the server tells the session to go away but still finishes its open stream
+		httpd.stop()
+
+		assert client.goaway() == (1, http2.error_none)
+		assert client.response(1)[1] == b'test slow localhost '
+		assert client.read_frame() is None
+
+		assert not multiplexer.sessions
+
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_disabled():
+	httpd = web.HTTPServer(('localhost', 0), {'/(.*)': TestHandler}, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	try:
+		client = socket.create_connection(httpd.server_address)
+		client.settimeout(2)
+		client.sendall(preface)
+
+		rfile = client.makefile('rb')
+		assert rfile.readline() == b'HTTP/1.1 505 HTTP Version Not Supported\r\n'
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+
+def test_preface():
+	multiplexer = http2.Multiplexer()
+
+	server = fake.FakeHTTPServer(http2=multiplexer)
+
+	request = web.HTTPRequest(fake.FakeSocket(b'PRI * HTTP/2.0\r\n\r\nXX\r\n\r\n'), ('127.0.0.1', 1337), server)
+	request.handle()
+
+	#A bad preface is closed instead of handed off
+	assert request.detached == False
+	assert request.keepalive == False
+	assert not multiplexer.incoming
+
+	multiplexer.close()
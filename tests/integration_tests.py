@@ -1,6 +1,10 @@
 import io
+import json
 import os
+import re
 import shutil
+import socket
+import threading
 
 import web
 import web.file
@@ -122,6 +126,113 @@ def test_integration_https():
 	finally:
 		httpsd.close()
 
+@with_setup(setup_integration, teardown_integration)
+def test_integration_range_upload():
+	httpd = web.HTTPServer(('localhost', 0), routes, log=web.HTTPLog('tmp/httpd.log', 'tmp/access.log'))
+
+	httpd.start()
+
+	body = test_message * 1000
+	half = len(body) // 2
+	statuses = []
+
+	def upload(lower, upper):
+		conn = HTTPConnection('localhost', httpd.server_address[1])
+		conn.request('PUT', '/tmp/ranged', body[lower:upper], headers={ 'Content-Range': 'bytes ' + str(lower) + '-' + str(upper - 1) + '/' + str(len(body)) })
+		response = conn.getresponse()
+		response.read()
+		statuses.append(response.status)
+		conn.close()
+
+	try:
+		#Upload both halves at the same time on separate connections
+		threads = [threading.Thread(target=upload, args=(0, half)), threading.Thread(target=upload, args=(half, len(body)))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(timeout=5)
+
+		assert sorted(statuses) == [202, 204]
+
+		conn = HTTPConnection('localhost', httpd.server_address[1])
+		conn.request('GET', '/tmp/ranged')
+		response = conn.getresponse()
+		assert response.status == 200
+		assert response.read() == body
+		conn.close()
+	finally:
+		httpd.close()
+
+@with_setup(setup_integration, teardown_integration)
+def test_integration_structured_log():
+	httpd = web.HTTPServer(('localhost', 0), routes, log=web.HTTPLog('tmp/httpd.log', 'tmp/access.log', structured=True))
+
+	httpd.start()
+
+	try:
+		conn = HTTPConnection('localhost', httpd.server_address[1])
+
+		for i in range(2):
+			conn.request('GET', '/')
+			response = conn.getresponse()
+			assert response.status == 200
+			response.read()
+
+		conn.close()
+	finally:
+		httpd.close()
+
+	with open('tmp/access.log') as log_file:
+		records = [json.loads(line) for line in log_file]
+
+	assert len(records) == 2
+
+	#The second request reuses the connection
+	assert [record['reused'] for record in records] == [False, True]
+
+	for record in records:
+		assert record['code'] == '200'
+		assert record['size'] == str(len(test_message))
+		assert record['worker'] in range(httpd.max_threads)
+
+		for stage in ['queue_time', 'idle_time', 'parse_time', 'lock_time', 'handler_time', 'write_time']:
+			assert record[stage] >= 0
+
+@with_setup(setup_integration, teardown_integration)
+def test_integration_pipelining():
+	httpd = web.HTTPServer(('localhost', 0), routes, log=web.HTTPLog('tmp/httpd.log', 'tmp/access.log', structured=True))
+
+	httpd.start()
+
+	try:
+		client = socket.create_connection(httpd.server_address)
+		client.settimeout(2)
+
+		#Send every request before reading any response
+		client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n' + b'PUT /echo HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n\r\ntest' + b'GET /echo HTTP/1.1\r\nHost: localhost\r\n\r\n' + b'GET /io HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+		rfile = client.makefile('rb')
+		received = rfile.read()
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+
+	#Check that responses come back in order
+	assert re.findall(b'HTTP/1.1 [^\r]*', received) == [b'HTTP/1.1 200 OK', b'HTTP/1.1 204 No Content', b'HTTP/1.1 200 OK', b'HTTP/1.1 200 OK']
+	assert b'\r\n\r\ntestHTTP/1.1 200 OK\r\n' in received
+	assert received.endswith(b'\r\n\r\n' + test_message)
+
+	with open('tmp/access.log') as log_file:
+		records = [json.loads(line) for line in log_file]
+
+	assert [record['request'] for record in records] == ['GET / HTTP/1.1', 'PUT /echo HTTP/1.1', 'GET /echo HTTP/1.1', 'GET /io HTTP/1.1']
+
+	#Check that pipelined requests stay on one worker without going back through the queue
+	assert len(set(record['worker'] for record in records)) == 1
+	assert all(record['queue_time'] == 0 for record in records[1:])
+
 @nottest
 def run_conn_tests(conn):
 	#test_root
@@ -1,5 +1,12 @@
+import gzip
+import io
+import json
 import os
 import shutil
+import signal
+import sys
+import threading
+import time
 
 from web import web
 
@@ -99,3 +106,307 @@ def test_request():
 	assert value.startswith('localhost - - [')
 	#Timestamp here
 	assert value.endswith('] "GET / HTTP/1.1" 200 1024\n')
+
+@with_setup(setup_log, teardown_log)
+def test_flush():
+	log = make_log()
+
+	log.message(message)
+	log.flush()
+
+	with open(log.httpd_log.name) as log_file:
+		assert log_file.read().endswith(message + '\n')
+
+def test_timestamp_cache():
+	log = make_log(None, None)
+
+	now = time.time()
+
+	timestamp = log.timestamp(now)
+
+	assert timestamp == time.strftime('[%d/%b/%Y:%H:%M:%S %z]', time.localtime(now))
+
+	#Check that the same second reuses the formatted timestamp
+	assert log.timestamp(int(now)) is timestamp
+	assert log.timestamp(int(now) + 1) != timestamp
+
+def make_async_log(httpd_log='tmp/httpd.log', access_log='tmp/access.log', **kwargs):
+	return web.AsyncHTTPLog(httpd_log, access_log, **kwargs)
+
+@with_setup(setup_log, teardown_log)
+def test_async_message():
+	log = make_async_log()
+
+	try:
+		log.info(message)
+		log.request('localhost', 'GET / HTTP/1.1', '200', '1024', '-', '-')
+
+		log.flush()
+
+		with open(log.httpd_log.name) as log_file:
+			assert log_file.read().endswith('INFO: ' + message + '\n')
+
+		with open(log.access_log.name) as log_file:
+			value = log_file.read()
+
+		assert value.startswith('localhost - - [')
+		assert value.endswith('] "GET / HTTP/1.1" 200 1024\n')
+	finally:
+		log.close()
+
+	assert not log.writer_thread.is_alive()
+
+@with_setup(setup_log, teardown_log)
+def test_async_batch():
+	log = make_async_log(batch_size=8)
+
+	try:
+		for i in range(100):
+			log.request('localhost', 'GET /' + str(i) + ' HTTP/1.1', '200', '0')
+
+		log.flush()
+
+		#Check that everything was written in order
+		with open(log.access_log.name) as log_file:
+			lines = log_file.readlines()
+
+		assert len(lines) == 100
+		for i, line in enumerate(lines):
+			assert '"GET /' + str(i) + ' HTTP/1.1"' in line
+	finally:
+		log.close()
+
+@with_setup(setup_log, teardown_log)
+def test_async_drop():
+	log = make_async_log(max_queue=1)
+
+	#Hold the writer up so the queue fills
+	log.httpd_log_lock.acquire()
+
+	try:
+		log.message(message)
+
+		#Wait for the writer to take the first record
+		while not log.records.empty():
+			time.sleep(0.01)
+
+		log.message(message)
+		log.message(message)
+		log.message(message)
+
+		assert log.dropped == 2
+	finally:
+		log.httpd_log_lock.release()
+
+	log.close()
+
+	with open(log.httpd_log.name) as log_file:
+		value = log_file.read()
+
+	assert value.count(message) == 2
+	assert 'WARN: Dropped 2 log records\n' in value
+
+@with_setup(setup_log, teardown_log)
+def test_async_failure():
+	log = make_async_log(structured=True)
+
+	stderr = sys.stderr
+	sys.stderr = io.StringIO()
+
+	try:
+		#A record that can't be formatted is reported and left out without losing the rest of its batch
+		log.request('localhost', 'GET /bad HTTP/1.1', '200', '0', timing={'bad': object()})
+		log.request('localhost', 'GET /good HTTP/1.1', '200', '0')
+
+		log.flush()
+
+		assert 'ERROR: Failed to format log record:' in sys.stderr.getvalue()
+
+		with open(log.access_log.name) as log_file:
+			value = log_file.read()
+
+		assert '/bad' not in value
+		assert '/good' in value
+
+		#A failed write is reported and flush still returns
+		def fail(string):
+			raise OSError('No space left on device')
+
+		write, log.access_log.write = log.access_log.write, fail
+
+		log.request('localhost', 'GET /lost HTTP/1.1', '200', '0')
+		log.flush()
+
+		assert 'ERROR: Failed to write 1 access log records:' in sys.stderr.getvalue()
+		assert 'No space left on device' in sys.stderr.getvalue()
+
+		log.access_log.write = write
+
+		assert log.writer_thread.is_alive()
+	finally:
+		sys.stderr = stderr
+
+		log.close()
+
+@with_setup(setup_log, teardown_log)
+def test_async_close():
+	log = make_async_log()
+
+	log.close()
+
+	#Check that logging still works after closing
+	log.error(message)
+
+	with open(log.httpd_log.name) as log_file:
+		assert log_file.read().endswith('ERROR: ' + message + '\n')
+
+@with_setup(setup_log, teardown_log)
+def test_request_structured():
+	log = web.HTTPLog('tmp/httpd.log', 'tmp/access.log', structured=True)
+
+	log.request('localhost', 'GET / HTTP/1.1', '200', '1024', '-', '-', timing={'worker': 1, 'handler_time': 0.5})
+	with open(log.access_log.name) as log_file:
+		record = json.loads(log_file.read())
+
+	assert record['host'] == 'localhost'
+	assert record['request'] == 'GET / HTTP/1.1'
+	assert record['code'] == '200'
+	assert record['size'] == '1024'
+	assert record['worker'] == 1
+	assert record['handler_time'] == 0.5
+	assert abs(record['time'] - time.time()) < 60
+
+@with_setup(setup_log, teardown_log)
+def test_rotate_size():
+	log = web.HTTPLog('tmp/httpd.log', 'tmp/access.log', max_size=len(message) * 2)
+
+	for i in range(5):
+		log.access_write(message + '\n')
+
+		#Wait for any rotation to finish
+		if log.access_log.cleanup_thread:
+			log.access_log.cleanup_thread.join()
+
+	rotated = log.access_log.rotated()
+
+	assert len(rotated) == 2
+	for name in rotated:
+		with open(name) as log_file:
+			assert log_file.read() == (message + '\n') * 2
+
+	with open('tmp/access.log') as log_file:
+		assert log_file.read() == message + '\n'
+
+@with_setup(setup_log, teardown_log)
+def test_rotate_interval():
+	log = web.HTTPLog('tmp/httpd.log', 'tmp/access.log', rotate_interval=60)
+
+	log.write(message + '\n')
+
+	assert log.httpd_log.rotated() == []
+
+	#Pretend the file has been open for a while
+	log.httpd_log.opened -= 60
+
+	log.write(message + '\n')
+	log.httpd_log.cleanup_thread.join()
+
+	#The write that found the file too old still goes in it
+	rotated = log.httpd_log.rotated()
+
+	assert len(rotated) == 1
+
+	with open(rotated[0]) as log_file:
+		assert log_file.read() == (message + '\n') * 2
+
+	with open('tmp/httpd.log') as log_file:
+		assert log_file.read() == ''
+
+	#Empty files are not rotated
+	log = web.HTTPLog('tmp/other.log', None, rotate_interval=60)
+	log.httpd_log.opened -= 60
+
+	assert not log.httpd_log.should_rotate()
+
+@with_setup(setup_log, teardown_log)
+def test_rotate_compress_backups():
+	log = web.HTTPLog('tmp/httpd.log', 'tmp/access.log', max_size=1, backups=2, compress=True)
+
+	for i in range(5):
+		log.access_write(str(i) + '\n')
+		if log.access_log.cleanup_thread:
+			log.access_log.cleanup_thread.join()
+
+	rotated = log.access_log.rotated()
+
+	#Only the newest are kept and they are compressed
+	assert len(rotated) == 2
+	for i, name in enumerate(rotated):
+		assert name.endswith('.gz')
+		with gzip.open(name, 'rt') as log_file:
+			assert log_file.read() == str(i + 3) + '\n'
+
+@with_setup(setup_log, teardown_log)
+def test_rotate_background():
+	log = web.HTTPLog('tmp/httpd.log', 'tmp/access.log', max_size=1)
+
+	#Hold up the rotation to check that writers don't wait on it
+	proceed = threading.Event()
+	rotate_file = log.access_log.rotate_file
+	log.access_log.rotate_file = lambda: proceed.wait() and rotate_file()
+
+	log.access_write('0\n')
+
+	assert log.access_log.rotating
+
+	log.access_write('1\n')
+	log.access_write('2\n')
+
+	proceed.set()
+	log.access_log.cleanup_thread.join()
+
+	#Check that writes made during the rotation went to the rotated file and the new one is swapped in
+	rotated = log.access_log.rotated()
+
+	assert len(rotated) == 1
+	with open(rotated[0]) as log_file:
+		assert log_file.read() == '0\n1\n2\n'
+
+	log.access_write('3\n')
+	log.access_log.cleanup_thread.join()
+
+	assert len(log.access_log.rotated()) == 2
+
+@with_setup(setup_log, teardown_log)
+def test_reopen():
+	log = make_log()
+
+	log.message(message)
+
+	#Move the log away like an external rotation would
+	os.rename('tmp/httpd.log', 'tmp/httpd.log.old')
+
+	log.reopen()
+	log.message(message)
+
+	with open('tmp/httpd.log') as log_file:
+		assert log_file.read().endswith(message + '\n')
+
+	with open('tmp/httpd.log.old') as log_file:
+		assert log_file.read().count(message) == 1
+
+@with_setup(setup_log, teardown_log)
+def test_reopen_on_signal():
+	log = make_log()
+
+	old_handler = signal.getsignal(signal.SIGHUP)
+
+	try:
+		log.reopen_on_signal()
+
+		os.kill(os.getpid(), signal.SIGHUP)
+
+		assert log.httpd_log.reopen_requested
+		assert log.access_log.reopen_requested
+	finally:
+		signal.signal(signal.SIGHUP, old_handler)
@@ -0,0 +1,195 @@
+import threading
+
+from web import web, metrics
+
+import fake
+
+from http.client import HTTPConnection
+
+from nose.tools import nottest
+
+@nottest
+def test_request(resource='/', method='GET', route='/', count=1, body=None):
+	request = fake.FakeHTTPRequest(None, ('127.0.0.1', 1337), None, method=method, resource=resource, body=body)
+	request.route = route
+	request.count = count
+	request.bytes_in = 20
+
+	return request
+
+def test_inc():
+	registry = metrics.Metrics()
+
+	registry.inc('test_total')
+	registry.inc('test_total', value=2)
+	registry.inc('test_total', (('a', 'b'),))
+
+	totals = registry.collect()
+
+	assert totals.counters[('test_total', ())] == 3
+	assert totals.counters[('test_total', (('a', 'b'),))] == 1
+
+def test_shards():
+	registry = metrics.Metrics()
+
+	def count():
+		for i in range(100):
+			registry.inc('test_total')
+
+	threads = [threading.Thread(target=count) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	registry.inc('test_total')
+
+	#Check that each thread got its own shard and dead threads are folded together
+	assert registry.collect().counters[('test_total', ())] == 401
+	assert len(registry.shards) == 1
+	assert registry.retired.counters[('test_total', ())] == 400
+
+	#Check that retired counts are not lost or counted twice
+	assert registry.collect().counters[('test_total', ())] == 401
+
+def test_observe():
+	registry = metrics.Metrics(buckets=[ 0.1, 1 ])
+
+	registry.observe((('route', '/'),), 0.05)
+	registry.observe((('route', '/'),), 0.5)
+	registry.observe((('route', '/'),), 5)
+
+	histogram = registry.collect().histograms[(('route', '/'),)]
+
+	assert histogram[:3] == [ 1, 1, 1 ]
+	assert histogram[3] == 5.55
+
+def test_request_metrics():
+	registry = metrics.Metrics(buckets=[ 0.1, 1 ])
+
+	registry.request(test_request(), 200, 100, 0.05)
+	registry.request(test_request(count=2, method='PUT', body=b'abcd'), 204, 0, 0.5)
+	registry.request(test_request(route=None), 404, 10, 0.05)
+
+	text = registry.render()
+
+	assert 'http_requests_total{route="/",method="GET",code="200"} 1\n' in text
+	assert 'http_requests_total{route="/",method="PUT",code="204"} 1\n' in text
+	assert 'http_requests_total{route="",method="GET",code="404"} 1\n' in text
+
+	assert 'http_request_bytes_total 64\n' in text
+	assert 'http_response_bytes_total 110\n' in text
+	assert 'http_keepalive_reused_total 1\n' in text
+
+	assert 'http_request_duration_seconds_bucket{route="/",le="0.1"} 1\n' in text
+	assert 'http_request_duration_seconds_bucket{route="/",le="1"} 2\n' in text
+	assert 'http_request_duration_seconds_bucket{route="/",le="+Inf"} 2\n' in text
+	assert 'http_request_duration_seconds_count{route="/"} 2\n' in text
+	assert 'http_request_duration_seconds_count{route=""} 1\n' in text
+
+	assert '# TYPE http_request_duration_seconds histogram\n' in text
+
+def test_format_labels():
+	assert metrics.format_labels(()) == ''
+	assert metrics.format_labels((('a', 'b'), ('c', 1))) == '{a="b",c="1"}'
+	assert metrics.format_labels((('a', '"\\\n'),)) == '{a="\\"\\\\\\n"}'
+
+def test_handler():
+	server = fake.FakeHTTPServer(metrics=metrics.Metrics())
+
+	request = fake.FakeHTTPRequest(None, ('127.0.0.1', 1337), server, handler=metrics.MetricsHandler)
+
+	#The fake server has no workers yet
+	server.worker_threads = None
+
+	response = request.handler.respond()
+
+	assert response[0] == 200
+	assert request.response.headers.get('Content-Type') == metrics.metrics_content_type
+
+	assert 'http_request_queue_depth 0\n' in response[1]
+	assert 'http_workers 0\n' in response[1]
+	assert 'http_resource_lock_contended_total 0\n' in response[1]
+	assert 'http_slow_requests_total 0\n' in response[1]
+	assert 'http_stuck_workers 0\n' in response[1]
+	assert 'http_connections_accepted_total 0\n' in response[1]
+	assert 'http_accept_wakeups_total 0\n' in response[1]
+	assert 'http_accept_errors_total 0\n' in response[1]
+	assert 'http_open_connections 0\n' in response[1]
+	assert 'http_connections_evicted_total 0\n' in response[1]
+	assert 'http_connections_refused_total 0\n' in response[1]
+	assert 'http_slow_clients_total 0\n' in response[1]
+
+def test_handler_no_metrics():
+	server = fake.FakeHTTPServer()
+
+	request = fake.FakeHTTPRequest(None, ('127.0.0.1', 1337), server, handler=metrics.MetricsHandler)
+
+	try:
+		request.handler.respond()
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 404
+
+def test_reslock_contention():
+	res_lock = web.ResLock()
+
+	res_lock.acquire('/')
+
+	thread = threading.Thread(target=res_lock.acquire, args=('/',))
+	thread.start()
+
+	#Wait for the thread to be waiting
+	while res_lock.locks_count['/'] < 2:
+		pass
+
+	res_lock.release('/')
+	thread.join(timeout=1)
+	res_lock.release('/')
+
+	assert res_lock.contended == 1
+	assert res_lock.contended_time > 0
+
+	#Uncontended locks are not counted
+	res_lock.acquire('/')
+	res_lock.release('/')
+	res_lock.wait('/')
+
+	assert res_lock.contended == 1
+
+def test_integration():
+	class RootHandler(web.HTTPHandler):
+		def do_get(self):
+			return 200, 'test'
+
+	routes = { '/': RootHandler }
+	routes.update(metrics.new())
+
+	httpd = web.HTTPServer(('localhost', 0), routes, log=fake.FakeHTTPLog(None, None), metrics=metrics.Metrics())
+
+	httpd.start()
+
+	try:
+		conn = HTTPConnection('localhost', httpd.server_address[1])
+
+		conn.request('GET', '/')
+		response = conn.getresponse()
+		response.read()
+
+		conn.request('GET', '/nothere')
+		response = conn.getresponse()
+		response.read()
+
+		conn.request('GET', '/metrics')
+		response = conn.getresponse()
+		assert response.status == 200
+		text = response.read().decode('utf-8')
+
+		conn.close()
+	finally:
+		httpd.close()
+
+	assert 'http_requests_total{route="^/$",method="GET",code="200"} 1\n' in text
+	assert 'http_requests_total{route="",method="GET",code="404"} 1\n' in text
+	assert 'http_keepalive_reused_total 1\n' in text
+	assert 'http_workers ' + str(httpd.num_threads) + '\n' in text
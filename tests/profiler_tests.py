@@ -0,0 +1,226 @@
+import queue
+import threading
+import time
+
+from web import web, profiler
+
+import fake
+
+from nose.tools import nottest
+
+def busy_function(event):
+	event.wait()
+
+@nottest
+def test_thread(target, name='HTTPServer-Worker'):
+	event = threading.Event()
+
+	thread = threading.Thread(target=target, args=(event,), name=name)
+	thread.start()
+
+	return event, thread
+
+@nottest
+def test(method='GET', action=None, query_string=None, test_profiler=None):
+	if not test_profiler:
+		test_profiler = profiler.Profiler()
+
+	handler = list(profiler.new(test_profiler).values())[0]
+
+	request = fake.FakeHTTPRequest(None, ('127.0.0.1', 1337), None, method=method, groups=(action, query_string), handler=handler)
+
+	return request, request.handler.respond()
+
+def test_sample():
+	test_profiler = profiler.Profiler()
+
+	event, thread = test_thread(busy_function)
+
+	try:
+		#Wait for the thread to block in the function
+		time.sleep(0.05)
+
+		test_profiler.sample()
+		test_profiler.sample()
+	finally:
+		event.set()
+		thread.join()
+
+	collapsed = test_profiler.collapsed()
+
+	assert test_profiler.samples == 2
+
+	lines = [line for line in collapsed.splitlines() if 'busy_function (profiler_tests.py:' in line]
+	assert len(lines) == 1
+
+	#Stacks go from root to leaf and end with the sample count
+	stack, count = lines[0].rsplit(' ', 1)
+	frames = stack.split(';')
+	assert count == '2'
+	assert frames[0].startswith('_bootstrap (threading.py:')
+	assert frames[-1].startswith('wait (threading.py:')
+
+def test_sample_other_threads():
+	test_profiler = profiler.Profiler()
+
+	event, thread = test_thread(busy_function, name='Other')
+
+	try:
+		time.sleep(0.05)
+
+		test_profiler.sample()
+	finally:
+		event.set()
+		thread.join()
+
+	assert test_profiler.samples == 1
+	assert 'busy_function' not in test_profiler.collapsed()
+
+def test_idle():
+	test_queue = queue.Queue()
+
+	httpd = fake.FakeHTTPServer()
+	httpd.request_queue = test_queue
+
+	#Run the real worker loop which idles on the queue
+	httpd.worker_shutdown = None
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(httpd, 0), name='HTTPServer-Worker')
+	thread.start()
+
+	try:
+		time.sleep(0.05)
+
+		test_profiler = profiler.Profiler()
+		test_profiler.sample()
+
+		idle_profiler = profiler.Profiler(idle=True)
+		idle_profiler.sample()
+	finally:
+		httpd.worker_shutdown = -1
+		thread.join()
+
+	assert 'worker (web.py:' not in test_profiler.collapsed()
+	assert 'worker (web.py:' in idle_profiler.collapsed()
+
+def test_start_stop():
+	test_profiler = profiler.Profiler(interval=0.001)
+
+	event, thread = test_thread(busy_function)
+
+	try:
+		test_profiler.start()
+		assert test_profiler.is_running()
+		assert test_profiler.sampler_thread.name == 'Profiler-Sampler'
+
+		time.sleep(0.05)
+
+		test_profiler.stop()
+		assert not test_profiler.is_running()
+	finally:
+		event.set()
+		thread.join()
+
+	samples = test_profiler.samples
+
+	assert samples > 0
+	assert 'busy_function' in test_profiler.collapsed()
+
+	#No more samples after stopping
+	time.sleep(0.01)
+	assert test_profiler.samples == samples
+
+	test_profiler.clear()
+
+	assert test_profiler.samples == 0
+	assert test_profiler.collapsed() == ''
+
+def test_get():
+	test_profiler = profiler.Profiler()
+	test_profiler.stacks[(busy_function.__code__,)] = 3
+	test_profiler.samples = 3
+
+	request, response = test(test_profiler=test_profiler)
+
+	assert response[0] == 200
+	assert response[1] == 'busy_function (profiler_tests.py:' + str(busy_function.__code__.co_firstlineno) + ') 3\n'
+	assert request.response.headers.get('Content-Type') == profiler.collapsed_content_type
+	assert request.response.headers.get('X-Profiler-Samples') == '3'
+
+def test_get_seconds():
+	test_profiler = profiler.Profiler(interval=0.001)
+
+	event, thread = test_thread(busy_function)
+
+	try:
+		request, response = test(query_string='seconds=0.05', test_profiler=test_profiler)
+	finally:
+		event.set()
+		thread.join()
+
+	assert response[0] == 200
+	assert 'busy_function' in response[1]
+	assert not test_profiler.is_running()
+
+def test_get_bad_seconds():
+	for query_string in [ 'seconds=a', 'seconds=0', 'seconds=3600' ]:
+		try:
+			test(query_string=query_string)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == 400
+
+def test_get_seconds_running():
+	test_profiler = profiler.Profiler()
+	test_profiler.start()
+
+	try:
+		test(query_string='seconds=1', test_profiler=test_profiler)
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 409
+	finally:
+		test_profiler.stop()
+
+def test_get_action():
+	try:
+		test(action='start')
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 404
+
+def test_post():
+	test_profiler = profiler.Profiler()
+
+	request, response = test(method='POST', action='start', test_profiler=test_profiler)
+	assert response[0] == 204
+	assert test_profiler.is_running()
+
+	request, response = test(method='POST', action='stop', test_profiler=test_profiler)
+	assert response[0] == 204
+	assert not test_profiler.is_running()
+
+	test_profiler.samples = 1
+	request, response = test(method='POST', action='clear', test_profiler=test_profiler)
+	assert response[0] == 204
+	assert test_profiler.samples == 0
+
+	try:
+		test(method='POST', test_profiler=test_profiler)
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 404
+
+def test_new():
+	routes = profiler.new()
+
+	regex, handler = list(routes.items())[0]
+
+	assert isinstance(handler.profiler, profiler.Profiler)
+
+	server = fake.FakeHTTPServer(routes=routes)
+	match = list(server.routes.keys())[0].match
+
+	assert match('/profile').groups() == (None, None)
+	assert match('/profile?seconds=5').groups() == (None, 'seconds=5')
+	assert match('/profile/start').groups() == ('start', None)
+	assert not match('/profile/other')
@@ -1,3 +1,5 @@
+import socket
+
 from web import web
 
 import fake
@@ -7,14 +9,14 @@ from nose.tools import nottest
 test_request = 'GET / HTTP/1.1\r\n' + '\r\n'
 
 @nottest
-def test(request, handler=None, timeout=None, keepalive=True, initial_timeout=None, read_exception=False, close=True):
+def test(request, handler=None, timeout=None, keepalive=True, initial_timeout=None, read_exception=False, close=True, server_args={}):
 	if not isinstance(request, bytes):
 		request = request.encode(web.http_encoding)
 
 	if not handler:
 		handler = fake.FakeHTTPHandler
 
-	server = fake.FakeHTTPServer(routes={ '/': handler })
+	server = fake.FakeHTTPServer(routes={ '/': handler }, **server_args)
 
 	socket = fake.FakeSocket(request)
 
@@ -56,6 +58,9 @@ def test_no_request():
 	#If no request, do not keepalive
 	assert request.keepalive == False
 
+	#Nothing was received to be timed
+	assert request.received == None
+
 def test_request_too_large():
 	#Request for 'GET aaaaaaa... HTTP/1.1\r\n' where it's length is one over the maximum line size
 	long_request = 'GET ' + 'a' * (web.max_line_size - 4 - 9 - 2 + 1) + ' HTTP/1.1\r\n\r\n'
@@ -134,6 +139,32 @@ def test_no_keepalive():
 
 	assert request.keepalive == False
 
+def test_max_requests():
+	request = test(test_request, close=False, server_args={ 'max_requests': 2 })
+
+	assert request.count == 1
+	assert request.keepalive == True
+
+	#Check that the connection is closed after its last allowed request
+	request.rfile = fake.FakeSocket(test_request.encode(web.http_encoding)).makefile('rb')
+	request.handle()
+	request.close()
+
+	assert request.count == 2
+	assert request.keepalive == False
+
+def test_head_timeout():
+	request = test('GET / HTTP/1.1\r\n' + 'Host: localhost\r\n' + '\r\n', server_args={ 'head_timeout': 1 })
+
+	assert request.handler.__class__ == fake.FakeHTTPHandler
+	assert request.deadline == None
+
+	#Check that a head finished past its deadline is refused (a deadline already passed stands in for a slow client)
+	request = test('GET / HTTP/1.1\r\n' + 'Host: localhost\r\n' + '\r\n', server_args={ 'head_timeout': -1 })
+
+	assert request.handler.error.code == 408
+	assert request.keepalive == False
+
 def test_handler():
 	request = test(test_request, handler=web.HTTPHandler)
 
@@ -146,6 +177,42 @@ def test_read_pipelining():
 
 	request.close()
 
+def test_pipelined():
+	server = fake.FakeHTTPServer(routes={ '/': fake.FakeHTTPHandler })
+
+	#Use a real TCP connection since the request sets TCP options
+	listener = socket.socket()
+	listener.bind(('localhost', 0))
+	listener.listen(1)
+
+	client = socket.create_connection(listener.getsockname())
+	server_sock, client_address = listener.accept()
+	listener.close()
+
+	try:
+		request = web.HTTPRequest(server_sock, ('127.0.0.1', 1337), server, 1)
+		request.response = fake.FakeHTTPResponse(server_sock, ('127.0.0.1', 1337), server, request)
+
+		client.sendall((test_request + test_request).encode(web.http_encoding))
+
+		request.handle()
+		assert request.pipelined()
+
+		request.handle()
+		assert not request.pipelined()
+
+		#Check that the connection still works normally after looking
+		client.sendall(test_request.encode(web.http_encoding))
+
+		request.handle()
+		assert request.count == 3
+		assert request.keepalive
+
+		request.close()
+	finally:
+		server_sock.close()
+		client.close()
+
 def test_close():
 	request = test('GET / HTTP/1.1\r\n' + '\r\n')
 
@@ -1,4 +1,5 @@
 import io
+import json
 import threading
 import time
 
@@ -237,6 +238,199 @@ def test_response_length():
 
 	assert body == test_message
 
+def test_response_iterable():
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, [test_message, b'', test_string]
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert headers.get('Transfer-Encoding') == 'chunked'
+	assert headers.get('Content-Length') == None
+
+	#Each chunk is written as it comes and empty chunks are skipped
+	chunk = ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding)
+	assert body == chunk + chunk + '0\r\n\r\n'.encode(web.http_encoding)
+
+def test_response_generator():
+	closed = []
+
+	def generate():
+		try:
+			yield test_message
+			yield test_string
+		finally:
+			closed.append(True)
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, generate()
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert headers.get('Transfer-Encoding') == 'chunked'
+
+	chunk = ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding)
+	assert body == chunk + chunk + '0\r\n\r\n'.encode(web.http_encoding)
+
+	assert closed == [True]
+
+def test_response_async_generator():
+	closed = []
+
+	async def generate():
+		try:
+			yield test_message
+			yield test_string
+		finally:
+			closed.append(True)
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, generate()
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert headers.get('Transfer-Encoding') == 'chunked'
+
+	chunk = ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding)
+	assert body == chunk + chunk + '0\r\n\r\n'.encode(web.http_encoding)
+
+	assert closed == [True]
+
+def test_response_iterable_length():
+	def generate():
+		yield test_message
+		yield test_message
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			self.response.headers.set('Content-Length', str(len(test_message) + 2))
+
+			return 200, generate()
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert headers.get('Content-Length') == str(len(test_message) + 2)
+	assert headers.get('Transfer-Encoding') == None
+
+	assert body == test_message + test_message[0:2]
+
+def test_no_write_iterable():
+	closed = []
+
+	def generate():
+		try:
+			yield test_message
+		finally:
+			closed.append(True)
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			self.response.write_body = False
+
+			return 200, generate()
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert response_line == 'HTTP/1.1 200 OK'.encode(web.http_encoding)
+
+	assert body == b''
+
+	#Check that the generator is not run
+	assert closed == []
+
+def test_iterable_disconnect():
+	closed = []
+
+	def generate():
+		try:
+			while True:
+				yield test_message
+		finally:
+			closed.append(True)
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, generate()
+
+	class DisconnectFile(io.BytesIO):
+		def write(self, data):
+			#Let the head through and disconnect after a few chunks
+			if len(self.getvalue()) > 512:
+				raise ConnectionResetError()
+
+			return io.BytesIO.write(self, data)
+
+	class DisconnectSocket(fake.FakeSocket):
+		def makefile(self, mode='r', buffering=None):
+			return DisconnectFile()
+
+	server = fake.FakeHTTPServer()
+
+	response, response_line, headers, body = test(MyHandler, socket=DisconnectSocket(), server=server)
+
+	assert response_line == 'HTTP/1.1 200 OK'.encode(web.http_encoding)
+
+	#Check that the generator was closed and the connection will not be reused
+	assert closed == [True]
+	assert response.request.keepalive == False
+
+	assert 'ConnectionResetError' in server.log.httpd_log.getvalue()
+
+def test_iterable_error():
+	def generate():
+		yield test_message
+		raise Exception()
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, generate()
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert response_line == 'HTTP/1.1 200 OK'.encode(web.http_encoding)
+
+	#Check that the body is left unterminated so the client sees it was cut off
+	chunk = ('{:x}'.format(len(test_message)) + '\r\n').encode(web.http_encoding) + test_message + '\r\n'.encode(web.http_encoding)
+	assert body == chunk
+
+	assert response.request.keepalive == False
+
+def test_response_detach():
+	detached = []
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, web.Detach(detached.append)
+
+	response, response_line, headers, body = test(MyHandler)
+
+	assert response_line == 'HTTP/1.1 200 OK'.encode(web.http_encoding)
+	assert headers.get('Transfer-Encoding') == 'chunked'
+
+	#Check that only the head is written and the connection handed off
+	assert body == b''
+	assert detached == [response.request]
+	assert response.request.detached == True
+
+def test_response_detach_error():
+	def callback(request):
+		raise Exception()
+
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, web.Detach(callback)
+
+	server = fake.FakeHTTPServer()
+
+	response, response_line, headers, body = test(MyHandler, server=server)
+
+	assert response.request.detached == False
+	assert response.request.keepalive == False
+
+	assert 'Caught exception' in server.log.httpd_log.getvalue()
+
 def test_connection_close():
 	class MyHandler(web.HTTPHandler):
 		def respond(self):
@@ -311,3 +505,27 @@ def test_log_request():
 	assert body == test_message
 
 	assert server.log.access_log.getvalue() == '127.0.0.1 - - [01/Jan/1970:00:00:00 -0000] "GET / HTTP/1.1" 200 15\n'
+
+def test_log_request_structured():
+	class MyHandler(web.HTTPHandler):
+		def respond(self):
+			return 200, test_message
+
+	server = fake.FakeHTTPServer(log=fake.FakeHTTPLog(None, None, structured=True))
+
+	response, response_line, headers, body = test(MyHandler, server=server)
+
+	record = json.loads(server.log.access_log.getvalue())
+
+	assert record['host'] == '127.0.0.1'
+	assert record['request'] == 'GET / HTTP/1.1'
+	assert record['code'] == '200'
+	assert record['size'] == '15'
+
+	#Fake requests are never queued
+	assert record['worker'] == None
+	assert record['reused'] == False
+	assert record['queue_time'] == None
+
+	for stage in ['lock_time', 'handler_time', 'write_time']:
+		assert record[stage] >= 0
@@ -1,11 +1,22 @@
+import gc
 import os
 import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import time
 
 from web import web
 
 import fake
 
-from nose.tools import with_setup
+from nose.tools import nottest, with_setup
+
+class TestHandler(web.HTTPHandler):
+	def do_get(self):
+		return 200, 'test'
 
 def setup_server():
 	if os.path.exists('tmp'):
@@ -27,6 +38,234 @@ def test_ssl():
 	httpsd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', log=fake.FakeHTTPLog(None, None))
 
 	assert httpsd.using_ssl
+	assert httpsd.ssl_context.minimum_version == ssl.TLSVersion.TLSv1_2
+
+@nottest
+def test_ssl_client_context():
+	#The test certificate is self-signed
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	context.set_alpn_protocols(['h2', 'http/1.1'])
+
+	return context
+
+@nottest
+def test_ssl_client(httpsd, context, session=None, server_hostname=None):
+	client = context.wrap_socket(socket.create_connection(httpsd.server_address, timeout=2), session=session, server_hostname=server_hostname)
+	client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+	response = b''
+	while True:
+		data = client.recv(4096)
+		if not data:
+			break
+		response += data
+
+	return client, response
+
+@nottest
+def wait_for(condition, timeout=2):
+	end = time.monotonic() + timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+
+@nottest
+def read_response(client):
+	#Read a keepalive response (with a body of 'test') that may come in more than one record
+	response = b''
+	while not response.endswith(b'\r\n\r\ntest'):
+		data = client.recv(4096)
+		if not data:
+			break
+		response += data
+
+	return response
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_context():
+	context = web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key')
+
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, ssl_context=context, log=fake.FakeHTTPLog(None, None))
+	httpsd.start()
+
+	try:
+		client_context = test_ssl_client_context()
+
+		client, response = test_ssl_client(httpsd, client_context)
+
+		assert httpsd.ssl_context is context
+		assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+		assert response.endswith(b'\r\n\r\ntest')
+
+		#Only protocols the server speaks over TLS are offered
+		assert client.selected_alpn_protocol() == 'http/1.1'
+
+		#A second connection resumes the first session instead of doing a full handshake
+		session = client.session
+		client.close()
+
+		client, response = test_ssl_client(httpsd, client_context, session)
+
+		assert client.session_reused
+		assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+		assert context.session_stats()['hits'] >= 1
+
+		client.close()
+	finally:
+		httpsd.close()
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_reload():
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', log=fake.FakeHTTPLog(None, None))
+	httpsd.start()
+
+	try:
+		client_context = test_ssl_client_context()
+
+		old_context = httpsd.ssl_context
+
+		#Keep a connection open across the reload
+		client = client_context.wrap_socket(socket.create_connection(httpsd.server_address, timeout=2))
+		client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		assert read_response(client).endswith(b'\r\n\r\ntest')
+
+		#Reload from the files
+		httpsd.reload_ssl()
+
+		assert httpsd.ssl_context is not old_context
+
+		#Check that the open connection is left alone
+		client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		assert read_response(client).endswith(b'\r\n\r\ntest')
+		client.close()
+
+		#Check that new connections use the new context
+		new_client, response = test_ssl_client(httpsd, client_context)
+
+		assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+		assert old_context.session_stats()['accept'] == 1
+		assert httpsd.ssl_context.session_stats()['accept'] == 1
+
+		new_client.close()
+
+		#A context can also be given directly
+		context = web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key')
+		httpsd.reload_ssl(context)
+
+		assert httpsd.ssl_context is context
+	finally:
+		httpsd.close()
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_reload_failed():
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', log=fake.FakeHTTPLog(None, None))
+
+	old_context = httpsd.ssl_context
+
+	#Check that a missing file leaves the current context in place
+	httpsd.certfile = 'tests/ssl/missing.crt'
+
+	try:
+		httpsd.reload_ssl()
+		assert False
+	except OSError:
+		pass
+
+	assert httpsd.ssl_context is old_context
+
+	httpsd.server_close()
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_reload_on_signal():
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', log=fake.FakeHTTPLog(None, None))
+
+	old_context = httpsd.ssl_context
+	old_handler = signal.getsignal(signal.SIGUSR1)
+
+	try:
+		httpsd.reload_ssl_on_signal()
+
+		os.kill(os.getpid(), signal.SIGUSR1)
+
+		assert httpsd.ssl_context is not old_context
+	finally:
+		signal.signal(signal.SIGUSR1, old_handler)
+
+		httpsd.server_close()
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_sni():
+	example = web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key')
+	wildcard = web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key')
+
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', sni={ 'Example.com': example, '*.example.com': wildcard, 'files.example.com': ('tests/ssl/ssl.crt', 'tests/ssl/ssl.key') }, log=fake.FakeHTTPLog(None, None))
+	httpsd.start()
+
+	try:
+		client_context = test_ssl_client_context()
+
+		#Each host name gets its own context with the default for the rest
+		for server_hostname in ['example.com', 'www.example.com', 'files.example.com', 'other.com', None]:
+			client, response = test_ssl_client(httpsd, client_context, server_hostname=server_hostname)
+			assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+			client.close()
+
+		assert example.session_stats()['accept'] == 1
+		assert wildcard.session_stats()['accept'] == 1
+		assert httpsd.sni_contexts['files.example.com'].session_stats()['accept'] == 1
+		assert httpsd.ssl_context.session_stats()['accept'] == 2
+
+		#Reloading keeps the given contexts and reloads the files
+		files = httpsd.sni_contexts['files.example.com']
+		httpsd.reload_ssl()
+
+		assert httpsd.sni_contexts['example.com'] is example
+		assert httpsd.sni_contexts['files.example.com'] is not files
+	finally:
+		httpsd.close()
+
+@with_setup(setup_server, teardown_server)
+def test_ssl_handshake():
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', handshake_timeout=0.5, log=fake.FakeHTTPLog(None, None))
+	httpsd.start()
+
+	try:
+		#Connect without ever starting a handshake
+		stalled = socket.create_connection(httpsd.server_address, timeout=2)
+
+		#Check that other connections are still accepted and served
+		start = time.monotonic()
+		client, response = test_ssl_client(httpsd, test_ssl_client_context())
+
+		assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+		assert time.monotonic() - start < 0.5
+
+		client.close()
+
+		#Check that the stalled connection is closed after the handshake timeout
+		assert stalled.recv(4096) == b''
+		assert httpsd.handshake_failures == 1
+
+		stalled.close()
+	finally:
+		httpsd.close()
+
+def test_ssl_handshake_failures():
+	httpsd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keyfile='tests/ssl/ssl.key', certfile='tests/ssl/ssl.crt', handshake_timeout=0.5, num_threads=8, log=fake.FakeHTTPLog(None, None))
+	httpsd.start()
+
+	try:
+		#Stall handshakes on every worker at once so the failures are counted concurrently
+		stalled = [socket.create_connection(httpsd.server_address, timeout=2) for _ in range(8)]
+
+		for connection in stalled:
+			assert connection.recv(4096) == b''
+			connection.close()
+
+		assert httpsd.handshake_failures == 8
+	finally:
+		httpsd.close()
 
 @with_setup(setup_server, teardown_server)
 def test_start_stop_close():
@@ -81,3 +320,462 @@ def test_process_request():
 	httpd.process_request(fake.FakeSocket(), ('127.0.0.1', 1337))
 
 	assert httpd.request_queue.qsize() == 1
+
+def test_backlog_options():
+	httpd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, backlog=512, defer_accept=1, fastopen=16, recv_buffer=65536, send_buffer=65536, log=fake.FakeHTTPLog(None, None))
+
+	try:
+		assert httpd.request_queue_size == 512
+
+		#The kernel doubles buffer sizes for its own bookkeeping
+		assert httpd.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+		assert httpd.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+
+		if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+			assert httpd.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT)
+		if hasattr(socket, 'TCP_FASTOPEN'):
+			assert httpd.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN) == 16
+
+		#Check that the listening socket never blocks the accept loop
+		assert httpd.socket.gettimeout() == 0
+	finally:
+		httpd.server_close()
+
+def test_listen_option_unsupported():
+	log = fake.FakeHTTPLog(None, None)
+
+	httpd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, log=log)
+
+	try:
+		#Unknown options are skipped with a warning
+		httpd.set_listen_option('TCP_NOT_AN_OPTION', 1)
+
+		assert 'TCP_NOT_AN_OPTION is not supported' in log.httpd_log.getvalue()
+	finally:
+		httpd.server_close()
+
+def test_batch_accept():
+	httpd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, max_accept=4, log=fake.FakeHTTPLog(None, None))
+
+	clients = [socket.create_connection(httpd.server_address) for i in range(6)]
+
+	try:
+		#Each wakeup takes as many connections as allowed from the backlog
+		httpd.accept()
+
+		assert httpd.request_queue.qsize() == 4
+		assert httpd.accepted == 4
+
+		httpd.accept()
+
+		assert httpd.request_queue.qsize() == 6
+		assert httpd.accepted == 6
+		assert httpd.accept_wakeups == 2
+
+		#Nothing left to accept
+		httpd.accept()
+
+		assert httpd.accepted == 6
+		assert httpd.accept_wakeups == 3
+		assert httpd.accept_errors == 0
+
+		#Accepted connections block as usual
+		request, keepalive, initial_timeout = httpd.request_queue.get()
+		assert request.connection.getblocking()
+		request.connection.close()
+	finally:
+		while not httpd.request_queue.empty():
+			httpd.request_queue.get()[0].connection.close()
+
+		for client in clients:
+			client.close()
+
+		httpd.server_close()
+
+def test_batch_handle_request():
+	httpd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, max_accept=4, log=fake.FakeHTTPLog(None, None))
+	httpd.timeout = 0.1
+
+	clients = [socket.create_connection(httpd.server_address) for i in range(3)]
+
+	try:
+		#A single handle_request takes everything waiting
+		httpd.handle_request()
+
+		assert httpd.request_queue.qsize() == 3
+		assert httpd.accept_wakeups == 1
+
+		#Nothing waiting so it times out without accepting
+		httpd.handle_request()
+
+		assert httpd.accept_wakeups == 1
+	finally:
+		while not httpd.request_queue.empty():
+			httpd.request_queue.get()[0].connection.close()
+
+		for client in clients:
+			client.close()
+
+		httpd.server_close()
+
+def test_batch_serve_forever():
+	httpd = web.HTTPServer(('localhost', 0), { '/': fake.FakeHTTPHandler }, max_accept=4, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	try:
+		clients = [socket.create_connection(httpd.server_address) for i in range(6)]
+
+		#The running server accepts through the batch loop
+		start = time.monotonic()
+		while httpd.accepted < 6 and time.monotonic() - start < 2:
+			time.sleep(0.01)
+
+		assert httpd.accepted == 6
+		assert httpd.accept_wakeups <= 6
+
+		for client in clients:
+			client.close()
+	finally:
+		httpd.close()
+
+	#Stopping ends the accept loop
+	assert not httpd.is_running()
+
+class SlowHandler(web.HTTPHandler):
+	def do_get(self):
+		time.sleep(0.3)
+
+		return 200, 'test'
+
+@nottest
+def read_head(rfile):
+	head = []
+	while True:
+		line = rfile.readline()
+		if line in (b'\r\n', b''):
+			return head
+		head.append(line)
+
+def test_drain():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler, '/slow': SlowHandler }, keepalive=5, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	idle = socket.create_connection(httpd.server_address, timeout=2)
+	busy = socket.create_connection(httpd.server_address, timeout=2)
+
+	try:
+		#Leave one connection idle after a request
+		idle.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		idle_rfile = idle.makefile('rb')
+		assert b'Connection: close\r\n' not in read_head(idle_rfile)
+		assert idle_rfile.read(4) == b'test'
+
+		#And one in the middle of a request
+		busy.sendall(b'GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		busy_rfile = busy.makefile('rb')
+
+		wait_for(lambda: any(handler.received for handler in list(httpd.inflight.values())))
+
+		#Check that stopping doesn't wait out the keepalive timeout
+		start = time.monotonic()
+		httpd.stop()
+		assert time.monotonic() - start < 2
+
+		#Check that the idle connection was closed and the request in progress finished with Connection: close
+		assert idle_rfile.read() == b''
+
+		head = read_head(busy_rfile)
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+		assert b'Connection: close\r\n' in head
+		assert busy_rfile.read() == b'test'
+
+		assert not httpd.draining
+
+		idle_rfile.close()
+		busy_rfile.close()
+	finally:
+		idle.close()
+		busy.close()
+
+		httpd.close()
+
+def test_inherit():
+	listener = socket.socket()
+	listener.bind(('localhost', 0))
+	listener.listen()
+
+	#Take a copy of the socket like a new process would
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, fd=os.dup(listener.fileno()), log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	try:
+		assert httpd.server_address == listener.getsockname()
+
+		client = socket.create_connection(listener.getsockname(), timeout=2)
+		client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+		rfile = client.makefile('rb')
+		assert read_head(rfile)[0] == b'HTTP/1.1 200 OK\r\n'
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		listener.close()
+
+def test_listen_fds():
+	environ = os.environ.copy()
+
+	try:
+		os.environ.pop('WEB_LISTEN_FD', None)
+
+		#systemd only passes sockets to the process it names
+		os.environ['LISTEN_PID'] = str(os.getpid())
+		os.environ['LISTEN_FDS'] = '2'
+		os.environ['LISTEN_FDNAMES'] = 'http:https'
+		assert web.listen_fds() == [3, 4]
+
+		#The variables are consumed so children don't see them
+		assert 'LISTEN_PID' not in os.environ
+		assert 'LISTEN_FDS' not in os.environ
+		assert 'LISTEN_FDNAMES' not in os.environ
+		assert web.listen_fds() == []
+
+		os.environ['LISTEN_PID'] = str(os.getpid() + 1)
+		os.environ['LISTEN_FDS'] = '2'
+		assert web.listen_fds() == []
+		assert 'LISTEN_FDS' not in os.environ
+
+		os.environ['WEB_LISTEN_FD'] = '7'
+		assert web.listen_fds() == [7]
+		assert 'WEB_LISTEN_FD' not in os.environ
+	finally:
+		os.environ.clear()
+		os.environ.update(environ)
+
+def test_spawn():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, log=fake.FakeHTTPLog(None, None))
+
+	try:
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd()] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+
+		#Check that the new process gets the same listening socket
+		child = httpd.spawn([sys.executable, '-c', 'import socket, web; print(socket.socket(fileno=web.listen_fds()[0]).getsockname()[1])'], env=env, stdout=subprocess.PIPE)
+		output, error = child.communicate(timeout=10)
+
+		assert int(output) == httpd.server_address[1]
+	finally:
+		httpd.server_close()
+
+class EchoHandler(web.HTTPHandler):
+	def do_post(self):
+		return 200, self.request.body
+
+def test_head_timeout():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, head_timeout=0.3, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	client = socket.create_connection(httpd.server_address, timeout=2)
+
+	try:
+		#Trickle part of the head in, each piece well within the timeout for a single read, and never finish it
+		client.sendall(b'GET / HTTP/1.1\r\n')
+		for i in range(2):
+			time.sleep(0.1)
+			client.sendall(b'X-Slow: ' + str(i).encode(web.http_encoding) + b'\r\n')
+
+		rfile = client.makefile('rb')
+
+		#Check that the client was cut off with a 408 and the connection closed
+		head = read_head(rfile)
+		assert head[0] == b'HTTP/1.1 408 Request Timeout\r\n'
+		assert b'Connection: close\r\n' in head
+
+		rfile.read()
+		rfile.close()
+
+		assert httpd.slow_clients == 1
+	finally:
+		client.close()
+
+		httpd.close()
+
+def test_head_timeout_idle():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keepalive=5, head_timeout=0.2, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	client = socket.create_connection(httpd.server_address, timeout=2)
+
+	try:
+		rfile = client.makefile('rb')
+
+		client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+		head = read_head(rfile)
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+		assert rfile.read(4) == b'test'
+
+		#Check that a keepalive connection idle past the head timeout is not cut off since the deadline only starts with a request
+		time.sleep(0.5)
+
+		client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+		head = read_head(rfile)
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+		assert rfile.read(4) == b'test'
+
+		rfile.close()
+
+		assert httpd.slow_clients == 0
+	finally:
+		client.close()
+
+		httpd.close()
+
+def test_min_body_rate():
+	httpd = web.HTTPServer(('localhost', 0), { '/': EchoHandler }, timeout=None, min_body_rate=1000, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	client = socket.create_connection(httpd.server_address, timeout=2)
+
+	try:
+		#Check that a body sent fast enough is handled
+		client.sendall(b'POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\ntest')
+
+		rfile = client.makefile('rb')
+
+		head = read_head(rfile)
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+		assert rfile.read(4) == b'test'
+
+		#Check that one sent slower than the minimum rate is cut off (after 0.2s for the body) even with no read timeout
+		client.sendall(b'POST / HTTP/1.1\r\nContent-Length: 200\r\n\r\n')
+		for i in range(4):
+			time.sleep(0.05)
+			client.sendall(b'x')
+
+		head = read_head(rfile)
+		assert head[0] == b'HTTP/1.1 408 Request Timeout\r\n'
+		assert b'Connection: close\r\n' in head
+
+		rfile.read()
+		rfile.close()
+
+		assert httpd.slow_clients == 1
+	finally:
+		client.close()
+
+		httpd.close()
+
+@nottest
+def most_recently_idle(httpd, port):
+	with httpd.connections_lock:
+		handlers = list(httpd.connections.values())
+
+	return bool(handlers) and handlers[-1].idle and handlers[-1].client_address[1] == port
+
+def test_max_connections_per_ip():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, keepalive=5, max_connections_per_ip=2, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	clients = []
+
+	try:
+		#Leave two connections idle after a request, the first least recently used
+		for i in range(2):
+			client = socket.create_connection(httpd.server_address, timeout=2)
+			clients.append(client)
+
+			client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+			assert read_response(client).endswith(b'\r\n\r\ntest')
+
+			#Workers mark connections idle after responding so wait for this one to be most recently idle before going on
+			port = client.getsockname()[1]
+			wait_for(lambda: most_recently_idle(httpd, port))
+			assert most_recently_idle(httpd, port)
+
+		#Check that another connection evicts the least recently used idle one
+		client = socket.create_connection(httpd.server_address, timeout=2)
+		clients.append(client)
+
+		assert clients[0].recv(4096) == b''
+
+		client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		assert read_response(client).endswith(b'\r\n\r\ntest')
+
+		clients[1].sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		assert read_response(clients[1]).endswith(b'\r\n\r\ntest')
+
+		assert httpd.evicted == 1
+		assert httpd.refused == 0
+
+		wait_for(lambda: len(httpd.connections) == 2)
+		assert httpd.connections_per_ip == { '127.0.0.1': 2 }
+	finally:
+		for client in clients:
+			client.close()
+
+		httpd.close()
+
+def test_refused_closed():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, max_connections=1, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	busy = socket.create_connection(httpd.server_address, timeout=2)
+
+	#Only collect garbage by hand so nothing but closing releases a refused connection
+	gc.disable()
+
+	try:
+		wait_for(lambda: len(httpd.connections) == 1)
+
+		fds = len(os.listdir('/proc/self/fd'))
+
+		#Check that each refused connection gives back its descriptor right away
+		for i in range(20):
+			client = socket.create_connection(httpd.server_address, timeout=2)
+			try:
+				assert client.recv(4096) == b''
+			finally:
+				client.close()
+
+		#The client sees the shutdown just before the server closes so give the last one a moment
+		wait_for(lambda: len(os.listdir('/proc/self/fd')) <= fds)
+
+		assert httpd.refused == 20
+		assert len(os.listdir('/proc/self/fd')) <= fds
+	finally:
+		gc.enable()
+
+		busy.close()
+
+		httpd.close()
+
+def test_max_connections():
+	httpd = web.HTTPServer(('localhost', 0), { '/': TestHandler }, max_connections=1, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	busy = socket.create_connection(httpd.server_address, timeout=2)
+
+	try:
+		wait_for(lambda: len(httpd.connections) == 1)
+
+		#Check that a connection is refused when none open are idle to make room
+		client = socket.create_connection(httpd.server_address, timeout=2)
+		try:
+			assert client.recv(4096) == b''
+		finally:
+			client.close()
+
+		assert httpd.refused == 1
+		assert httpd.evicted == 0
+
+		#Check that the open connection is still served and stops counting when closed
+		busy.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+		assert read_response(busy).endswith(b'\r\n\r\ntest')
+
+		wait_for(lambda: len(httpd.connections) == 0)
+		assert httpd.connections == {}
+		assert httpd.connections_per_ip == {}
+	finally:
+		busy.close()
+
+		httpd.close()
@@ -0,0 +1,267 @@
+import socket
+import ssl
+import time
+
+from web import web, sse
+
+import fake
+
+from nose.tools import nottest
+
+@nottest
+def test_server(broadcaster, ssl_context=None):
+	httpd = web.HTTPServer(('localhost', 0), sse.new(broadcaster), ssl_context=ssl_context, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	return httpd
+
+@nottest
+def test_client(httpd, topic='test', ssl_context=None):
+	client = socket.create_connection(httpd.server_address)
+	client.settimeout(2)
+
+	if ssl_context:
+		client = ssl_context.wrap_socket(client)
+
+	client.sendall(('GET /events/' + topic + ' HTTP/1.1\r\nHost: localhost\r\n\r\n').encode(web.http_encoding))
+
+	rfile = client.makefile('rb')
+
+	#Read the head
+	head = []
+	while True:
+		line = rfile.readline()
+		if line == b'\r\n':
+			break
+		head.append(line)
+
+	return client, rfile, head
+
+@nottest
+def read_chunk(rfile):
+	size = int(rfile.readline(), 16)
+	chunk = rfile.read(size)
+	rfile.readline()
+
+	return chunk
+
+@nottest
+def wait_for(condition, timeout=2):
+	end = time.monotonic() + timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+
+def test_format_event():
+	assert sse.format_event('test') == 'data: test\n\n'
+	assert sse.format_event('a\nb', event='update', id=1, retry=1000) == 'id: 1\nevent: update\nretry: 1000\ndata: a\ndata: b\n\n'
+
+def test_format_chunk():
+	assert sse.format_chunk(b'data: test\n\n') == b'c\r\ndata: test\n\n\r\n'
+	assert sse.format_chunk(b'') == b'0\r\n\r\n'
+
+def test_not_running():
+	broadcaster = sse.Broadcaster()
+
+	httpd = test_server(broadcaster)
+
+	try:
+		#Check that a stopped broadcaster refuses the subscription instead of taking the connection and never closing it
+		client, rfile, head = test_client(httpd)
+
+		assert head[0].startswith(b'HTTP/1.1 503 ')
+
+		#The server keeps the connection (detached ones are untracked) and closes it once the client is done
+		assert len(httpd.connections) == 1
+		assert broadcaster.subscribers == 0
+
+		rfile.close()
+		client.close()
+
+		wait_for(lambda: httpd.connections == {})
+		assert httpd.connections == {}
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+def test_subscribe_publish():
+	broadcaster = sse.Broadcaster()
+	broadcaster.start()
+
+	httpd = test_server(broadcaster)
+
+	try:
+		client, rfile, head = test_client(httpd)
+		other, other_rfile, other_head = test_client(httpd, 'other')
+
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+		assert b'Content-Type: text/event-stream\r\n' in head
+		assert b'Transfer-Encoding: chunked\r\n' in head
+
+		wait_for(lambda: broadcaster.subscribers == 2)
+		assert broadcaster.subscribers == 2
+
+		#Check that subscribers don't hold worker threads
+		wait_for(lambda: httpd.inflight == {})
+		assert httpd.inflight == {}
+
+		broadcaster.publish('test', 'hello', event='greeting')
+		broadcaster.publish('other', 'other')
+
+		assert read_chunk(rfile) == b'event: greeting\ndata: hello\n\n'
+		assert read_chunk(other_rfile) == b'data: other\n\n'
+
+		rfile.close()
+		client.close()
+		other_rfile.close()
+		other.close()
+
+		#Check that disconnected subscribers are removed
+		wait_for(lambda: broadcaster.subscribers == 0)
+		assert broadcaster.subscribers == 0
+		assert broadcaster.topics == {}
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+def test_fan_out():
+	broadcaster = sse.Broadcaster()
+	broadcaster.start()
+
+	httpd = test_server(broadcaster)
+
+	try:
+		clients = [test_client(httpd) for i in range(10)]
+
+		wait_for(lambda: broadcaster.subscribers == 10)
+
+		broadcaster.publish('test', 'all')
+
+		for client, rfile, head in clients:
+			assert read_chunk(rfile) == b'data: all\n\n'
+			rfile.close()
+			client.close()
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+def test_tls():
+	broadcaster = sse.Broadcaster(max_pending=16777216)
+	broadcaster.start()
+
+	httpd = test_server(broadcaster, web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key'))
+
+	#The test certificate is self-signed
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+
+	try:
+		client, rfile, head = test_client(httpd, ssl_context=context)
+
+		assert head[0] == b'HTTP/1.1 200 OK\r\n'
+
+		wait_for(lambda: broadcaster.subscribers == 1)
+
+		#Publish more than the socket buffers hold before reading so sends only partly go through
+		data = 'a' * 16384
+		for i in range(256):
+			broadcaster.publish('test', data, id=i)
+
+		#Check that the subscriber is kept and gets everything
+		for i in range(256):
+			assert read_chunk(rfile) == ('id: ' + str(i) + '\ndata: ' + data + '\n\n').encode('utf-8')
+
+		assert broadcaster.subscribers == 1
+		assert broadcaster.dropped == 0
+
+		rfile.close()
+		client.close()
+
+		#Check that a disconnected TLS subscriber is still removed
+		wait_for(lambda: broadcaster.subscribers == 0)
+		assert broadcaster.subscribers == 0
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+def test_heartbeat():
+	broadcaster = sse.Broadcaster(heartbeat=0.1)
+	broadcaster.start()
+
+	httpd = test_server(broadcaster)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		assert read_chunk(rfile) == b':\n\n'
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+def test_slow_consumer():
+	broadcaster = sse.Broadcaster(max_pending=65536)
+	broadcaster.start()
+
+	server_sock, client = socket.socketpair()
+
+	try:
+		request = fake.FakeHTTPRequest(server_sock, ('127.0.0.1', 1337), None)
+		broadcaster.subscribe(request, 'test')
+
+		wait_for(lambda: broadcaster.subscribers == 1)
+
+		#Never read so the socket buffer and then the pending buffer fill up
+		data = 'a' * 16384
+		for i in range(1024):
+			broadcaster.publish('test', data)
+
+			if broadcaster.dropped:
+				break
+
+			time.sleep(0.001)
+
+		wait_for(lambda: broadcaster.dropped == 1)
+
+		assert broadcaster.dropped == 1
+		assert broadcaster.subscribers == 0
+	finally:
+		client.close()
+		broadcaster.close()
+
+def test_close():
+	broadcaster = sse.Broadcaster()
+	broadcaster.start()
+
+	httpd = test_server(broadcaster)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		wait_for(lambda: broadcaster.subscribers == 1)
+	finally:
+		httpd.close()
+		broadcaster.close()
+
+	#Check that the stream is ended cleanly
+	assert read_chunk(rfile) == b''
+	assert rfile.read() == b''
+
+	assert not broadcaster.is_running()
+	assert broadcaster.subscribers == 0
+
+	rfile.close()
+	client.close()
+
+def test_head():
+	broadcaster = sse.Broadcaster()
+
+	request = fake.FakeHTTPRequest(fake.FakeSocket(), ('127.0.0.1', 1337), fake.FakeHTTPServer(), method='HEAD', groups=('test',), handler=list(sse.new(broadcaster).values())[0], response=web.HTTPResponse)
+
+	request.response.handle()
+
+	#Check that the connection is not handed off without a body to write
+	assert request.detached == False
+	assert len(broadcaster.incoming) == 0
@@ -0,0 +1,601 @@
+import os
+import socket
+import ssl
+import time
+import zlib
+
+from web import web, websocket
+
+import fake
+
+from nose.tools import nottest
+
+test_key = 'dGhlIHNhbXBsZSBub25jZQ=='
+
+class EchoHandler(websocket.WebSocketHandler):
+	max_message_size = 65536
+
+	subprotocols = ['chat']
+
+	events = []
+
+	def on_open(self):
+		self.events.append(('open',))
+
+	def on_message(self, message):
+		if message == 'close':
+			self.close(websocket.close_normal, 'bye')
+		elif message == 'error':
+			raise Exception('test')
+		else:
+			self.send(message)
+
+	def on_pong(self, data):
+		self.events.append(('pong', data))
+
+	def on_close(self, code, reason):
+		self.events.append(('close', code, reason))
+
+@nottest
+def test_server(multiplexer, ssl_context=None):
+	EchoHandler.events = []
+
+	httpd = web.HTTPServer(('localhost', 0), websocket.new(multiplexer, '/ws', EchoHandler), ssl_context=ssl_context, log=fake.FakeHTTPLog(None, None))
+	httpd.start()
+
+	return httpd
+
+@nottest
+def test_client(httpd, headers='', ssl_context=None):
+	client = socket.create_connection(httpd.server_address)
+	client.settimeout(2)
+
+	if ssl_context:
+		client = ssl_context.wrap_socket(client)
+
+	client.sendall(('GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: ' + test_key + '\r\nSec-WebSocket-Version: 13\r\n' + headers + '\r\n').encode(web.http_encoding))
+
+	rfile = client.makefile('rb')
+
+	#Read the head
+	head = []
+	while True:
+		line = rfile.readline()
+		if line == b'\r\n':
+			break
+		head.append(line)
+
+	return client, rfile, head
+
+@nottest
+def client_frame(opcode, payload, fin=True, rsv1=False):
+	#Build a frame the way a client must, masked
+	key = os.urandom(4)
+	frame = websocket.build_frame(opcode, websocket.mask(payload, key), fin, rsv1)
+
+	#Set the mask bit and put the key between the header and the payload
+	header_length = len(frame) - len(payload)
+
+	return bytes([frame[0], frame[1] | 0x80]) + frame[2:header_length] + key + frame[header_length:]
+
+@nottest
+def read_frame(rfile):
+	head = rfile.read(2)
+
+	length = head[1] & 0x7f
+	if length == 126:
+		length = int.from_bytes(rfile.read(2), 'big')
+	elif length == 127:
+		length = int.from_bytes(rfile.read(8), 'big')
+
+	return bool(head[0] & 0x80), bool(head[0] & 0x40), head[0] & 0x0f, rfile.read(length)
+
+@nottest
+def wait_for(condition, timeout=2):
+	end = time.monotonic() + timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+
+@nottest
+def test_handshake(headers):
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	try:
+		request = fake.FakeHTTPRequest(None, ('127.0.0.1', 1337), None, headers=headers, handler=list(websocket.new(multiplexer, '/ws', EchoHandler).values())[0])
+
+		return request, request.handler.respond()
+	finally:
+		multiplexer.close()
+
+def test_accept_key():
+	#Example from RFC 6455
+	assert websocket.accept_key(test_key) == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+def test_mask():
+	key = b'\x37\xfa\x21\x3d'
+
+	#Example from RFC 6455
+	assert websocket.mask(b'Hello', key) == b'\x7f\x9f\x4d\x51\x58'
+	assert websocket.mask(websocket.mask(b'Hello', key), key) == b'Hello'
+	assert websocket.mask(b'', key) == b''
+
+def test_build_frame():
+	assert websocket.build_frame(websocket.opcode_text, b'Hello') == b'\x81\x05Hello'
+	assert websocket.build_frame(websocket.opcode_text, b'Hel', fin=False) == b'\x01\x03Hel'
+	assert websocket.build_frame(websocket.opcode_binary, b'a' * 256)[:4] == b'\x82\x7e\x01\x00'
+	assert websocket.build_frame(websocket.opcode_binary, b'a' * 65536)[:10] == b'\x82\x7f\x00\x00\x00\x00\x00\x01\x00\x00'
+	assert websocket.build_frame(websocket.opcode_text, b'', rsv1=True) == b'\xc1\x00'
+
+def test_parse_frame():
+	#Example from RFC 6455
+	frame = b'\x81\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58'
+
+	assert websocket.parse_frame(frame) == (True, False, websocket.opcode_text, b'Hello', len(frame))
+	assert websocket.parse_frame(frame + b'\x81') == (True, False, websocket.opcode_text, b'Hello', len(frame))
+
+	#Incomplete frames
+	for length in range(len(frame)):
+		assert websocket.parse_frame(frame[:length]) is None
+
+	frame = client_frame(websocket.opcode_binary, b'a' * 70000)
+	assert websocket.parse_frame(frame) == (True, False, websocket.opcode_binary, b'a' * 70000, len(frame))
+	assert websocket.parse_frame(frame[:9]) is None
+
+def test_parse_frame_errors():
+	tests = [
+		#Unmasked
+		(b'\x81\x05Hello', websocket.close_protocol_error),
+		#Reserved bits
+		(b'\xa1' + client_frame(websocket.opcode_text, b'Hello')[1:], websocket.close_protocol_error),
+		#Unknown opcode
+		(client_frame(0x3, b''), websocket.close_protocol_error),
+		#Fragmented control frame
+		(client_frame(websocket.opcode_ping, b'', fin=False), websocket.close_protocol_error),
+		#Long control frame
+		(client_frame(websocket.opcode_ping, b'a' * 126), websocket.close_protocol_error),
+	]
+
+	for frame, code in tests:
+		try:
+			websocket.parse_frame(frame)
+			assert False
+		except websocket.WebSocketError as error:
+			assert error.code == code
+
+	#Too big is known from the header alone
+	try:
+		websocket.parse_frame(client_frame(websocket.opcode_binary, b'a' * 1024)[:8], 1000)
+		assert False
+	except websocket.WebSocketError as error:
+		assert error.code == websocket.close_too_big
+
+def test_parse_extensions():
+	assert websocket.parse_extensions('') == []
+	assert websocket.parse_extensions('permessage-deflate; client_max_window_bits, x-webkit-deflate-frame') == [('permessage-deflate', {'client_max_window_bits': None}), ('x-webkit-deflate-frame', {})]
+	assert websocket.parse_extensions('permessage-deflate; server_max_window_bits="10"') == [('permessage-deflate', {'server_max_window_bits': '10'})]
+
+def test_handshake_accept():
+	request, response = test_handshake({'Upgrade': 'websocket', 'Connection': 'keep-alive, Upgrade', 'Sec-WebSocket-Key': test_key, 'Sec-WebSocket-Version': '13', 'Sec-WebSocket-Protocol': 'other, chat', 'Sec-WebSocket-Extensions': 'permessage-deflate; client_max_window_bits'})
+
+	assert response[0] == 101
+	assert isinstance(response[1], web.Detach)
+
+	assert request.response.headers.get('Upgrade') == 'websocket'
+	assert request.response.headers.get('Connection') == 'Upgrade'
+	assert request.response.headers.get('Sec-WebSocket-Accept') == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+	assert request.response.headers.get('Sec-WebSocket-Protocol') == 'chat'
+	assert request.response.headers.get('Sec-WebSocket-Extensions') == 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+
+def test_handshake_no_extensions():
+	request, response = test_handshake({'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Key': test_key, 'Sec-WebSocket-Version': '13', 'Sec-WebSocket-Extensions': 'permessage-deflate; server_max_window_bits=10'})
+
+	assert response[0] == 101
+
+	assert request.response.headers.get('Sec-WebSocket-Protocol') is None
+	assert request.response.headers.get('Sec-WebSocket-Extensions') is None
+
+def test_handshake_bad_request():
+	for headers in [{}, {'Upgrade': 'websocket', 'Sec-WebSocket-Key': test_key, 'Sec-WebSocket-Version': '13'}, {'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Version': '13'}, {'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Key': 'short', 'Sec-WebSocket-Version': '13'}]:
+		try:
+			test_handshake(headers)
+			assert False
+		except web.HTTPError as error:
+			assert error.code == 400
+
+def test_handshake_bad_version():
+	try:
+		test_handshake({'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Key': test_key, 'Sec-WebSocket-Version': '8'})
+		assert False
+	except web.HTTPError as error:
+		assert error.code == 426
+		assert error.headers.get('Sec-WebSocket-Version') == '13'
+
+def test_not_running():
+	multiplexer = websocket.Multiplexer()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		#Check that a stopped multiplexer refuses the upgrade instead of taking the connection and never closing it
+		client, rfile, head = test_client(httpd)
+
+		assert head[0].startswith(b'HTTP/1.1 503 ')
+
+		#The server keeps the connection (detached ones are untracked) and closes it once the client is done
+		assert len(httpd.connections) == 1
+		assert multiplexer.handlers == set()
+
+		rfile.close()
+		client.close()
+
+		wait_for(lambda: httpd.connections == {})
+		assert httpd.connections == {}
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_echo():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		assert head[0] == b'HTTP/1.1 101 Switching Protocols\r\n'
+		assert b'Upgrade: websocket\r\n' in head
+		assert b'Connection: Upgrade\r\n' in head
+		assert b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n' in head
+		assert not any(line.startswith(b'Transfer-Encoding') or line.startswith(b'Content-Length') for line in head)
+
+		client.sendall(client_frame(websocket.opcode_text, 'héllo'.encode('utf-8')))
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, 'héllo'.encode('utf-8'))
+
+		client.sendall(client_frame(websocket.opcode_binary, b'\x00\x01'))
+		assert read_frame(rfile) == (True, False, websocket.opcode_binary, b'\x00\x01')
+
+		#Check that connections don't hold worker threads
+		wait_for(lambda: httpd.inflight == {})
+		assert httpd.inflight == {}
+		assert len(multiplexer.handlers) == 1
+		assert EchoHandler.events == [('open',)]
+
+		rfile.close()
+		client.close()
+
+		wait_for(lambda: EchoHandler.events[-1][0] == 'close')
+		assert not multiplexer.handlers
+		assert EchoHandler.events[-1] == ('close', websocket.close_abnormal, '')
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_tls():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer, web.make_ssl_context('tests/ssl/ssl.crt', 'tests/ssl/ssl.key'))
+
+	#The test certificate is self-signed
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+
+	try:
+		client, rfile, head = test_client(httpd, ssl_context=context)
+
+		assert head[0] == b'HTTP/1.1 101 Switching Protocols\r\n'
+
+		client.sendall(client_frame(websocket.opcode_text, b'hello'))
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'hello')
+
+		#Check that several frames in one go (decrypted together) and large ones are all handled
+		client.sendall(client_frame(websocket.opcode_text, b'one') + client_frame(websocket.opcode_text, b'two'))
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'one')
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'two')
+
+		data = os.urandom(60000)
+		client.sendall(client_frame(websocket.opcode_binary, data))
+		assert read_frame(rfile) == (True, False, websocket.opcode_binary, data)
+
+		assert EchoHandler.events == [('open',)]
+
+		rfile.close()
+		client.close()
+
+		wait_for(lambda: not multiplexer.handlers)
+		assert EchoHandler.events[-1] == ('close', websocket.close_abnormal, '')
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_leftover():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		#Send a frame along with the handshake before seeing the response
+		client = socket.create_connection(httpd.server_address)
+		client.settimeout(2)
+		client.sendall(('GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: ' + test_key + '\r\nSec-WebSocket-Version: 13\r\n\r\n').encode(web.http_encoding) + client_frame(websocket.opcode_text, b'early'))
+
+		rfile = client.makefile('rb')
+		while rfile.readline() != b'\r\n':
+			pass
+
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'early')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_fragmented():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		#Control frames can come between fragments
+		client.sendall(client_frame(websocket.opcode_text, b'Hel', fin=False) + client_frame(websocket.opcode_ping, b'ping') + client_frame(websocket.opcode_continuation, b'lo', fin=False) + client_frame(websocket.opcode_continuation, b'!'))
+
+		assert read_frame(rfile) == (True, False, websocket.opcode_pong, b'ping')
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'Hello!')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_ping_pong():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		wait_for(lambda: multiplexer.handlers)
+		handler = list(multiplexer.handlers)[0]
+
+		handler.ping(b'test')
+		assert read_frame(rfile) == (True, False, websocket.opcode_ping, b'test')
+
+		client.sendall(client_frame(websocket.opcode_pong, b'test'))
+
+		wait_for(lambda: ('pong', b'test') in EchoHandler.events)
+		assert ('pong', b'test') in EchoHandler.events
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_deflate():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd, 'Sec-WebSocket-Extensions: permessage-deflate\r\n')
+
+		assert b'Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover; client_no_context_takeover\r\n' in head
+
+		message = b'compress me ' * 100
+
+		compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+		payload = (compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+		client.sendall(client_frame(websocket.opcode_text, payload, rsv1=True))
+
+		fin, rsv1, opcode, echoed = read_frame(rfile)
+
+		assert rsv1
+		assert opcode == websocket.opcode_text
+		assert len(echoed) < len(message)
+		assert zlib.decompressobj(-zlib.MAX_WBITS).decompress(echoed + b'\x00\x00\xff\xff') == message
+
+		#Short messages are not worth compressing
+		client.sendall(client_frame(websocket.opcode_text, b'short'))
+		assert read_frame(rfile) == (True, False, websocket.opcode_text, b'short')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_deflate_not_negotiated():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		client.sendall(client_frame(websocket.opcode_text, b'\x01\x00\x00\xff\xff', rsv1=True))
+
+		fin, rsv1, opcode, payload = read_frame(rfile)
+		assert opcode == websocket.opcode_close
+		assert int.from_bytes(payload[:2], 'big') == websocket.close_protocol_error
+
+		assert rfile.read() == b''
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_client_close():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		client.sendall(client_frame(websocket.opcode_close, websocket.close_going_away.to_bytes(2, 'big') + b'leaving'))
+
+		#Check that the close is echoed and the connection closed
+		assert read_frame(rfile) == (True, False, websocket.opcode_close, websocket.close_going_away.to_bytes(2, 'big'))
+		assert rfile.read() == b''
+
+		wait_for(lambda: EchoHandler.events[-1][0] == 'close')
+		assert EchoHandler.events[-1] == ('close', websocket.close_going_away, 'leaving')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_server_close():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		client.sendall(client_frame(websocket.opcode_text, b'close'))
+
+		assert read_frame(rfile) == (True, False, websocket.opcode_close, websocket.close_normal.to_bytes(2, 'big') + b'bye')
+
+		#Connection stays open until the close is answered
+		assert len(multiplexer.handlers) == 1
+
+		client.sendall(client_frame(websocket.opcode_close, websocket.close_normal.to_bytes(2, 'big')))
+		assert rfile.read() == b''
+
+		wait_for(lambda: EchoHandler.events[-1][0] == 'close')
+		assert EchoHandler.events[-1] == ('close', websocket.close_normal, '')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_close_timeout():
+	multiplexer = websocket.Multiplexer(close_timeout=0.1)
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		client.sendall(client_frame(websocket.opcode_text, b'close'))
+		assert read_frame(rfile)[2] == websocket.opcode_close
+
+		#Never answer the close
+		assert rfile.read() == b''
+
+		wait_for(lambda: EchoHandler.events[-1][0] == 'close')
+		assert EchoHandler.events[-1] == ('close', websocket.close_abnormal, 'Close timed out')
+
+		rfile.close()
+		client.close()
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_errors():
+	tests = [
+		#Invalid UTF-8
+		(client_frame(websocket.opcode_text, b'\xff'), websocket.close_invalid_data),
+		#Continuation without a start
+		(client_frame(websocket.opcode_continuation, b'a'), websocket.close_protocol_error),
+		#New message in the middle of a fragmented one
+		(client_frame(websocket.opcode_text, b'a', fin=False) + client_frame(websocket.opcode_text, b'b'), websocket.close_protocol_error),
+		#Unmasked
+		(websocket.build_frame(websocket.opcode_text, b'a'), websocket.close_protocol_error),
+		#Too big
+		(client_frame(websocket.opcode_binary, b'a' * 65537), websocket.close_too_big),
+		#Too big when put together
+		(client_frame(websocket.opcode_binary, b'a' * 40000, fin=False) + client_frame(websocket.opcode_continuation, b'a' * 40000), websocket.close_too_big),
+		#Bad close code
+		(client_frame(websocket.opcode_close, (1005).to_bytes(2, 'big')), websocket.close_protocol_error),
+		#Error in a callback
+		(client_frame(websocket.opcode_text, b'error'), websocket.close_internal_error),
+	]
+
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		for frame, code in tests:
+			client, rfile, head = test_client(httpd)
+
+			client.sendall(frame)
+
+			fin, rsv1, opcode, payload = read_frame(rfile)
+			assert opcode == websocket.opcode_close
+			assert int.from_bytes(payload[:2], 'big') == code
+
+			assert rfile.read() == b''
+
+			rfile.close()
+			client.close()
+
+		wait_for(lambda: not multiplexer.handlers)
+		assert not multiplexer.handlers
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+def test_shutdown():
+	multiplexer = websocket.Multiplexer()
+	multiplexer.start()
+
+	httpd = test_server(multiplexer)
+
+	try:
+		client, rfile, head = test_client(httpd)
+
+		wait_for(lambda: multiplexer.handlers)
+	finally:
+		httpd.close()
+		multiplexer.close()
+
+	#Check that connections are told the server is going away
+	assert read_frame(rfile) == (True, False, websocket.opcode_close, websocket.close_going_away.to_bytes(2, 'big'))
+	assert rfile.read() == b''
+
+	assert not multiplexer.is_running()
+	assert EchoHandler.events[-1] == ('close', websocket.close_going_away, 'Server shutting down')
+
+	rfile.close()
+	client.close()
+
+def test_new():
+	multiplexer = websocket.Multiplexer()
+
+	routes = websocket.new(multiplexer, '/ws', EchoHandler)
+
+	regex, handler = list(routes.items())[0]
+
+	assert regex == '/ws'
+	assert issubclass(handler, EchoHandler)
+	assert handler.multiplexer is multiplexer
+	assert EchoHandler.multiplexer is None
+
+	multiplexer.close()
@@ -198,6 +198,248 @@ def test_worker_keepalive():
 	assert request.handled == 2
 	assert request.initial_timeout == server.keepalive_timeout
 
+	#Check that it was marked idle while waiting on another request
+	assert request.idle == True
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_worker_pipelined():
+	server = fake.FakeHTTPServer()
+
+	puts = []
+	put = server.request_queue.put
+	server.request_queue.put = lambda item: (puts.append(item), put(item))
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	request = fake.FakeHTTPRequest(None, None, None, keepalive_number=3, pipelined_number=2)
+
+	server.request_queue.put((request, True, None))
+
+	#Wait another bit
+	time.sleep(server.poll_interval + 0.1)
+
+	#Check that the pipelined requests were handled without going back through the queue
+	assert request.handled == 3
+	assert len(puts) == 1
+	assert request.initial_timeout == server.keepalive_timeout
+	assert request.queued == request.dequeued
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_worker_draining():
+	server = fake.FakeHTTPServer()
+	server.draining = True
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	idle = fake.FakeHTTPRequest(None, None, None, keepalive_number=3)
+	waiting = fake.FakeHTTPRequest(None, None, None, keepalive_number=3, pipelined_number=1)
+	new = fake.FakeHTTPRequest(None, None, None, keepalive_number=1)
+
+	server.request_queue.put((idle, True, server.keepalive_timeout))
+	server.request_queue.put((waiting, True, server.keepalive_timeout))
+	server.request_queue.put((new, True, None))
+
+	#Wait another bit
+	time.sleep(server.poll_interval + 0.1)
+
+	#Check that idle keepalive connections are closed without waiting on them and others are still handled
+	assert idle.handled == 0
+	assert waiting.handled == 1
+	assert new.handled == 1
+	assert server.request_queue.empty()
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_worker_max_pipeline():
+	server = fake.FakeHTTPServer(max_pipeline=2)
+
+	puts = []
+	put = server.request_queue.put
+	server.request_queue.put = lambda item: (puts.append(item), put(item))
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	request = fake.FakeHTTPRequest(None, None, None, keepalive_number=5, pipelined_number=5)
+
+	server.request_queue.put((request, True, None))
+
+	#Wait another bit
+	time.sleep(server.poll_interval + 0.1)
+
+	#Check that the connection goes back through the queue after every two requests
+	assert request.handled == 5
+	assert len(puts) == 3
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_worker_detached():
+	server = fake.FakeHTTPServer()
+
+	closed = []
+	server.shutdown_request = closed.append
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	request = fake.FakeHTTPRequest(None, None, None)
+	def detach_handle(keepalive, timeout):
+		request.detached = True
+	request.handle = detach_handle
+
+	server.request_queue.put((request, True, None))
+
+	#Wait another bit
+	time.sleep(server.poll_interval + 0.1)
+
+	#Check that the connection was neither handled again nor closed
+	assert server.request_queue.qsize() == 0
+	assert server.request_queue.unfinished_tasks == 0
+	assert closed == []
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_worker_inflight():
+	server = fake.FakeHTTPServer()
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	event = threading.Event()
+
+	request = fake.FakeHTTPRequest(None, None, None)
+	def blocking_handle(keepalive, timeout):
+		request.keepalive = False
+		event.wait()
+	request.handle = blocking_handle
+
+	server.request_queue.put((request, False, None))
+
+	#Wait another bit
+	time.sleep(server.poll_interval + 0.1)
+
+	#Check that the request is tracked while it is handled
+	assert list(server.inflight.items()) == [(thread.ident, request)]
+
+	event.set()
+
+	#Wait another bit
+	time.sleep(0.1)
+
+	assert server.inflight == {}
+
 	server.worker_shutdown = -1
 	thread.join(timeout=1)
 	server.worker_shutdown = None
+
+def test_watchdog():
+	server = fake.FakeHTTPServer(slow_timeout=0.5)
+
+	thread = threading.Thread(target=web.HTTPServer.worker, args=(server, 0))
+	thread.start()
+
+	#Wait a bit
+	time.sleep(0.1)
+
+	event = threading.Event()
+
+	request = fake.FakeHTTPRequest(None, None, None)
+	request.route = '^/$'
+	def slow_handle(keepalive, timeout):
+		request.keepalive = False
+		request.received = time.perf_counter()
+		event.wait()
+	request.handle = slow_handle
+
+	server.request_queue.put((request, False, None))
+
+	try:
+		#Wait less than the timeout
+		time.sleep(0.1)
+
+		web.HTTPServer.watchdog(server)
+
+		assert server.slow_requests == 0
+		assert server.stuck_workers == 0
+
+		#Wait past the timeout
+		time.sleep(server.slow_timeout)
+
+		web.HTTPServer.watchdog(server)
+
+		assert server.slow_requests == 1
+		assert server.stuck_workers == 1
+
+		#Check that the log has the request and the stack of the worker
+		message = server.log.httpd_log.getvalue()
+		assert 'WARN: Slow request on worker 0 after ' in message
+		assert '"GET / HTTP/1.1" route ^/$' in message
+		assert 'in slow_handle' in message
+
+		#Check that it is only reported once
+		web.HTTPServer.watchdog(server)
+
+		assert server.slow_requests == 1
+		assert server.stuck_workers == 1
+		assert message == server.log.httpd_log.getvalue()
+	finally:
+		event.set()
+
+	#Wait another bit
+	time.sleep(0.1)
+
+	web.HTTPServer.watchdog(server)
+
+	assert server.slow_requests == 1
+	assert server.stuck_workers == 0
+
+	server.worker_shutdown = -1
+	thread.join(timeout=1)
+	server.worker_shutdown = None
+
+def test_manager_watchdog():
+	server = fake.FakeHTTPServer(slow_timeout=0.1)
+
+	watched = threading.Event()
+	server.watchdog = watched.set
+
+	server.manager_thread = threading.Thread(target=web.HTTPServer.manager, args=(server,))
+	server.manager_thread.start()
+
+	#Wait for a poll
+	time.sleep(server.poll_interval + 0.1)
+
+	assert watched.is_set()
+
+	server.manager_shutdown = True
+	server.manager_thread.join(timeout=1)
+	server.manager_shutdown = False
@@ -8,7 +8,10 @@ from .web import server_version, http_version, http_encoding, default_encoding
 from .web import max_line_size, max_headers, max_request_size, stream_chunk_size
 
 #Constants
-from .web import status_messages
+from .web import status_messages, would_block
 
 #Classes
-from .web import HTTPServer, HTTPHandler, HTTPErrorHandler, HTTPError, HTTPHeaders, HTTPLog
+from .web import HTTPServer, HTTPHandler, HTTPErrorHandler, HTTPError, HTTPHeaders, HTTPLog, AsyncHTTPLog, LogFile, Detach
+
+#Functions
+from .web import make_ssl_context, listen_fds, tls_pending
@@ -1,5 +1,15 @@
+import collections
+import fnmatch
+import heapq
+import html
+import io
+import itertools
+import json
+import operator
 import os
 import stat
+import string
+import threading
 import time
 import urllib
 
@@ -28,7 +38,7 @@ index_template = '''<!DOCTYPE html>
 				</thead>
 				<tbody>{entries}
 				</tbody>
-			</table>{postindex}
+			</table>{pagination}{postindex}
 		</div>{postcontent}
 	</body>
 </html>
@@ -37,7 +47,16 @@ index_template = '''<!DOCTYPE html>
 index_entry = '''
 					<tr><td class="filename"><a href="{name}">{name}</a></td><td class="size">{size}</td><td class="modified">{modified}</td></tr>'''
 
+index_pagination = '''
+			<p id="pagination">{previous} {next}</p>'''
+
+index_pagination_link = '<a href="?{query}">{text}</a>'
+
 index_content_type = 'text/html; charset=utf-8'
+index_json_content_type = 'application/json'
+
+#Number of entries rendered together into a single chunk of a streamed index
+index_batch_size = 256
 
 @functools.total_ordering
 class DirEntry(object):
@@ -53,7 +72,6 @@ class DirEntry(object):
 		self.stat = os.stat(self.path)
 
 		self.mode = self.stat.st_mode
-		self.modified = time.localtime(self.stat.st_mtime)
 
 		#For directories, add a / and specify no size
 		if stat.S_ISDIR(self.mode):
@@ -67,6 +85,18 @@ class DirEntry(object):
 	def __repr__(self):
 		return '<' + self.__class__.__name__ + ' (' + self.dirname + ') \'' + self.filename + '\'>'
 
+	@property
+	def modified(self):
+		#Only convert when needed since indexes format straight from the stat, unless a sortclass assigned its own
+		try:
+			return self.modified_value
+		except AttributeError:
+			return time.localtime(self.stat.st_mtime)
+
+	@modified.setter
+	def modified(self, value):
+		self.modified_value = value
+
 	def __str__(self):
 		return self.filename
 
@@ -94,18 +124,139 @@ class DirEntry(object):
 		#If nothing else, sort by filename
 		return self.filename < other.filename
 
+def scandir(dirname, root=False, sortclass=DirEntry):
+	if not root:
+		yield sortclass(dirname, '..')
+
+	with os.scandir(dirname) as entries:
+		for entry in entries:
+			#Leave out uploads in progress
+			if web.file.hidden(entry.name):
+				continue
+
+			yield sortclass(dirname, entry.name)
+
 def listdir(dirname, root=False, sortclass=DirEntry):
-	direntries = []
+	return sorted(scandir(dirname, root, sortclass))
+
+def listdir_page(dirname, root=False, sortclass=DirEntry, offset=0, limit=None):
+	total = 0
+
+	def count(direntries):
+		nonlocal total
+
+		for direntry in direntries:
+			total += 1
+			yield direntry
+
+	if limit is None:
+		direntries = sorted(count(scandir(dirname, root, sortclass)))[offset:]
+	else:
+		#Only keep as many entries in memory as are needed to reach the end of the page
+		direntries = heapq.nsmallest(offset + limit, count(scandir(dirname, root, sortclass)))[offset:]
+
+	return direntries, total
+
+def scandir_page(dirname, root=False, sortclass=DirEntry, offset=0, limit=None):
+	#Count without stating anything and then go through the page in directory order so nothing grows with the size of the directory
+	with os.scandir(dirname) as entries:
+		total = sum(1 for entry in entries if not web.file.hidden(entry.name))
 
 	if not root:
-		direntries.append(sortclass(dirname, '..'))
+		total += 1
+
+	return itertools.islice(scandir(dirname, root, sortclass), offset, None if limit is None else offset + limit), total
+
+def custom_modified(direntry):
+	#Overridden on the sortclass or assigned on the entry
+	return type(direntry).modified is not DirEntry.modified or hasattr(direntry, 'modified_value')
+
+def modified_key(direntry):
+	#Go straight to the timestamp unless the sortclass changes what modified means
+	if custom_modified(direntry):
+		return direntry.modified
+
+	return direntry.stat.st_mtime
+
+#Keys for sorting JSON listings, where None means the sortclass ordering
+sort_keys = {
+	'name': None,
+	'size': lambda direntry: (not direntry.is_dir, direntry.size or 0),
+	'mtime': modified_key,
+}
+
+class DirCache(object):
+	#Directories modified this recently (in nanoseconds) could change again without their mtime changing, given the resolution of filesystem timestamps
+	racy = 2000000000
+
+	def __init__(self, size=64, ttl=1):
+		self.size = size
+		self.ttl = ttl
+
+		#(dirname, root, sortclass) -> (directory mtime, scan time, sorted entries) for scans that can be trusted to notice changes
+		self.scans = collections.OrderedDict()
+		self.scans_lock = threading.Lock()
+
+	def get(self, dirname, root=False, sortclass=DirEntry):
+		key = dirname, root, sortclass
+
+		#A changed directory mtime means entries were added or removed and the ttl catches changes to the files themselves
+		mtime = os.stat(dirname).st_mtime_ns
+		now = time.monotonic()
+
+		with self.scans_lock:
+			try:
+				scan_mtime, scan_time, direntries = self.scans[key]
+
+				if scan_mtime == mtime and now - scan_time < self.ttl:
+					self.scans.move_to_end(key)
+					return direntries
+			except KeyError:
+				pass
+
+		#Scan outside of the lock so other directories are not held up
+		direntries = listdir(dirname, root, sortclass)
+
+		#Do not keep scans of a directory still changing
+		if time.time_ns() - mtime < self.racy:
+			return direntries
+
+		with self.scans_lock:
+			self.scans[key] = mtime, now, direntries
+			self.scans.move_to_end(key)
 
-	for filename in os.listdir(dirname):
-		direntries.append(sortclass(dirname, filename))
+			#Evict least recently used scans
+			while len(self.scans) > self.size:
+				self.scans.popitem(last=False)
 
-	direntries.sort()
+		return direntries
 
-	return direntries
+	def clear(self):
+		with self.scans_lock:
+			self.scans.clear()
+
+def accepts_json(accept):
+	json_quality = 0
+	html_quality = 0
+
+	#Compare the quality given to JSON against the quality given to HTML, with ties going to HTML
+	for media_range in accept.split(','):
+		media_type, *params = (item.strip() for item in media_range.split(';'))
+
+		quality = 1
+		for param in params:
+			if param.startswith('q='):
+				try:
+					quality = float(param[2:])
+				except ValueError:
+					quality = 0
+
+		if media_type == 'application/json':
+			json_quality = max(json_quality, quality)
+		elif media_type in ('text/html', 'text/*', '*/*'):
+			html_quality = max(html_quality, quality)
+
+	return json_quality > html_quality
 
 def human_readable_size(size, fmt='{size:.2f} {unit}', units=[ 'B', 'KiB', 'MiB', 'GiB', 'TiB' ]):
 	if size == None:
@@ -123,6 +274,113 @@ def human_readable_size(size, fmt='{size:.2f} {unit}', units=[ 'B', 'KiB', 'MiB'
 def human_readable_time(tme, fmt='%d-%b-%Y %H:%M %Z'):
 	return time.strftime(fmt, tme)
 
+#Sizes and minutes repeat a lot in large listings, so remember how they were formatted
+cached_human_readable_size = functools.lru_cache(maxsize=4096)(human_readable_size)
+
+@functools.lru_cache(maxsize=4096)
+def human_readable_minute(minute):
+	return human_readable_time(time.localtime(minute * 60))
+
+class Slot(object):
+	def __init__(self, field, conversion, format_spec):
+		self.field = field
+		self.conversion = conversion
+		self.format_spec = format_spec
+
+	def __repr__(self):
+		return '<' + self.__class__.__name__ + ' \'' + self.field + '\'>'
+
+	def simple(self):
+		return not self.conversion and not self.format_spec
+
+class Template(object):
+	formatter = string.Formatter()
+
+	def __init__(self, template):
+		self.template = template
+
+		#Split the template once into literal strings and slots for fields
+		self.parts = []
+		for literal, field, format_spec, conversion in self.formatter.parse(template):
+			if literal:
+				#Escaped braces split literals up, so join them back together
+				if self.parts and isinstance(self.parts[-1], str):
+					self.parts[-1] += literal
+				else:
+					self.parts.append(literal)
+			if field is not None:
+				self.parts.append(Slot(field, conversion, format_spec))
+
+		self.slots = [part for part in self.parts if isinstance(part, Slot)]
+
+	def __repr__(self):
+		return '<' + self.__class__.__name__ + ' ' + repr(self.template) + '>'
+
+	def format_slot(self, slot, fields):
+		value = self.formatter.convert_field(self.formatter.get_field(slot.field, (), fields)[0], slot.conversion)
+		return self.formatter.format_field(value, slot.format_spec)
+
+	def renderer(self, names):
+		#Fall back to str.format if any slot needs more than plain substitution of a known name
+		if not all(slot.simple() and slot.field in names for slot in self.slots):
+			template = self.template
+			return lambda values: template.format(**dict(zip(names, values)))
+
+		#Otherwise turn the template into a %-format string which is much cheaper to fill in
+		percent = ''.join(part.replace('%', '%%') if isinstance(part, str) else '%s' for part in self.parts)
+
+		if not self.slots:
+			return lambda values: percent
+
+		getter = operator.itemgetter(*(names.index(slot.field) for slot in self.slots))
+
+		if len(self.slots) == 1:
+			return lambda values: percent % (getter(values),)
+		else:
+			return lambda values: percent % getter(values)
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template):
+	return Template(template)
+
+class IterStream(io.RawIOBase):
+	def __init__(self, iterable, encoding=web.default_encoding):
+		self.iterator = iter(iterable)
+		self.encoding = encoding
+
+		self.chunk = b''
+		self.position = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		#Get the next non-empty chunk if the current one is used up
+		while self.position >= len(self.chunk):
+			try:
+				chunk = next(self.iterator)
+			except StopIteration:
+				return 0
+
+			if isinstance(chunk, str):
+				chunk = chunk.encode(self.encoding)
+
+			self.chunk = chunk
+			self.position = 0
+
+		length = min(len(buffer), len(self.chunk) - self.position)
+		buffer[:length] = self.chunk[self.position:self.position + length]
+		self.position += length
+
+		return length
+
+	def close(self):
+		#Make sure generators get cleaned up if the stream is abandoned early
+		if hasattr(self.iterator, 'close'):
+			self.iterator.close()
+
+		io.RawIOBase.close(self)
+
 class FancyIndexHandler(web.file.FileHandler):
 	head = ''
 	precontent = ''
@@ -133,15 +391,192 @@ class FancyIndexHandler(web.file.FileHandler):
 	index_template = index_template
 	index_entry = index_entry
 	index_entry_join = ''
+	index_pagination = index_pagination
+	index_pagination_link = index_pagination_link
 	index_content_type = index_content_type
+	index_json_content_type = index_json_content_type
+	index_stream = False
+	index_sort = True
+	index_limit = None
+	index_batch_size = index_batch_size
+	index_cache = None
 
 	def index(self):
+		#The same resource can be either format
+		self.response.headers.set('Vary', 'Accept')
+
+		if self.format() == 'json':
+			return self.index_json()
+
+		offset, limit = self.page()
+
+		path = self.groups[0].partition('?')[0]
+
+		if self.index_cache:
+			direntries = self.index_cache.get(self.filename, path == '/', self.sortclass)
+			total = len(direntries)
+			direntries = direntries[offset:None if limit is None else offset + limit]
+		elif not self.index_sort:
+			direntries, total = scandir_page(self.filename, path == '/', self.sortclass, offset, limit)
+		else:
+			direntries, total = listdir_page(self.filename, path == '/', self.sortclass, offset, limit)
+
 		self.response.headers.set('Content-Type', self.index_content_type)
 
-		#Magic for formatting index_template with the unquoted resource as a title and a joined list comprehension that formats index_entry for each entry in the directory
-		return self.index_template.format(dirname=urllib.parse.unquote(self.request.resource), head=self.head, precontent=self.precontent, preindex=self.preindex, postindex=self.postindex, postcontent=self.postcontent, entries=self.index_entry_join.join(self.index_entry.format(name=str(direntry), size=human_readable_size(direntry.size), modified=human_readable_time(direntry.modified)) for direntry in listdir(self.filename, self.groups[0] == '/', self.sortclass)))
+		fields = {'dirname': urllib.parse.unquote(self.request.resource.partition('?')[0]), 'head': self.head, 'precontent': self.precontent, 'preindex': self.preindex, 'postindex': self.postindex, 'postcontent': self.postcontent, 'pagination': self.pagination(offset, limit, total)}
+
+		#Streamed indexes are sent with chunked encoding as they are rendered
+		if self.index_stream:
+			return IterStream(self.render(fields, direntries))
+
+		return ''.join(self.render(fields, direntries))
+
+	def index_json(self):
+		offset, limit = self.page()
+		sort_key, reverse = self.sort()
+
+		#Parent directory entries are left out of JSON listings
+		if self.index_cache:
+			direntries = self.index_cache.get(self.filename, True, self.sortclass)
+		else:
+			direntries = listdir(self.filename, True, self.sortclass)
+
+		globs = self.query.get('glob')
+		if globs:
+			direntries = [direntry for direntry in direntries if any(fnmatch.fnmatchcase(direntry.filename.rstrip('/'), glob) for glob in globs)]
+
+		if sort_key:
+			direntries = sorted(direntries, key=sort_key, reverse=reverse)
+		elif reverse:
+			direntries = direntries[::-1]
+
+		total = len(direntries)
+		direntries = direntries[offset:None if limit is None else offset + limit]
+
+		self.response.headers.set('Content-Type', self.index_json_content_type)
+
+		return IterStream(self.render_json(urllib.parse.unquote(self.request.resource.partition('?')[0]), total, direntries))
+
+	def format(self):
+		if 'format' in self.query:
+			index_format = self.query['format'][0]
+
+			#HTTP Status 400
+			if index_format not in ('html', 'json'):
+				raise web.HTTPError(400)
+
+			return index_format
+
+		if accepts_json(self.request.headers.get('Accept', '')):
+			return 'json'
+
+		return 'html'
+
+	def sort(self):
+		sort = self.query.get('sort', ['name'])[0]
+		order = self.query.get('order', ['asc'])[0]
+
+		#HTTP Status 400
+		if sort not in sort_keys or order not in ('asc', 'desc'):
+			raise web.HTTPError(400)
+
+		return sort_keys[sort], order == 'desc'
 
-def new(local, remote='', modify=False, head='', precontent='', preindex='', postindex='', postcontent='', sortclass=DirEntry, index_template=index_template, index_entry=index_entry, index_entry_join='', index_content_type=index_content_type, handler=FancyIndexHandler):
+	def page(self):
+		try:
+			offset = int(self.query.get('offset', ['0'])[0])
+
+			if 'limit' in self.query:
+				limit = int(self.query['limit'][0])
+			else:
+				limit = self.index_limit
+		#HTTP Status 400
+		except ValueError:
+			raise web.HTTPError(400)
+
+		#HTTP Status 400
+		if offset < 0 or (limit is not None and limit < 1):
+			raise web.HTTPError(400)
+
+		return offset, limit
+
+	def pagination(self, offset, limit, total):
+		#Only paginate if the listing is cut short
+		if limit is None:
+			return ''
+
+		if offset > 0:
+			previous_link = self.index_pagination_link.format(query=self.page_query(max(offset - limit, 0), limit), offset=max(offset - limit, 0), limit=limit, text='Previous')
+		else:
+			previous_link = ''
+
+		if offset + limit < total:
+			next_link = self.index_pagination_link.format(query=self.page_query(offset + limit, limit), offset=offset + limit, limit=limit, text='Next')
+		else:
+			next_link = ''
+
+		return self.index_pagination.format(previous=previous_link, next=next_link, offset=offset, limit=limit, total=total)
+
+	def page_query(self, offset, limit):
+		#Keep the rest of the query (e.g. format) for links to other pages
+		query = {'offset': [offset], 'limit': [limit]}
+		query.update((key, values) for key, values in self.query.items() if key not in query)
+
+		return html.escape(urllib.parse.urlencode(query, doseq=True))
+
+	def entries(self, direntries):
+		render = compile_template(self.index_entry).renderer(('name', 'size', 'modified'))
+
+		#Format from the timestamp a minute at a time unless the sortclass changes what modified means
+		def modified(direntry):
+			if custom_modified(direntry):
+				return human_readable_time(direntry.modified)
+
+			return human_readable_minute(int(direntry.stat.st_mtime // 60))
+
+		#Render entries a batch at a time so a streamed index is sent in reasonably sized chunks, taking them from an iterator so unsorted listings are never held whole
+		direntries = iter(direntries)
+
+		first = True
+		while True:
+			batch = [render((str(direntry), cached_human_readable_size(direntry.size), modified(direntry))) for direntry in itertools.islice(direntries, self.index_batch_size)]
+			if not batch:
+				break
+
+			if not first:
+				yield self.index_entry_join
+
+			yield self.index_entry_join.join(batch)
+
+			first = False
+
+	def render_json(self, dirname, total, direntries):
+		yield '{"dirname":' + json.dumps(dirname) + ',"total":' + str(total) + ',"entries":['
+
+		#Encode entries a batch at a time like the HTML index
+		for start in range(0, len(direntries), self.index_batch_size):
+			batch = ','.join(json.dumps({'name': direntry.filename.rstrip('/'), 'size': direntry.size, 'mtime': direntry.stat.st_mtime, 'is_dir': direntry.is_dir}, separators=(',', ':')) for direntry in direntries[start:start + self.index_batch_size])
+
+			if start > 0:
+				yield ','
+
+			yield batch
+
+		yield ']}'
+
+	def render(self, fields, direntries):
+		template = compile_template(self.index_template)
+
+		#Walk index_template part by part so the entries can be rendered lazily in place
+		for part in template.parts:
+			if isinstance(part, str):
+				yield part
+			elif part.field == 'entries':
+				yield from self.entries(direntries)
+			else:
+				yield template.format_slot(part, fields)
+
+def new(local, remote='', modify=False, head='', precontent='', preindex='', postindex='', postcontent='', sortclass=DirEntry, index_template=index_template, index_entry=index_entry, index_entry_join='', index_content_type=index_content_type, handler=FancyIndexHandler, stream=False, sort=True, limit=None, cache=None):
 	#Create a file handler with the custom arguments
 	class GenFancyIndexHandler(handler):
 		pass
@@ -156,9 +591,18 @@ def new(local, remote='', modify=False, head='', precontent='', preindex='', pos
 
 	GenFancyIndexHandler.index_template = index_template
 	GenFancyIndexHandler.index_entry = index_entry
+
+	#Split the templates up front so requests only look them up
+	compile_template(index_template)
+	compile_template(index_entry)
 	GenFancyIndexHandler.index_entry_join = index_entry_join
 	GenFancyIndexHandler.index_content_type = index_content_type
 
+	GenFancyIndexHandler.index_stream = stream
+	GenFancyIndexHandler.index_sort = sort
+	GenFancyIndexHandler.index_limit = limit
+	GenFancyIndexHandler.index_cache = cache
+
 	return web.file.new(local, remote, dir_index=True, modify=modify, handler=GenFancyIndexHandler)
 
 if __name__ == '__main__':
@@ -167,9 +611,13 @@ if __name__ == '__main__':
 	parser = ArgumentParser(description='quickly serve up local files over HTTP with a fancy directory index')
 	parser.add_argument('-p', '--port', default=8080, type=int, dest='port', help='port to serve HTTP on (default: 8080)')
 	parser.add_argument('--allow-modify', action='store_true', default=False, dest='modify', help='allow file and directory modifications using PUT and DELETE methods')
+	parser.add_argument('--stream', action='store_true', default=False, dest='stream', help='stream directory indexes as they are rendered')
+	parser.add_argument('--unsorted', action='store_false', default=True, dest='sort', help='list directory indexes in directory order without holding the whole listing in memory')
+	parser.add_argument('--limit', default=None, type=int, dest='limit', help='default number of entries per directory index page (default: all)')
+	parser.add_argument('--cache-ttl', default=1, type=float, dest='cache_ttl', help='seconds to reuse a directory scan while the directory is unchanged, or 0 to scan every time (default: 1)')
 	parser.add_argument('local_dir', help='local directory to serve over HTTP')
 
 	args = parser.parse_args()
 
-	httpd = web.HTTPServer(('', args.port), new(args.local_dir, modify=args.modify))
+	httpd = web.HTTPServer(('', args.port), new(args.local_dir, modify=args.modify, stream=args.stream, sort=args.sort, limit=args.limit, cache=DirCache(ttl=args.cache_ttl) if args.cache_ttl > 0 else None))
 	httpd.start()
@@ -1,8 +1,14 @@
+import atexit
 import collections
+import errno
 import mimetypes
 import os
+import queue
 import re
 import shutil
+import stat
+import threading
+import time
 import urllib.parse
 
 import web
@@ -35,13 +41,239 @@ def normpath(path):
 
 	return '/'.join(new_path)
 
+#Names of upload temporary and staging files (see ModifyMixIn), which are never served
+upload_file_regex = re.compile('\\..+\\.(?:[0-9a-f]{12}\\.upload|partial)')
+
+def hidden(name):
+	return bool(upload_file_regex.fullmatch(name))
+
+#Per-thread buffers reused across uploads
+upload_buffers = threading.local()
+
+def upload_buffer(size):
+	buffer = getattr(upload_buffers, 'buffer', None)
+
+	if buffer is None or len(buffer) != size:
+		buffer = memoryview(bytearray(size))
+		upload_buffers.buffer = buffer
+
+	return buffer
+
+def fsync_dir(dirname):
+	#Make a rename durable by syncing the directory entry (not possible on every platform)
+	try:
+		fd = os.open(dirname, os.O_RDONLY)
+	except OSError:
+		return
+
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+class Reaper(object):
+	def __init__(self, trash, num_threads=2, log=None, partial_upload_timeout=3600, expire_interval=60):
+		self.trash = trash
+		self.num_threads = num_threads
+		self.log = log
+
+		#Remove ranged uploads idle longer than partial_upload_timeout every expire_interval seconds (see expire_partial_uploads), None to leave it to the next upload
+		self.partial_upload_timeout = partial_upload_timeout
+		self.expire_interval = expire_interval
+
+		#Trees waiting to be removed from the trash
+		self.trees = queue.Queue()
+
+		self.worker_threads = None
+		self.worker_lock = threading.Lock()
+
+		#Progress and metrics
+		self.stats_lock = threading.Lock()
+		self.trees_discarded = 0
+		self.trees_removed = 0
+		self.files_removed = 0
+		self.dirs_removed = 0
+		self.errors = 0
+		self.uploads_expired = 0
+		self.removing = {}
+
+		#Fail fast on a trash that could never be used
+		os.makedirs(self.trash, exist_ok=True)
+		if not self.usable():
+			raise PermissionError(errno.EACCES, 'Trash directory is not writable', self.trash)
+
+	def usable(self):
+		return os.path.isdir(self.trash) and os.access(self.trash, os.W_OK | os.X_OK)
+
+	def start(self):
+		with self.worker_lock:
+			if self.worker_threads:
+				return
+
+			os.makedirs(self.trash, exist_ok=True)
+
+			#Pick up anything left in the trash from a previous run
+			for name in os.listdir(self.trash):
+				self.trees.put(os.path.join(self.trash, name))
+
+			self.worker_threads = []
+			for i in range(self.num_threads):
+				thread = threading.Thread(target=self.worker, name='Reaper-Worker', args=(i,), daemon=True)
+				self.worker_threads.append(thread)
+				thread.start()
+
+			#Finish what is in the trash before exiting however the server is shut down
+			atexit.register(self.close)
+
+	def close(self, timeout=None):
+		with self.worker_lock:
+			if not self.worker_threads:
+				return
+
+			#Tell each worker to quit once the trash is empty
+			for thread in self.worker_threads:
+				self.trees.put(None)
+
+			for thread in self.worker_threads:
+				thread.join(timeout)
+
+			self.worker_threads = None
+
+			atexit.unregister(self.close)
+
+	def join(self):
+		self.trees.join()
+
+	def discard(self, path):
+		#Move the tree out of the way in a single rename so the removal can happen later
+		trash_path = os.path.join(self.trash, os.path.basename(path) + '.' + os.urandom(6).hex())
+
+		try:
+			self.start()
+			os.rename(path, trash_path)
+		except OSError as error:
+			#Errors with the tree itself are for the caller, but a tree on another filesystem or a trash that stopped working means removing it some other way
+			if error.errno != errno.EXDEV and self.usable():
+				raise
+
+			if self.log:
+				self.log.warn('Removing ' + path + ' without the trash: ' + str(error))
+
+			return False
+
+		with self.stats_lock:
+			self.trees_discarded += 1
+
+		self.trees.put(trash_path)
+
+		return True
+
+	def remove(self, path):
+		for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+			for filename in filenames:
+				os.unlink(os.path.join(dirpath, filename))
+
+				with self.stats_lock:
+					self.files_removed += 1
+					self.removing[path] += 1
+
+			for dirname in dirnames:
+				#Symbolic links to directories are listed as directories but are not walked
+				dirname = os.path.join(dirpath, dirname)
+				if os.path.islink(dirname):
+					os.unlink(dirname)
+				else:
+					os.rmdir(dirname)
+
+				with self.stats_lock:
+					self.dirs_removed += 1
+					self.removing[path] += 1
+
+		os.rmdir(path)
+
+		with self.stats_lock:
+			self.dirs_removed += 1
+
+	def expire(self):
+		try:
+			expired = expire_partial_uploads(self.partial_upload_timeout)
+		except OSError:
+			with self.stats_lock:
+				self.errors += 1
+
+			if self.log:
+				self.log.exception()
+
+			return
+
+		with self.stats_lock:
+			self.uploads_expired += len(expired)
+
+	def worker(self, num):
+		#The first worker also expires abandoned uploads between trees so they go even when no more uploads come
+		expiring = num == 0 and self.partial_upload_timeout is not None
+		next_expire = time.monotonic() + self.expire_interval
+
+		while True:
+			if expiring and time.monotonic() >= next_expire:
+				self.expire()
+				next_expire = time.monotonic() + self.expire_interval
+
+			try:
+				path = self.trees.get(timeout=max(0, next_expire - time.monotonic()) if expiring else None)
+			except queue.Empty:
+				continue
+
+			try:
+				if path is None:
+					return
+
+				with self.stats_lock:
+					self.removing[path] = 0
+
+				try:
+					if os.path.isdir(path) and not os.path.islink(path):
+						self.remove(path)
+					else:
+						os.unlink(path)
+
+					with self.stats_lock:
+						self.trees_removed += 1
+				except OSError:
+					with self.stats_lock:
+						self.errors += 1
+
+					if self.log:
+						self.log.exception()
+				finally:
+					with self.stats_lock:
+						del self.removing[path]
+			finally:
+				self.trees.task_done()
+
+	def stats(self):
+		with self.stats_lock:
+			return {
+				'pending': self.trees.qsize(),
+				'removing': dict(self.removing),
+				'trees_discarded': self.trees_discarded,
+				'trees_removed': self.trees_removed,
+				'files_removed': self.files_removed,
+				'dirs_removed': self.dirs_removed,
+				'errors': self.errors,
+				'uploads_expired': self.uploads_expired,
+			}
+
 class FileHandler(web.HTTPHandler):
 	filename = None
+	query = {}
 	dir_index = False
 
 	def index(self):
 		#Magic for stringing together everything in the directory with a newline and adding a / at the end for directories
-		return ''.join(filename + '/\n' if os.path.isdir(os.path.join(self.filename, filename)) else filename + '\n' for filename in os.listdir(self.filename))
+		return ''.join(filename + '/\n' if os.path.isdir(os.path.join(self.filename, filename)) else filename + '\n' for filename in os.listdir(self.filename) if not hidden(filename))
 
 	def get_body(self):
 		return False
@@ -51,7 +283,8 @@ class FileHandler(web.HTTPHandler):
 			if os.path.isdir(self.filename):
 				#If necessary, redirect to add trailing slash
 				if not self.filename.endswith('/'):
-					self.response.headers.set('Location', self.request.resource + '/')
+					resource, question, query_string = self.request.resource.partition('?')
+					self.response.headers.set('Location', resource + '/' + question + query_string)
 
 					return 307, ''
 
@@ -117,22 +350,356 @@ class FileHandler(web.HTTPHandler):
 		except IOError:
 			raise web.HTTPError(403)
 
+class PartialUpload(object):
+	def __init__(self, filename, total):
+		self.filename = filename
+		self.total = total
+
+		dirname, basename = os.path.split(filename)
+		self.staging = os.path.join(dirname, '.' + basename + '.partial')
+
+		#Sorted, merged list of received [start, end) byte ranges
+		self.ranges = []
+
+		#Number of requests currently writing to the staging file
+		self.writers = 0
+
+		#Set once the staging file is created (or failed to be) by the request that started the upload
+		self.ready = threading.Event()
+		self.failed = False
+
+		#Last time a request used the upload, for expiring abandoned ones
+		self.touched = time.monotonic()
+
+	def __repr__(self):
+		return '<' + self.__class__.__name__ + ' \'' + self.filename + '\' ' + self.range_header() + '/' + str(self.total) + '>'
+
+	def add(self, start, end):
+		merged = []
+
+		for range_start, range_end in self.ranges:
+			#Merge any overlapping or touching ranges into the new one
+			if range_end < start or range_start > end:
+				merged.append((range_start, range_end))
+			else:
+				start = min(start, range_start)
+				end = max(end, range_end)
+
+		merged.append((start, end))
+		merged.sort()
+
+		self.ranges = merged
+
+	def complete(self):
+		return self.ranges == [(0, self.total)]
+
+	def range_header(self):
+		return 'bytes=' + ','.join(str(start) + '-' + str(end - 1) for start, end in self.ranges)
+
+#Filename -> PartialUpload for ranged uploads in progress
+partial_uploads = {}
+partial_uploads_lock = threading.Lock()
+
+def expire_partial_uploads(timeout):
+	now = time.monotonic()
+	expired = []
+
+	#Forget uploads nobody has touched in a while and remove their staging files
+	with partial_uploads_lock:
+		for filename, upload in list(partial_uploads.items()):
+			if upload.writers == 0 and now - upload.touched > timeout:
+				del partial_uploads[filename]
+				expired.append(upload)
+
+	for upload in expired:
+		try:
+			os.remove(upload.staging)
+		except FileNotFoundError:
+			pass
+
+	return expired
+
+content_range_regex = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)')
+
 class ModifyMixIn:
+	fsync = False
+	reaper = None
+	upload_buffer_size = 1048576 #1 MiB
+	max_upload_size = None
+	partial_upload_timeout = 3600 #1 hour
+
+	@property
+	def nonatomic(self):
+		#Ranged uploads write separate parts of a staging file so they can run in parallel
+		if self.method == 'put' and self.request.headers.get('Content-Range'):
+			return True
+
+		return super().nonatomic
+
+	def content_length(self):
+		try:
+			length = int(self.request.headers.get('Content-Length', '0'))
+		#HTTP Status 400
+		except ValueError:
+			raise web.HTTPError(400)
+
+		#HTTP Status 400
+		if length < 0:
+			raise web.HTTPError(400)
+
+		return length
+
+	def file_mode(self, filename):
+		#Keep the same permission semantics as writing in place
+		try:
+			mode = stat.S_IMODE(os.stat(filename).st_mode)
+
+			if not os.access(filename, os.W_OK):
+				raise PermissionError(filename)
+		except FileNotFoundError:
+			mode = None
+
+		return mode
+
+	def receive(self, file, length):
+		buffer = upload_buffer(self.upload_buffer_size)
+
+		self.request.expect_body(length)
+
+		bytes_left = length
+		while bytes_left:
+			try:
+				read = self.request.rfile.readinto(buffer[:min(bytes_left, len(buffer))])
+			#Treat a timed out or broken connection like a short body
+			except OSError:
+				read = 0
+
+			if not read:
+				break
+
+			bytes_left -= read
+
+			written = 0
+			while written < read:
+				written += file.write(buffer[written:read])
+
+		#HTTP Status 408 or 400
+		#Do not commit a short body and do not try to read another request from the connection
+		if bytes_left:
+			self.request.keepalive = False
+			raise web.HTTPError(408 if self.request.timed_out() else 400)
+
+		self.request.deadline = None
+
+	def check_size(self, dirname, length):
+		#HTTP Status 413
+		if self.max_upload_size is not None and length > self.max_upload_size:
+			raise web.HTTPError(413)
+
+		#HTTP Status 507
+		if length > shutil.disk_usage(dirname or '.').free:
+			raise web.HTTPError(507)
+
+	def preallocate(self, fd, length):
+		#Reserve space up front to avoid fragmentation and find a full disk before reading the body
+		if length and hasattr(os, 'posix_fallocate'):
+			try:
+				os.posix_fallocate(fd, 0, length)
+			except OSError as error:
+				#Not every filesystem supports it, but a full disk should fail early
+				if error.errno == errno.ENOSPC:
+					raise
+
+	def promote(self, temp, filename, mode):
+		if mode is not None:
+			os.chmod(temp, mode)
+
+		os.replace(temp, filename)
+
+		if self.fsync:
+			fsync_dir(os.path.dirname(filename) or '.')
+
+	def upload(self, filename):
+		length = self.content_length()
+		mode = self.file_mode(filename)
+
+		#Write to a temporary file in the same directory so it can be atomically renamed over the target
+		dirname, basename = os.path.split(filename)
+
+		self.check_size(dirname, length)
+		temp = os.path.join(dirname, '.' + basename + '.' + os.urandom(6).hex() + '.upload')
+
+		fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+		try:
+			with open(fd, 'wb', buffering=0) as file:
+				self.preallocate(fd, length)
+
+				self.receive(file, length)
+
+				if self.fsync:
+					os.fsync(fd)
+
+			self.promote(temp, filename, mode)
+		except:
+			os.remove(temp)
+			raise
+
+	def upload_range(self, filename, content_range):
+		range_match = content_range_regex.fullmatch(content_range)
+
+		#HTTP Status 400
+		if not range_match:
+			raise web.HTTPError(400)
+
+		lower, upper, total = range_match.groups()
+		total = int(total)
+
+		length = self.content_length()
+
+		#Fail early if the file could never be replaced
+		self.file_mode(filename)
+
+		expire_partial_uploads(self.partial_upload_timeout)
+
+		with partial_uploads_lock:
+			upload = partial_uploads.get(filename)
+
+			#'bytes */total' just asks how much of the upload has been received
+			if lower is None:
+				if upload:
+					self.response.headers.set('Range', upload.range_header())
+
+				return 202, ''
+
+			lower = int(lower)
+			upper = int(upper)
+
+			#HTTP Status 416
+			if upper < lower or upper >= total:
+				raise web.HTTPError(416)
+
+			#HTTP Status 400
+			if length != upper - lower + 1:
+				raise web.HTTPError(400)
+
+			#HTTP Status 409
+			#Uploads to the same file must agree on its size
+			if upload and upload.total != total:
+				raise web.HTTPError(409)
+
+			#Hold the place of a new upload so the staging file can be created without holding up every other upload
+			stage = not upload
+			if stage:
+				#Check the size before creating anything
+				self.check_size(os.path.dirname(filename), total)
+
+				upload = PartialUpload(filename, total)
+				partial_uploads[filename] = upload
+
+			upload.writers += 1
+			upload.touched = time.monotonic()
+
+		if stage:
+			try:
+				self.stage(upload)
+			except:
+				with partial_uploads_lock:
+					upload.failed = True
+					upload.writers -= 1
+
+					if partial_uploads.get(filename) is upload:
+						del partial_uploads[filename]
+
+				upload.ready.set()
+
+				try:
+					os.remove(upload.staging)
+				except FileNotFoundError:
+					pass
+
+				raise
+
+			upload.ready.set()
+		else:
+			upload.ready.wait()
+
+			#HTTP Status 503
+			#The request that started the upload could not create the staging file, so let the client try again
+			if upload.failed:
+				with partial_uploads_lock:
+					upload.writers -= 1
+
+				raise web.HTTPError(503)
+
+		try:
+			#Other requests may be filling in other ranges of the same file at the same time
+			with open(upload.staging, 'r+b', buffering=0) as file:
+				file.seek(lower)
+
+				self.receive(file, length)
+
+				if self.fsync:
+					os.fsync(file.fileno())
+		except:
+			self.finish_range(upload)
+			raise
+
+		if self.finish_range(upload, lower, upper + 1):
+			return 204, ''
+		else:
+			return 202, ''
+
+	def stage(self, upload):
+		#Start from an empty staging file of the right size, discarding anything left over from before a restart
+		fd = os.open(upload.staging, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+		try:
+			self.preallocate(fd, upload.total)
+			os.ftruncate(fd, upload.total)
+		except OSError as error:
+			#HTTP Status 413 or 507
+			if error.errno == errno.EFBIG:
+				raise web.HTTPError(413)
+			elif error.errno == errno.ENOSPC:
+				raise web.HTTPError(507)
+
+			raise
+		finally:
+			os.close(fd)
+
+	def finish_range(self, upload, lower=None, upper=None):
+		with partial_uploads_lock:
+			upload.writers -= 1
+			upload.touched = time.monotonic()
+
+			if lower is not None:
+				upload.add(lower, upper)
+
+			#The last writer to finish a complete upload promotes it
+			promote = upload.complete() and upload.writers == 0 and partial_uploads.get(upload.filename) is upload
+			if promote:
+				del partial_uploads[upload.filename]
+			else:
+				self.response.headers.set('Range', upload.range_header())
+
+		if promote:
+			self.promote(upload.staging, upload.filename, self.file_mode(upload.filename))
+
+		return promote
+
 	def do_put(self):
 		try:
 			#Make sure directories are there (including the given one if not given a file)
 			os.makedirs(os.path.dirname(self.filename), exist_ok=True)
 
-			#If not directory, open (possibly new) file and fill it with request body
+			#If not directory, atomically replace the (possibly new) file with the request body
 			if not os.path.isdir(self.filename):
-				with open(self.filename, 'wb') as file:
-					bytes_left = int(self.request.headers.get('Content-Length', '0'))
-					while True:
-						chunk = self.request.rfile.read(min(bytes_left, web.stream_chunk_size))
-						if not chunk:
-							break
-						bytes_left -= len(chunk)
-						file.write(chunk)
+				#Ranges of a file can be uploaded separately and the file is replaced once they are all received
+				content_range = self.request.headers.get('Content-Range')
+				if content_range:
+					return self.upload_range(self.filename, content_range)
+
+				self.upload(self.filename)
 
 			return 204, ''
 		except IOError:
@@ -141,6 +708,10 @@ class ModifyMixIn:
 	def do_delete(self):
 		try:
 			if os.path.isdir(self.filename):
+				#Hand directory to the reaper to be removed in the background if it can take it
+				if self.reaper and self.reaper.discard(self.filename.rstrip('/') or self.filename):
+					return 204, ''
+
 				#Recursively remove directory
 				shutil.rmtree(self.filename)
 			else:
@@ -156,7 +727,7 @@ class ModifyMixIn:
 class ModifyFileHandler(ModifyMixIn, FileHandler):
 	pass
 
-def new(local, remote='', dir_index=False, modify=False, handler=FileHandler):
+def new(local, remote='', dir_index=False, modify=False, handler=FileHandler, fsync=False, reaper=None, max_upload_size=None):
 	#Remove trailing slashes if necessary
 	if local.endswith('/'):
 		local = local[:-1]
@@ -172,19 +743,31 @@ def new(local, remote='', dir_index=False, modify=False, handler=FileHandler):
 	#Create a file handler for routes
 	class GenFileHandler(*inherit):
 		def respond(self):
-			norm_request = normpath(self.groups[0])
-			if self.groups[0] != norm_request:
-				self.response.headers.set('Location', self.remote + norm_request)
+			#Split off the query string so it is not treated as part of the path
+			path, question, query_string = self.groups[0].partition('?')
+
+			norm_request = normpath(path)
+			if path != norm_request:
+				self.response.headers.set('Location', self.remote + norm_request + question + query_string)
 
 				return 307, ''
 
-			self.filename = self.local + urllib.parse.unquote(self.groups[0])
+			self.filename = self.local + urllib.parse.unquote(path)
+			self.query = urllib.parse.parse_qs(query_string)
+
+			#HTTP Status 404
+			#Uploads in progress are not files to be served or touched
+			if hidden(os.path.basename(self.filename)):
+				raise web.HTTPError(404)
 
 			return handler.respond(self)
 
 	GenFileHandler.local = local
 	GenFileHandler.remote = remote
 	GenFileHandler.dir_index = dir_index
+	GenFileHandler.fsync = fsync
+	GenFileHandler.reaper = reaper
+	GenFileHandler.max_upload_size = max_upload_size
 
 	return {remote + '(|/.*)': GenFileHandler}
 
@@ -195,9 +778,32 @@ if __name__ == '__main__':
 	parser.add_argument('-p', '--port', default=8080, type=int, dest='port', help='port to serve HTTP on (default: 8080)')
 	parser.add_argument('--no-index', action='store_false', default=True, dest='indexing', help='disable directory listings')
 	parser.add_argument('--allow-modify', action='store_true', default=False, dest='modify', help='allow file and directory modifications using PUT and DELETE methods')
+	parser.add_argument('--fsync', action='store_true', default=False, dest='fsync', help='flush uploaded files to disk before acknowledging them')
+	parser.add_argument('--trash', default=None, dest='trash', help='move deleted directories to this directory (on the same filesystem) and remove them in the background')
+	parser.add_argument('--max-upload-size', default=None, type=int, dest='max_upload_size', help='largest file in bytes that can be uploaded (default: no limit beyond free space)')
 	parser.add_argument('local_dir', help='local directory to serve over HTTP')
 
 	args = parser.parse_args()
 
-	httpd = web.HTTPServer(('', args.port), new(args.local_dir, dir_index=args.indexing, modify=args.modify))
+	log = web.HTTPLog(None, None)
+
+	if args.trash:
+		#Start right away so abandoned uploads are expired even before anything is deleted
+		reaper = Reaper(args.trash, log=log)
+		reaper.start()
+	else:
+		reaper = None
+
+	httpd = web.HTTPServer(('', args.port), new(args.local_dir, dir_index=args.indexing, modify=args.modify, fsync=args.fsync, reaper=reaper, max_upload_size=args.max_upload_size), log=log)
 	httpd.start()
+
+	#Stop cleanly, finishing pending deletes, when interrupted
+	try:
+		httpd.server_thread.join()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		httpd.close()
+
+		if reaper:
+			reaper.close()
@@ -0,0 +1,1462 @@
+import collections
+import io
+import selectors
+import socket
+import threading
+import time
+
+import web
+
+#Rest of the connection preface after the request line that HTTPRequest reads
+preface_rest = b'\r\nSM\r\n\r\n'
+
+http2_version = 'HTTP/2.0'
+
+#Frame types
+frame_data = 0x0
+frame_headers = 0x1
+frame_priority = 0x2
+frame_rst_stream = 0x3
+frame_settings = 0x4
+frame_push_promise = 0x5
+frame_ping = 0x6
+frame_goaway = 0x7
+frame_window_update = 0x8
+frame_continuation = 0x9
+frame_priority_update = 0x10
+
+#Frame flags
+flag_end_stream = 0x1
+flag_ack = 0x1
+flag_end_headers = 0x4
+flag_padded = 0x8
+flag_priority = 0x20
+
+#Settings
+setting_header_table_size = 0x1
+setting_enable_push = 0x2
+setting_max_concurrent_streams = 0x3
+setting_initial_window_size = 0x4
+setting_max_frame_size = 0x5
+setting_max_header_list_size = 0x6
+
+#Error codes
+error_none = 0x0
+error_protocol = 0x1
+error_internal = 0x2
+error_flow_control = 0x3
+error_stream_closed = 0x5
+error_frame_size = 0x6
+error_refused_stream = 0x7
+error_cancel = 0x8
+error_compression = 0x9
+error_enhance_your_calm = 0xb
+
+default_window_size = 65535
+max_window_size = 2147483647
+default_max_frame_size = 16384
+max_max_frame_size = 16777215
+default_header_table_size = 4096
+
+#Largest header block (with its continuations) accepted before giving up on the connection
+max_header_block_size = 262144
+
+#Headers that only mean something to a single HTTP/1.1 connection and are not allowed in HTTP/2
+connection_headers = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'}
+
+#Response headers that change with nearly every response and would only churn the header table
+unindexed_headers = {'date', 'content-length', 'content-range', 'etag', 'last-modified'}
+
+#HPACK static table (RFC 7541 Appendix A)
+static_table = [
+	(':authority', ''), (':method', 'GET'), (':method', 'POST'), (':path', '/'), (':path', '/index.html'),
+	(':scheme', 'http'), (':scheme', 'https'), (':status', '200'), (':status', '204'), (':status', '206'),
+	(':status', '304'), (':status', '400'), (':status', '404'), (':status', '500'), ('accept-charset', ''),
+	('accept-encoding', 'gzip, deflate'), ('accept-language', ''), ('accept-ranges', ''), ('accept', ''), ('access-control-allow-origin', ''),
+	('age', ''), ('allow', ''), ('authorization', ''), ('cache-control', ''), ('content-disposition', ''),
+	('content-encoding', ''), ('content-language', ''), ('content-length', ''), ('content-location', ''), ('content-range', ''),
+	('content-type', ''), ('cookie', ''), ('date', ''), ('etag', ''), ('expect', ''),
+	('expires', ''), ('from', ''), ('host', ''), ('if-match', ''), ('if-modified-since', ''),
+	('if-none-match', ''), ('if-range', ''), ('if-unmodified-since', ''), ('last-modified', ''), ('link', ''),
+	('location', ''), ('max-forwards', ''), ('proxy-authenticate', ''), ('proxy-authorization', ''), ('range', ''),
+	('referer', ''), ('refresh', ''), ('retry-after', ''), ('server', ''), ('set-cookie', ''),
+	('strict-transport-security', ''), ('transfer-encoding', ''), ('user-agent', ''), ('vary', ''), ('via', ''),
+	('www-authenticate', ''),
+]
+
+#(name, value) -> index and name -> first index for the encoder
+static_index = {}
+static_names = {}
+for index, (name, value) in enumerate(static_table, 1):
+	static_index.setdefault((name, value), index)
+	static_names.setdefault(name, index)
+
+#Code length of each symbol in the HPACK Huffman code (RFC 7541 Appendix B), the last being EOS
+huffman_lengths = [
+	13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+	6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6, 5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+	13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+	15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5, 6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+	20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23, 24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+	22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23, 21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+	26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25, 19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+	20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23, 26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+	30,
+]
+
+huffman_eos = 256
+
+def canonical_codes(lengths):
+	#The HPACK code is canonical so the codes follow from the lengths alone
+	codes = [None] * len(lengths)
+
+	code = 0
+	previous = None
+	for symbol in sorted(range(len(lengths)), key=lambda symbol: (lengths[symbol], symbol)):
+		if previous is not None:
+			code = (code + 1) << (lengths[symbol] - previous)
+		previous = lengths[symbol]
+
+		codes[symbol] = (code, lengths[symbol])
+
+	return codes
+
+#Symbol -> (code, length) for encoding and length -> {code: symbol} for decoding
+huffman_codes = canonical_codes(huffman_lengths)
+huffman_table = {}
+for symbol, (code, length) in enumerate(huffman_codes):
+	huffman_table.setdefault(length, {})[code] = symbol
+huffman_sizes = sorted(huffman_table)
+
+class HTTP2Error(Exception):
+	def __init__(self, code, message=''):
+		self.code = code
+		self.message = message
+
+class StreamError(HTTP2Error):
+	pass
+
+class HPACKError(HTTP2Error):
+	def __init__(self, message=''):
+		HTTP2Error.__init__(self, error_compression, message)
+
+def huffman_encode(data):
+	bits = 0
+	length = 0
+	for byte in data:
+		code, size = huffman_codes[byte]
+		bits = (bits << size) | code
+		length += size
+
+	#Pad to a whole byte with the most significant bits of EOS, which are all ones
+	padding = -length % 8
+	bits = (bits << padding) | ((1 << padding) - 1)
+
+	return bits.to_bytes((length + padding) // 8, 'big')
+
+def huffman_decode(data):
+	decoded = bytearray()
+
+	bits = 0
+	length = 0
+	for byte in data:
+		bits = (bits << 8) | byte
+		length += 8
+
+		#Take symbols off the top while there are enough bits for one
+		while True:
+			for size in huffman_sizes:
+				if size > length:
+					symbol = None
+					break
+
+				symbol = huffman_table[size].get(bits >> (length - size))
+				if symbol is not None:
+					break
+			else:
+				raise HPACKError('Invalid Huffman code')
+
+			if symbol is None:
+				break
+
+			if symbol == huffman_eos:
+				raise HPACKError('EOS in Huffman string')
+
+			decoded.append(symbol)
+
+			length -= size
+			bits &= (1 << length) - 1
+
+	#What is left must be padding made of the start of EOS
+	if length > 7 or bits != (1 << length) - 1:
+		raise HPACKError('Invalid Huffman padding')
+
+	return bytes(decoded)
+
+def encode_integer(value, prefix, flags=0):
+	mask = (1 << prefix) - 1
+
+	if value < mask:
+		return bytes([flags | value])
+
+	encoded = bytearray([flags | mask])
+
+	value -= mask
+	while value >= 128:
+		encoded.append((value & 0x7f) | 0x80)
+		value >>= 7
+	encoded.append(value)
+
+	return bytes(encoded)
+
+def decode_integer(data, offset, prefix):
+	if offset >= len(data):
+		raise HPACKError('Truncated integer')
+
+	mask = (1 << prefix) - 1
+
+	value = data[offset] & mask
+	offset += 1
+
+	if value < mask:
+		return value, offset
+
+	shift = 0
+	while True:
+		if offset >= len(data):
+			raise HPACKError('Truncated integer')
+
+		#Nothing legitimate needs more than 32 bits
+		if shift > 28:
+			raise HPACKError('Integer too large')
+
+		byte = data[offset]
+		offset += 1
+
+		value += (byte & 0x7f) << shift
+		shift += 7
+
+		if not byte & 0x80:
+			return value, offset
+
+def encode_string(data):
+	#Only use the Huffman code when it is actually shorter
+	encoded = huffman_encode(data)
+	if len(encoded) < len(data):
+		return encode_integer(len(encoded), 7, 0x80) + encoded
+
+	return encode_integer(len(data), 7) + data
+
+def decode_string(data, offset):
+	if offset >= len(data):
+		raise HPACKError('Truncated string')
+
+	huffman = data[offset] & 0x80
+	length, offset = decode_integer(data, offset, 7)
+
+	if offset + length > len(data):
+		raise HPACKError('Truncated string')
+
+	string = bytes(data[offset:offset + length])
+	if huffman:
+		string = huffman_decode(string)
+
+	return string.decode(web.http_encoding), offset + length
+
+def entry_size(name, value):
+	return 32 + len(name) + len(value)
+
+class HPACKDecoder(object):
+	def __init__(self, max_size=default_header_table_size):
+		#Largest size the encoder may pick (what we advertise) and the size it picked
+		self.settings_max_size = max_size
+		self.max_size = max_size
+
+		#Dynamic table with the newest entry first
+		self.table = collections.deque()
+		self.size = 0
+
+	def entry(self, index):
+		if index < 1:
+			raise HPACKError('Invalid index')
+
+		if index <= len(static_table):
+			return static_table[index - 1]
+
+		try:
+			return self.table[index - len(static_table) - 1]
+		except IndexError:
+			raise HPACKError('Invalid index')
+
+	def add(self, name, value):
+		size = entry_size(name, value)
+
+		#An entry larger than the table just empties it
+		while self.table and self.size + size > self.max_size:
+			evicted_name, evicted_value = self.table.pop()
+			self.size -= entry_size(evicted_name, evicted_value)
+
+		if size <= self.max_size:
+			self.table.appendleft((name, value))
+			self.size += size
+
+	def resize(self, max_size):
+		if max_size > self.settings_max_size:
+			raise HPACKError('Table size too large')
+
+		self.max_size = max_size
+
+		while self.size > self.max_size:
+			evicted_name, evicted_value = self.table.pop()
+			self.size -= entry_size(evicted_name, evicted_value)
+
+	def literal(self, block, offset, index):
+		if index:
+			name = self.entry(index)[0]
+		else:
+			name, offset = decode_string(block, offset)
+
+		value, offset = decode_string(block, offset)
+
+		return name, value, offset
+
+	def decode(self, block):
+		headers = []
+
+		offset = 0
+		while offset < len(block):
+			byte = block[offset]
+
+			#Indexed header field
+			if byte & 0x80:
+				index, offset = decode_integer(block, offset, 7)
+				headers.append(self.entry(index))
+			#Literal header field with incremental indexing
+			elif byte & 0x40:
+				index, offset = decode_integer(block, offset, 6)
+				name, value, offset = self.literal(block, offset, index)
+				self.add(name, value)
+				headers.append((name, value))
+			#Dynamic table size update, only allowed at the start of a block
+			elif byte & 0x20:
+				if headers:
+					raise HPACKError('Table size update after headers')
+
+				max_size, offset = decode_integer(block, offset, 5)
+				self.resize(max_size)
+			#Literal header field without indexing or never indexed
+			else:
+				index, offset = decode_integer(block, offset, 4)
+				name, value, offset = self.literal(block, offset, index)
+				headers.append((name, value))
+
+		return headers
+
+class HPACKEncoder(object):
+	def __init__(self, max_size=default_header_table_size):
+		self.max_size = max_size
+
+		#Smallest and last size set since the last header block, which the decoder must be told about
+		self.resized = None
+		self.resized_min = None
+
+		#Dynamic table with the newest entry first
+		self.table = collections.deque()
+		self.size = 0
+
+	def add(self, name, value):
+		size = entry_size(name, value)
+
+		while self.table and self.size + size > self.max_size:
+			evicted_name, evicted_value = self.table.pop()
+			self.size -= entry_size(evicted_name, evicted_value)
+
+		if size <= self.max_size:
+			self.table.appendleft((name, value))
+			self.size += size
+
+	def resize(self, max_size):
+		self.max_size = max_size
+
+		while self.size > self.max_size:
+			evicted_name, evicted_value = self.table.pop()
+			self.size -= entry_size(evicted_name, evicted_value)
+
+		self.resized = max_size
+		self.resized_min = max_size if self.resized_min is None else min(self.resized_min, max_size)
+
+	def find(self, name, value):
+		#Returns the index of the whole header and the index of just its name (or 0)
+		index = static_index.get((name, value))
+		if index:
+			return index, index
+
+		name_index = static_names.get(name, 0)
+
+		for position, (entry_name, entry_value) in enumerate(self.table):
+			if entry_name == name:
+				if entry_value == value:
+					return len(static_table) + position + 1, name_index
+
+				if not name_index:
+					name_index = len(static_table) + position + 1
+
+		return 0, name_index
+
+	def encode(self, headers):
+		block = bytearray()
+
+		#Tell the decoder about any table size changes first
+		if self.resized is not None:
+			if self.resized_min < self.resized:
+				block += encode_integer(self.resized_min, 5, 0x20)
+			block += encode_integer(self.resized, 5, 0x20)
+
+			self.resized = None
+			self.resized_min = None
+
+		for name, value in headers:
+			index, name_index = self.find(name, value)
+
+			#Indexed header field
+			if index:
+				block += encode_integer(index, 7, 0x80)
+				continue
+
+			if name in unindexed_headers:
+				#Literal header field without indexing
+				block += encode_integer(name_index, 4)
+			else:
+				#Literal header field with incremental indexing
+				block += encode_integer(name_index, 6, 0x40)
+				self.add(name, value)
+
+			if not name_index:
+				block += encode_string(name.encode(web.http_encoding))
+			block += encode_string(value.encode(web.http_encoding))
+
+		return bytes(block)
+
+def build_frame(frame_type, flags, stream_id, payload=b''):
+	return len(payload).to_bytes(3, 'big') + bytes([frame_type, flags]) + stream_id.to_bytes(4, 'big') + payload
+
+def build_settings(settings):
+	return build_frame(frame_settings, 0, 0, b''.join(setting.to_bytes(2, 'big') + value.to_bytes(4, 'big') for setting, value in settings))
+
+def build_window_update(stream_id, increment):
+	return build_frame(frame_window_update, 0, stream_id, increment.to_bytes(4, 'big'))
+
+def build_rst_stream(stream_id, code):
+	return build_frame(frame_rst_stream, 0, stream_id, code.to_bytes(4, 'big'))
+
+def build_goaway(last_stream_id, code):
+	return build_frame(frame_goaway, 0, 0, last_stream_id.to_bytes(4, 'big') + code.to_bytes(4, 'big'))
+
+def parse_priority(value, urgency=3, incremental=False):
+	#Extensible priorities (RFC 9218) as sent in the priority header or a PRIORITY_UPDATE frame
+	for item in value.split(','):
+		key, equals, param = item.strip().partition('=')
+
+		if key == 'u':
+			try:
+				if 0 <= int(param) <= 7:
+					urgency = int(param)
+			except ValueError:
+				pass
+		elif key == 'i':
+			incremental = not equals or param == '?1'
+
+	return urgency, incremental
+
+class StreamReader(io.RawIOBase):
+	def __init__(self, stream):
+		self.stream = stream
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		stream = self.stream
+		session = stream.session
+
+		with session.lock:
+			deadline = time.monotonic() + stream.timeout if stream.timeout else None
+
+			#Wait for the multiplexer to receive more of the body
+			while not stream.inbox and not stream.remote_closed and not stream.reset and not session.closed:
+				remaining = deadline - time.monotonic() if deadline else None
+				if remaining is not None and remaining <= 0:
+					raise socket.timeout('timed out')
+
+				session.lock.wait(remaining)
+
+			if not stream.inbox:
+				if stream.remote_closed:
+					return 0
+
+				raise ConnectionResetError('Stream reset')
+
+			length = min(len(buffer), len(stream.inbox))
+			buffer[:length] = stream.inbox[:length]
+			del stream.inbox[:length]
+
+			#Let the client send as much as was just read
+			if not stream.remote_closed and not stream.deferred:
+				session.window_update(stream, length)
+
+		return length
+
+class StreamWriter(object):
+	def __init__(self, stream):
+		self.stream = stream
+
+		#Response headers that are sent with the first data or the end of the stream
+		self.head = None
+
+	def send_head(self, end_stream):
+		stream = self.stream
+		session = stream.session
+
+		block = session.encoder.encode(self.head)
+		self.head = None
+
+		#Header blocks go out with the other control frames so the header table stays in order
+		max_frame_size = session.max_frame_size
+		fragments = [block[offset:offset + max_frame_size] for offset in range(0, len(block), max_frame_size)] or [b'']
+
+		for number, fragment in enumerate(fragments):
+			flags = flag_end_headers if number == len(fragments) - 1 else 0
+
+			if number == 0:
+				session.control.append(build_frame(frame_headers, flags | (flag_end_stream if end_stream else 0), stream.id, fragment))
+			else:
+				session.control.append(build_frame(frame_continuation, flags, stream.id, fragment))
+
+	def write(self, data):
+		stream = self.stream
+		session = stream.session
+
+		data = memoryview(data)
+
+		with session.lock:
+			if self.head is not None:
+				self.send_head(False)
+
+			offset = 0
+			while offset < len(data):
+				size = min(session.wait_window(stream), len(data) - offset)
+
+				session.queue(stream, build_frame(frame_data, 0, stream.id, data[offset:offset + size]))
+
+				stream.send_window -= size
+				session.send_window -= size
+
+				offset += size
+
+		session.multiplexer.flush_later(session)
+
+		return len(data)
+
+	def finish(self):
+		stream = self.stream
+		session = stream.session
+
+		with session.lock:
+			if stream.reset or session.closed:
+				return
+
+			if self.head is not None:
+				#Nothing was written so the headers end the stream
+				self.send_head(True)
+			else:
+				session.queue(stream, build_frame(frame_data, flag_end_stream, stream.id))
+
+			#Stop the client sending a body that will never be read
+			if not stream.remote_closed:
+				session.queue(stream, build_rst_stream(stream.id, error_none))
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+class StreamResponse(web.web.HTTPResponse):
+	#A stream has no connection of its own to hand off
+	detachable = False
+
+	def __init__(self, stream):
+		self.connection = None
+		self.client_address = stream.client_address
+		self.server = stream.server
+
+		self.wfile = StreamWriter(stream)
+
+		self.request = stream
+
+	def write_head(self, status, status_msg):
+		headers = [(':status', str(status))]
+
+		#Header names are lower case in HTTP/2 and connection specific ones are left out
+		for key, value in self.headers.headers.items():
+			if key not in connection_headers:
+				headers.append((key, value))
+
+		self.wfile.head = headers
+
+	def write_chunk(self, chunk):
+		#Streams are framed by HTTP/2 so chunks are just data
+		return self.wfile.write(chunk)
+
+	def finish(self):
+		self.wfile.finish()
+
+class Stream(web.web.HTTPRequest):
+	def __init__(self, session, stream_id, headers, end_stream, bytes_in):
+		self.session = session
+		self.connection = None
+		self.client_address = session.client_address
+		self.server = session.server
+
+		self.timeout = self.server.request_timeout
+
+		self.id = stream_id
+
+		#Set by the server and its workers for timing requests
+		self.queued = None
+		self.dequeued = None
+		self.worker = None
+
+		self.count = session.count
+		self.received = None
+
+		self.deadline = None
+		self.idle = False
+
+		self.route = None
+		self.bytes_in = bytes_in
+
+		#A stream never goes back to the worker queue
+		self.keepalive = True
+		self.detached = False
+
+		#Error to respond with instead of routing the request
+		self.error = None
+
+		#Body received and not yet read and flow control for it
+		self.inbox = bytearray()
+		self.remote_closed = end_stream
+		self.recv_window = session.multiplexer.window_size
+
+		#Data frames waiting to be sent and flow control for them
+		self.outgoing = collections.deque()
+		self.send_window = session.initial_window_size
+
+		self.urgency = 3
+		self.incremental = False
+		self.serial = 0
+
+		self.reset = False
+
+		self.parse_headers(headers)
+
+		#Without a Content-Length, wait for the whole body so one can be given to the handler
+		self.deferred = not end_stream and self.headers.get('Content-Length') is None
+
+		self.rfile = io.BufferedReader(StreamReader(self))
+		self.response = StreamResponse(self)
+
+	def parse_headers(self, headers):
+		pseudo = {}
+
+		self.headers = web.HTTPHeaders()
+
+		for name, value in headers:
+			#HTTP Status 400 (as a stream error since the request is malformed)
+			if name != name.lower():
+				raise StreamError(error_protocol, 'Upper case header')
+
+			if name.startswith(':'):
+				if name in pseudo or name not in (':method', ':scheme', ':authority', ':path') or len(self.headers):
+					raise StreamError(error_protocol, 'Bad pseudo header')
+
+				pseudo[name] = value
+				continue
+
+			if name in connection_headers or (name == 'te' and value != 'trailers'):
+				raise StreamError(error_protocol, 'Connection header')
+
+			#HTTP Status 431
+			if len(self.headers) >= web.max_headers or len(name) + len(value) + 4 > web.max_line_size:
+				self.error = web.HTTPError(431)
+				continue
+
+			#Cookies may be split into many headers
+			previous = self.headers.get(name)
+			if previous is not None:
+				value = previous + ('; ' if name == 'cookie' else ', ') + value
+
+			self.headers.set(name, value)
+
+		if ':method' not in pseudo or ':path' not in pseudo or ':scheme' not in pseudo or not pseudo[':path']:
+			raise StreamError(error_protocol, 'Missing pseudo header')
+
+		self.method = pseudo[':method']
+		self.resource = pseudo[':path']
+		self.request_http = http2_version
+		self.request_line = self.method + ' ' + self.resource + ' ' + http2_version
+
+		if ':authority' in pseudo and self.headers.get('Host') is None:
+			self.headers.set('host', pseudo[':authority'])
+
+		#The body is read as it arrives so there is nothing to continue
+		if self.headers.get('Expect') is not None:
+			self.headers.remove('expect')
+
+		if self.headers.get('Priority') is not None:
+			self.urgency, self.incremental = parse_priority(self.headers.get('Priority'))
+
+	def handle(self, keepalive=True, initial_timeout=None):
+		self.received = time.perf_counter()
+
+		try:
+			if self.error:
+				raise self.error
+
+			self.find_handler()
+		#Use DummyHandler so the error is raised again when ready for response
+		except Exception as error:
+			self.handler = web.web.DummyHandler(self, self.response, (), error)
+		finally:
+			try:
+				self.response.handle()
+			finally:
+				#A response that failed part way can't be ended cleanly
+				if self.keepalive:
+					self.response.finish()
+				else:
+					self.session.cancel(self)
+
+				self.session.multiplexer.finish_later(self.session, self)
+
+				#The connection belongs to the multiplexer and not the worker
+				self.detached = True
+
+	def close(self):
+		pass
+
+class Session(object):
+	def __init__(self, multiplexer, request):
+		self.multiplexer = multiplexer
+		self.request = request
+		self.connection = request.connection
+		self.client_address = request.client_address
+		self.server = request.server
+
+		#Guards everything below between the multiplexer and the workers
+		self.lock = threading.Condition()
+
+		#Received bytes not yet parsed into frames
+		self.buffer = bytearray()
+		#Bytes being sent
+		self.pending = bytearray()
+		self.writing = False
+
+		#Frames sent before any data, in order, and streams with data frames waiting
+		self.control = collections.deque()
+		self.ready = set()
+		self.buffered = 0
+		self.serial = 0
+
+		self.decoder = HPACKDecoder()
+		self.encoder = HPACKEncoder()
+
+		#Open streams
+		self.streams = {}
+		self.last_stream_id = 0
+		self.count = 0
+
+		#Stream id, flags and fragments of a header block still waiting on continuations
+		self.continuation = None
+
+		self.settings_received = False
+
+		#Flow control and limits for what we send
+		self.send_window = default_window_size
+		self.initial_window_size = default_window_size
+		self.max_frame_size = default_max_frame_size
+
+		#Set once no more streams will be accepted and once everything left should be sent before closing
+		self.goaway = False
+		self.closing = False
+		self.closed = False
+
+	def queue(self, stream, frame):
+		stream.outgoing.append(frame)
+		self.ready.add(stream)
+		self.buffered += len(frame)
+
+	def wait_window(self, stream):
+		#Block the worker until the client lets it send more and the multiplexer has caught up
+		deadline = time.monotonic() + stream.timeout if stream.timeout else None
+
+		while True:
+			if stream.reset or self.closed:
+				raise ConnectionResetError('Stream reset')
+
+			window = min(stream.send_window, self.send_window, self.max_frame_size)
+			if window > 0 and self.buffered < self.multiplexer.max_pending:
+				return window
+
+			remaining = deadline - time.monotonic() if deadline else None
+			if remaining is not None and remaining <= 0:
+				raise socket.timeout('timed out')
+
+			#Make sure what is queued goes out so the client has something to acknowledge
+			self.multiplexer.flush_later(self)
+
+			self.lock.wait(remaining)
+
+	def window_update(self, stream, increment):
+		stream.recv_window += increment
+		self.control.append(build_window_update(stream.id, increment))
+
+		self.multiplexer.flush_later(self)
+
+	def cancel(self, stream):
+		with self.lock:
+			if not stream.reset and not self.closed:
+				self.reset(stream.id, error_internal)
+
+	def reset(self, stream_id, code):
+		self.control.append(build_rst_stream(stream_id, code))
+
+		stream = self.streams.pop(stream_id, None)
+		if stream:
+			self.drop(stream)
+
+	def drop(self, stream):
+		stream.reset = True
+
+		self.buffered -= sum(len(frame) for frame in stream.outgoing)
+		stream.outgoing.clear()
+		self.ready.discard(stream)
+
+		self.lock.notify_all()
+
+	def fail(self, code):
+		#Tell the client which streams were seen and send what is left before closing
+		self.control.append(build_goaway(self.last_stream_id, code))
+
+		self.goaway = True
+		self.closing = True
+
+		for stream in list(self.streams.values()):
+			self.drop(stream)
+		self.streams.clear()
+
+	def next_frames(self, limit=65536):
+		#Control frames go first and then data from the most urgent stream, taking turns between incremental ones
+		frames = []
+		size = 0
+
+		while size < limit:
+			if self.control:
+				frame = self.control.popleft()
+			elif self.ready:
+				stream = min(self.ready, key=lambda stream: (stream.urgency, stream.serial if stream.incremental else 0, stream.id))
+
+				frame = stream.outgoing.popleft()
+				self.buffered -= len(frame)
+
+				self.serial += 1
+				stream.serial = self.serial
+
+				if not stream.outgoing:
+					self.ready.discard(stream)
+			else:
+				break
+
+			frames.append(frame)
+			size += len(frame)
+
+		if frames:
+			#Workers may be waiting on the buffer to drain
+			self.lock.notify_all()
+
+		return b''.join(frames)
+
+	def feed(self, data):
+		self.buffer += data
+
+		while len(self.buffer) >= 9 and not self.closing:
+			length = int.from_bytes(self.buffer[:3], 'big')
+			if length > default_max_frame_size:
+				raise HTTP2Error(error_frame_size, 'Frame too large')
+
+			if len(self.buffer) < 9 + length:
+				break
+
+			frame_type = self.buffer[3]
+			flags = self.buffer[4]
+			stream_id = int.from_bytes(self.buffer[5:9], 'big') & 0x7fffffff
+			payload = bytes(self.buffer[9:9 + length])
+
+			del self.buffer[:9 + length]
+
+			#The client preface ends with its settings
+			if not self.settings_received and frame_type != frame_settings:
+				raise HTTP2Error(error_protocol, 'Expected settings')
+
+			try:
+				self.frame(frame_type, flags, stream_id, payload)
+			except StreamError as error:
+				self.reset(stream_id, error.code)
+
+	def frame(self, frame_type, flags, stream_id, payload):
+		#Nothing may come between a header block and its continuations
+		if self.continuation and frame_type != frame_continuation:
+			raise HTTP2Error(error_protocol, 'Expected continuation')
+
+		if frame_type == frame_data:
+			self.frame_data(flags, stream_id, payload)
+		elif frame_type == frame_headers:
+			self.frame_headers(flags, stream_id, payload)
+		elif frame_type == frame_priority:
+			self.frame_priority(flags, stream_id, payload)
+		elif frame_type == frame_rst_stream:
+			self.frame_rst_stream(flags, stream_id, payload)
+		elif frame_type == frame_settings:
+			self.frame_settings(flags, stream_id, payload)
+		elif frame_type == frame_push_promise:
+			raise HTTP2Error(error_protocol, 'Client push')
+		elif frame_type == frame_ping:
+			self.frame_ping(flags, stream_id, payload)
+		elif frame_type == frame_goaway:
+			self.frame_goaway(flags, stream_id, payload)
+		elif frame_type == frame_window_update:
+			self.frame_window_update(flags, stream_id, payload)
+		elif frame_type == frame_continuation:
+			self.frame_continuation(flags, stream_id, payload)
+		elif frame_type == frame_priority_update:
+			self.frame_priority_update(flags, stream_id, payload)
+		#Unknown frame types are ignored
+
+	def unpad(self, flags, payload):
+		if not flags & flag_padded:
+			return payload
+
+		if not payload or payload[0] >= len(payload):
+			raise HTTP2Error(error_protocol, 'Bad padding')
+
+		return payload[1:len(payload) - payload[0]]
+
+	def idle(self, stream_id):
+		#Streams above the last one opened have never been used
+		return stream_id > self.last_stream_id
+
+	def frame_data(self, flags, stream_id, payload):
+		if not stream_id:
+			raise HTTP2Error(error_protocol, 'Data on connection')
+
+		#The connection window is given back right away since streams are limited by their own windows
+		if payload:
+			self.control.append(build_window_update(0, len(payload)))
+
+		data = self.unpad(flags, payload)
+
+		stream = self.streams.get(stream_id)
+		if not stream or stream.remote_closed:
+			if self.idle(stream_id):
+				raise HTTP2Error(error_protocol, 'Data on idle stream')
+
+			raise StreamError(error_stream_closed)
+
+		#Flow control counts the whole frame including padding
+		if len(payload) > stream.recv_window:
+			raise StreamError(error_flow_control)
+
+		stream.recv_window -= len(payload)
+		stream.inbox += data
+
+		if flags & flag_end_stream:
+			stream.remote_closed = True
+		elif stream.deferred:
+			#The body is buffered here so the client can keep sending up to the request limit
+			if len(stream.inbox) > web.max_request_size:
+				stream.error = web.HTTPError(413)
+				stream.deferred = False
+				self.dispatch(stream)
+			else:
+				self.window_update(stream, len(payload))
+		elif len(payload) > len(data):
+			#Padding is never read so give it back right away
+			self.window_update(stream, len(payload) - len(data))
+
+		if stream.deferred and stream.remote_closed:
+			stream.headers.set('Content-Length', str(len(stream.inbox)))
+			stream.deferred = False
+			self.dispatch(stream)
+
+		self.lock.notify_all()
+
+	def frame_headers(self, flags, stream_id, payload):
+		if not stream_id % 2:
+			raise HTTP2Error(error_protocol, 'Bad stream id')
+
+		data = self.unpad(flags, payload)
+
+		#Priority signals from RFC 7540 are deprecated and ignored in favor of the priority header
+		if flags & flag_priority:
+			if len(data) < 5:
+				raise HTTP2Error(error_frame_size, 'Bad priority')
+
+			data = data[5:]
+
+		self.continuation = (stream_id, flags, bytearray(data))
+
+		if flags & flag_end_headers:
+			self.end_headers()
+
+	def frame_continuation(self, flags, stream_id, payload):
+		if not self.continuation or self.continuation[0] != stream_id:
+			raise HTTP2Error(error_protocol, 'Unexpected continuation')
+
+		block = self.continuation[2]
+		block += payload
+
+		if len(block) > max_header_block_size:
+			raise HTTP2Error(error_enhance_your_calm, 'Header block too large')
+
+		if flags & flag_end_headers:
+			self.end_headers()
+
+	def end_headers(self):
+		stream_id, flags, block = self.continuation
+		self.continuation = None
+
+		#Always decode so the header table stays in step with the client
+		headers = self.decoder.decode(block)
+
+		end_stream = bool(flags & flag_end_stream)
+
+		#Trailers end the body and are otherwise ignored
+		stream = self.streams.get(stream_id)
+		if not stream and not self.idle(stream_id):
+			raise StreamError(error_stream_closed)
+
+		if stream:
+			if not end_stream or stream.remote_closed:
+				raise StreamError(error_protocol, 'Bad trailers')
+
+			stream.remote_closed = True
+
+			if stream.deferred:
+				stream.headers.set('Content-Length', str(len(stream.inbox)))
+				stream.deferred = False
+				self.dispatch(stream)
+
+			self.lock.notify_all()
+			return
+
+		self.last_stream_id = stream_id
+
+		#Streams opened after going away are never processed
+		if self.goaway:
+			return
+
+		if len(self.streams) >= self.multiplexer.max_streams:
+			raise StreamError(error_refused_stream)
+
+		self.count += 1
+
+		stream = Stream(self, stream_id, headers, end_stream, len(block))
+		self.streams[stream_id] = stream
+
+		if not stream.deferred:
+			self.dispatch(stream)
+
+	def dispatch(self, stream):
+		#Handle the stream on the server's workers like any other request
+		stream.queued = time.perf_counter()
+		self.server.request_queue.put((stream, False, None))
+
+	def frame_priority(self, flags, stream_id, payload):
+		if not stream_id:
+			raise HTTP2Error(error_protocol, 'Priority on connection')
+
+		if len(payload) != 5:
+			raise StreamError(error_frame_size)
+
+	def frame_priority_update(self, flags, stream_id, payload):
+		if stream_id or len(payload) < 4:
+			raise HTTP2Error(error_protocol, 'Bad priority update')
+
+		stream = self.streams.get(int.from_bytes(payload[:4], 'big') & 0x7fffffff)
+		if stream:
+			stream.urgency, stream.incremental = parse_priority(payload[4:].decode(web.http_encoding), stream.urgency, stream.incremental)
+
+	def frame_rst_stream(self, flags, stream_id, payload):
+		if len(payload) != 4:
+			raise HTTP2Error(error_frame_size, 'Bad reset')
+
+		if not stream_id or self.idle(stream_id):
+			raise HTTP2Error(error_protocol, 'Reset of idle stream')
+
+		stream = self.streams.pop(stream_id, None)
+		if stream:
+			self.drop(stream)
+
+	def frame_settings(self, flags, stream_id, payload):
+		if stream_id:
+			raise HTTP2Error(error_protocol, 'Settings on stream')
+
+		if flags & flag_ack:
+			if payload:
+				raise HTTP2Error(error_frame_size, 'Settings acknowledgement with payload')
+
+			return
+
+		if len(payload) % 6:
+			raise HTTP2Error(error_frame_size, 'Bad settings')
+
+		for offset in range(0, len(payload), 6):
+			setting = int.from_bytes(payload[offset:offset + 2], 'big')
+			value = int.from_bytes(payload[offset + 2:offset + 6], 'big')
+
+			if setting == setting_header_table_size:
+				self.encoder.resize(min(value, default_header_table_size))
+			elif setting == setting_enable_push:
+				if value > 1:
+					raise HTTP2Error(error_protocol, 'Bad push setting')
+			elif setting == setting_initial_window_size:
+				if value > max_window_size:
+					raise HTTP2Error(error_flow_control, 'Window too large')
+
+				#Changes apply to the windows of open streams too
+				for stream in self.streams.values():
+					stream.send_window += value - self.initial_window_size
+					if stream.send_window > max_window_size:
+						raise HTTP2Error(error_flow_control, 'Window too large')
+
+				self.initial_window_size = value
+			elif setting == setting_max_frame_size:
+				if value < default_max_frame_size or value > max_max_frame_size:
+					raise HTTP2Error(error_protocol, 'Bad frame size')
+
+				self.max_frame_size = value
+
+		self.settings_received = True
+
+		self.control.append(build_frame(frame_settings, flag_ack, 0))
+
+		self.lock.notify_all()
+
+	def frame_ping(self, flags, stream_id, payload):
+		if stream_id:
+			raise HTTP2Error(error_protocol, 'Ping on stream')
+
+		if len(payload) != 8:
+			raise HTTP2Error(error_frame_size, 'Bad ping')
+
+		if not flags & flag_ack:
+			self.control.append(build_frame(frame_ping, flag_ack, 0, payload))
+
+	def frame_goaway(self, flags, stream_id, payload):
+		if stream_id:
+			raise HTTP2Error(error_protocol, 'Go away on stream')
+
+		#Finish the open streams and then close
+		self.goaway = True
+
+		if not self.streams:
+			self.closing = True
+
+	def frame_window_update(self, flags, stream_id, payload):
+		if len(payload) != 4:
+			raise HTTP2Error(error_frame_size, 'Bad window update')
+
+		increment = int.from_bytes(payload, 'big') & 0x7fffffff
+
+		if not stream_id:
+			if not increment:
+				raise HTTP2Error(error_protocol, 'Empty window update')
+
+			self.send_window += increment
+			if self.send_window > max_window_size:
+				raise HTTP2Error(error_flow_control, 'Window too large')
+		else:
+			if self.idle(stream_id):
+				raise HTTP2Error(error_protocol, 'Window update on idle stream')
+
+			if not increment:
+				raise StreamError(error_protocol)
+
+			stream = self.streams.get(stream_id)
+			if stream:
+				stream.send_window += increment
+				if stream.send_window > max_window_size:
+					raise StreamError(error_flow_control)
+
+		self.lock.notify_all()
+
+class Multiplexer(object):
+	def __init__(self, max_streams=100, window_size=default_window_size, connection_window_size=16777216, max_pending=1048576, poll_interval=0.1):
+		self.max_streams = max_streams
+		self.window_size = window_size
+		self.connection_window_size = connection_window_size
+		self.max_pending = max_pending
+		self.poll_interval = poll_interval
+
+		#Open sessions
+		self.sessions = set()
+
+		self.selector = None
+
+		#Requests from other threads are queued and the multiplexer thread woken up to handle them
+		self.incoming = collections.deque()
+		self.wakeup_read, self.wakeup_write = socket.socketpair()
+		self.wakeup_read.setblocking(False)
+		self.wakeup_write.setblocking(False)
+
+		self.multiplexer_thread = None
+		self.multiplexer_shutdown = False
+
+	def start(self):
+		if self.is_running():
+			return
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+
+		self.multiplexer_shutdown = False
+
+		self.multiplexer_thread = threading.Thread(target=self.multiplexer, name='HTTP2-Multiplexer')
+		self.multiplexer_thread.start()
+
+	def stop(self, timeout=None):
+		if not self.is_running():
+			return
+
+		self.multiplexer_shutdown = True
+		self.wakeup()
+
+		self.multiplexer_thread.join(timeout)
+		self.multiplexer_thread = None
+
+	def close(self, timeout=None):
+		self.stop(timeout)
+
+		self.wakeup_read.close()
+		self.wakeup_write.close()
+
+	def is_running(self):
+		return bool(self.multiplexer_thread and self.multiplexer_thread.is_alive())
+
+	def wakeup(self):
+		try:
+			self.wakeup_write.send(b'\0')
+		except BlockingIOError:
+			#Already plenty of wakeups pending
+			pass
+
+	def attach(self, request):
+		#Called by HTTPRequest on a worker after reading the first line of the preface
+		try:
+			if request.rfile.read(len(preface_rest)) != preface_rest:
+				return False
+		except OSError:
+			return False
+
+		#Take anything the request file read past the preface without blocking
+		request.connection.setblocking(False)
+		leftover = request.rfile.read1(65536) or b''
+
+		self.incoming.append((self.add, (Session(self, request), leftover)))
+		self.wakeup()
+
+		return True
+
+	def flush_later(self, session):
+		self.incoming.append((self.flush, (session,)))
+		self.wakeup()
+
+	def finish_later(self, session, stream):
+		self.incoming.append((self.finish, (session, stream)))
+		self.wakeup()
+
+	def drain(self):
+		#Called by HTTPServer.drain so clients stop opening streams and each session closes once its open streams finish
+		self.incoming.append((self.go_away, ()))
+		self.wakeup()
+
+	def wait(self, timeout=None):
+		#Wait for drained sessions to finish their streams and close
+		end = time.monotonic() + timeout if timeout is not None else None
+		while self.sessions and self.is_running() and (end is None or time.monotonic() < end):
+			time.sleep(self.poll_interval)
+
+		return not self.sessions
+
+	def multiplexer(self):
+		try:
+			while not self.multiplexer_shutdown:
+				for key, mask in self.selector.select(self.poll_interval):
+					if key.fileobj is self.wakeup_read:
+						try:
+							while self.wakeup_read.recv(4096):
+								pass
+						except BlockingIOError:
+							pass
+					else:
+						if mask & selectors.EVENT_READ:
+							self.read(key.data)
+						#Reading may have closed the session
+						if mask & selectors.EVENT_WRITE and key.data in self.sessions:
+							self.flush(key.data)
+
+				#Handle new sessions and writes from workers
+				while self.incoming:
+					function, args = self.incoming.popleft()
+					function(*args)
+		finally:
+			for session in list(self.sessions):
+				try:
+					session.connection.send(build_goaway(session.last_stream_id, error_none))
+				except OSError:
+					pass
+
+				self.remove(session)
+
+			self.selector.close()
+
+	def add(self, session, leftover):
+		self.selector.register(session.connection, selectors.EVENT_READ, session)
+		self.sessions.add(session)
+
+		with session.lock:
+			settings = [(setting_max_concurrent_streams, self.max_streams)]
+			if self.window_size != default_window_size:
+				settings.append((setting_initial_window_size, self.window_size))
+
+			session.control.append(build_settings(settings))
+
+			#Streams have their own windows so the connection window only needs to be large
+			if self.connection_window_size > default_window_size:
+				session.control.append(build_window_update(0, self.connection_window_size - default_window_size))
+
+		if leftover:
+			self.feed(session, leftover)
+		else:
+			self.flush(session)
+
+	def read(self, session):
+		try:
+			data = session.connection.recv(65536)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b''
+
+		if not data:
+			self.remove(session)
+			return
+
+		self.feed(session, data)
+
+	def feed(self, session, data):
+		with session.lock:
+			try:
+				session.feed(data)
+			except HTTP2Error as error:
+				session.fail(error.code)
+			except Exception:
+				session.server.log.exception()
+				session.fail(error_internal)
+
+		self.flush(session)
+
+	def go_away(self):
+		for session in list(self.sessions):
+			with session.lock:
+				#Streams the client opens after this are never processed (see Session.frame_headers) so it knows to retry them elsewhere
+				if not session.goaway:
+					session.control.append(build_goaway(session.last_stream_id, error_none))
+					session.goaway = True
+
+				if not session.streams:
+					session.closing = True
+
+			self.flush(session)
+
+	def finish(self, session, stream):
+		with session.lock:
+			if session.streams.get(stream.id) is stream:
+				del session.streams[stream.id]
+
+			#Close once the client went away and the last stream is done
+			if session.goaway and not session.streams:
+				session.closing = True
+
+		self.flush(session)
+
+	def flush(self, session):
+		if session not in self.sessions:
+			return
+
+		while True:
+			if not session.pending:
+				with session.lock:
+					session.pending += session.next_frames()
+
+				if not session.pending:
+					break
+
+			try:
+				sent = session.connection.send(session.pending)
+			except BlockingIOError:
+				sent = 0
+			except OSError:
+				self.remove(session)
+				return
+
+			del session.pending[:sent]
+
+			#Wait for the socket to take more
+			if session.pending:
+				if not session.writing:
+					session.writing = True
+					self.selector.modify(session.connection, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+
+				return
+
+		if session.writing:
+			session.writing = False
+			self.selector.modify(session.connection, selectors.EVENT_READ, session)
+
+		if session.closing:
+			self.remove(session)
+
+	def remove(self, session):
+		if session not in self.sessions:
+			return
+
+		self.sessions.discard(session)
+		self.selector.unregister(session.connection)
+
+		with session.lock:
+			session.closed = True
+
+			for stream in list(session.streams.values()):
+				session.drop(stream)
+			session.streams.clear()
+
+			session.lock.notify_all()
+
+		try:
+			session.connection.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		session.request.close()
+		session.connection.close()
@@ -0,0 +1,189 @@
+import bisect
+import threading
+
+import web
+
+#Upper bounds in seconds of the request latency histogram buckets
+default_buckets = [ 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+metrics_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+class MetricsShard(object):
+	def __init__(self, thread):
+		self.thread = thread
+
+		#(name, labels) -> value
+		self.counters = {}
+		#labels -> [bucket counts..., +Inf count, sum]
+		self.histograms = {}
+
+class Metrics(object):
+	def __init__(self, buckets=default_buckets):
+		self.buckets = list(buckets)
+
+		#Each thread counts into its own shard so counting never takes a lock
+		self.local = threading.local()
+		self.shards = []
+		self.shards_lock = threading.Lock()
+
+		#Totals of shards whose threads have exited
+		self.retired = MetricsShard(None)
+
+	def shard(self):
+		try:
+			return self.local.shard
+		except AttributeError:
+			shard = MetricsShard(threading.current_thread())
+
+			with self.shards_lock:
+				self.shards.append(shard)
+
+			self.local.shard = shard
+
+			return shard
+
+	def inc(self, name, labels=(), value=1):
+		counters = self.shard().counters
+		key = name, labels
+
+		counters[key] = counters.get(key, 0) + value
+
+	def observe(self, labels, value):
+		histograms = self.shard().histograms
+
+		try:
+			histogram = histograms[labels]
+		except KeyError:
+			histogram = [0] * (len(self.buckets) + 2)
+			histograms[labels] = histogram
+
+		#Count only the matching bucket and leave accumulating for exposition
+		histogram[bisect.bisect_left(self.buckets, value)] += 1
+		histogram[-1] += value
+
+	def request(self, request, status, bytes_out, duration):
+		route = request.route or ''
+
+		self.inc('http_requests_total', (('route', route), ('method', request.method), ('code', str(status))))
+		self.observe((('route', route),), duration)
+
+		bytes_in = request.bytes_in
+		try:
+			bytes_in += int(request.headers.get('Content-Length', '0'))
+		except ValueError:
+			pass
+
+		self.inc('http_request_bytes_total', value=bytes_in)
+		self.inc('http_response_bytes_total', value=bytes_out)
+
+		if request.count > 1:
+			self.inc('http_keepalive_reused_total')
+
+	def merge(self, into, shard):
+		#Copying a dict is atomic, so shards can be read while their threads count
+		for key, value in dict(shard.counters).items():
+			into.counters[key] = into.counters.get(key, 0) + value
+
+		for labels, histogram in dict(shard.histograms).items():
+			try:
+				total = into.histograms[labels]
+			except KeyError:
+				total = [0] * (len(self.buckets) + 2)
+				into.histograms[labels] = total
+
+			for i, value in enumerate(list(histogram)):
+				total[i] += value
+
+	def collect(self):
+		totals = MetricsShard(None)
+
+		with self.shards_lock:
+			#Fold shards of dead threads into the retired totals so they don't pile up
+			for shard in self.shards:
+				if not shard.thread.is_alive():
+					self.merge(self.retired, shard)
+			self.shards = [shard for shard in self.shards if shard.thread.is_alive()]
+
+			self.merge(totals, self.retired)
+			for shard in self.shards:
+				self.merge(totals, shard)
+
+		return totals
+
+	def render(self, server=None):
+		totals = self.collect()
+
+		lines = []
+
+		def metric(name, kind, help, samples):
+			lines.append('# HELP ' + name + ' ' + help)
+			lines.append('# TYPE ' + name + ' ' + kind)
+			for sample_name, labels, value in samples:
+				lines.append(sample_name + format_labels(labels) + ' ' + format_value(value))
+
+		counters = {}
+		for (name, labels), value in sorted(totals.counters.items()):
+			counters.setdefault(name, []).append((name, labels, value))
+
+		metric('http_requests_total', 'counter', 'Total HTTP requests by route, method and status code.', counters.get('http_requests_total', []))
+		metric('http_request_bytes_total', 'counter', 'Total bytes of request heads and declared bodies received.', counters.get('http_request_bytes_total', [('http_request_bytes_total', (), 0)]))
+		metric('http_response_bytes_total', 'counter', 'Total bytes of response bodies sent.', counters.get('http_response_bytes_total', [('http_response_bytes_total', (), 0)]))
+		metric('http_keepalive_reused_total', 'counter', 'Total requests served on a reused keepalive connection.', counters.get('http_keepalive_reused_total', [('http_keepalive_reused_total', (), 0)]))
+
+		samples = []
+		for labels, histogram in sorted(totals.histograms.items()):
+			count = 0
+			for bound, value in zip(self.buckets + [ '+Inf' ], histogram):
+				count += value
+				samples.append(('http_request_duration_seconds_bucket', labels + (('le', format_value(bound)),), count))
+			samples.append(('http_request_duration_seconds_sum', labels, histogram[-1]))
+			samples.append(('http_request_duration_seconds_count', labels, count))
+		metric('http_request_duration_seconds', 'histogram', 'Time from receiving a request to writing its response.', samples)
+
+		if server:
+			metric('http_request_queue_depth', 'gauge', 'Connections waiting for a worker.', [('http_request_queue_depth', (), server.request_queue.qsize())])
+			metric('http_workers', 'gauge', 'Live worker threads.', [('http_workers', (), sum(1 for thread in server.worker_threads or [] if thread.is_alive()))])
+			metric('http_resource_locks', 'gauge', 'Resources currently locked.', [('http_resource_locks', (), len(server.res_lock.locks))])
+			metric('http_resource_lock_contended_total', 'counter', 'Times a request had to wait on a resource lock.', [('http_resource_lock_contended_total', (), server.res_lock.contended)])
+			metric('http_resource_lock_contended_seconds_total', 'counter', 'Total time requests spent waiting on resource locks.', [('http_resource_lock_contended_seconds_total', (), server.res_lock.contended_time)])
+			metric('http_slow_requests_total', 'counter', 'Requests that ran past the slow request timeout.', [('http_slow_requests_total', (), server.slow_requests)])
+			metric('http_stuck_workers', 'gauge', 'Workers currently running past the slow request timeout.', [('http_stuck_workers', (), server.stuck_workers)])
+			metric('http_connections_accepted_total', 'counter', 'Connections accepted from the listen backlog.', [('http_connections_accepted_total', (), server.accepted)])
+			metric('http_accept_wakeups_total', 'counter', 'Times the listening socket was ready to accept connections.', [('http_accept_wakeups_total', (), server.accept_wakeups)])
+			metric('http_accept_errors_total', 'counter', 'Accepts that failed.', [('http_accept_errors_total', (), server.accept_errors)])
+			metric('http_open_connections', 'gauge', 'Connections open and counted against the connection limits.', [('http_open_connections', (), len(server.connections))])
+			metric('http_connections_evicted_total', 'counter', 'Idle connections closed to make room for new ones.', [('http_connections_evicted_total', (), server.evicted)])
+			metric('http_connections_refused_total', 'counter', 'Connections refused for being over the connection limits.', [('http_connections_refused_total', (), server.refused)])
+			metric('http_slow_clients_total', 'counter', 'Clients cut off for sending a request head or body too slowly.', [('http_slow_clients_total', (), server.slow_clients)])
+
+		return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+	if not labels:
+		return ''
+
+	return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels) + '}'
+
+def format_value(value):
+	if isinstance(value, str):
+		return value
+
+	if isinstance(value, float):
+		return repr(value)
+
+	return str(value)
+
+class MetricsHandler(web.HTTPHandler):
+	def do_get(self):
+		metrics = self.request.server.metrics
+
+		#HTTP Status 404
+		if not metrics:
+			raise web.HTTPError(404)
+
+		self.response.headers.set('Content-Type', metrics_content_type)
+
+		return 200, metrics.render(self.request.server)
+
+def new(remote='/metrics', handler=MetricsHandler):
+	return {remote: handler}
@@ -0,0 +1,165 @@
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+
+import web
+
+collapsed_content_type = 'text/plain; charset=utf-8'
+
+class Profiler(object):
+	def __init__(self, interval=0.01, thread_name='HTTPServer-Worker', idle=False, max_depth=128):
+		self.interval = interval
+		self.thread_name = thread_name
+		self.idle = idle
+		self.max_depth = max_depth
+
+		#Tuple of code objects from root to leaf -> number of samples
+		self.stacks = {}
+		self.stacks_lock = threading.Lock()
+
+		self.samples = 0
+
+		self.sampler_thread = None
+		self.sampler_shutdown = threading.Event()
+
+	def start(self):
+		if self.is_running():
+			return
+
+		self.sampler_shutdown.clear()
+
+		self.sampler_thread = threading.Thread(target=self.sampler, name='Profiler-Sampler', daemon=True)
+		self.sampler_thread.start()
+
+	def stop(self, timeout=None):
+		if not self.is_running():
+			return
+
+		self.sampler_shutdown.set()
+		self.sampler_thread.join(timeout)
+		self.sampler_thread = None
+
+	def is_running(self):
+		return bool(self.sampler_thread and self.sampler_thread.is_alive())
+
+	def clear(self):
+		with self.stacks_lock:
+			self.stacks = {}
+			self.samples = 0
+
+	def sampler(self):
+		while not self.sampler_shutdown.wait(self.interval):
+			self.sample()
+
+	def sample(self):
+		#Match threads by name since workers are replaced when they die or the pool grows
+		idents = set(thread.ident for thread in threading.enumerate() if thread.name == self.thread_name)
+
+		frames = sys._current_frames()
+
+		with self.stacks_lock:
+			for ident in idents:
+				frame = frames.get(ident)
+				if frame is None:
+					continue
+
+				#Walk from the leaf to the root, keeping only code objects so sampling stays cheap
+				stack = []
+				while frame and len(stack) < self.max_depth:
+					stack.append(frame.f_code)
+					frame = frame.f_back
+
+				if not self.idle and is_idle(stack):
+					continue
+
+				stack = tuple(reversed(stack))
+				self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+			self.samples += 1
+
+	def collapsed(self):
+		with self.stacks_lock:
+			stacks = list(self.stacks.items())
+
+		#Brendan Gregg's collapsed stack format as read by flamegraph.pl and speedscope
+		lines = sorted(';'.join(format_code(code) for code in stack) + ' ' + str(count) for stack, count in stacks)
+
+		return ''.join(line + '\n' for line in lines)
+
+def is_idle(stack):
+	#A worker is idle if it is waiting on the request queue directly from its loop
+	for callee, caller in zip(stack, stack[1:]):
+		if caller is web.HTTPServer.worker.__code__:
+			return callee is queue.Queue.get.__code__
+
+	return False
+
+def format_code(code):
+	return code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')'
+
+class ProfilerHandler(web.HTTPHandler):
+	profiler = None
+	max_seconds = 60
+
+	def do_get(self):
+		action, query_string = self.groups
+
+		#HTTP Status 404
+		if action:
+			raise web.HTTPError(404)
+
+		query = urllib.parse.parse_qs(query_string or '')
+
+		#Profile for a fixed window if requested
+		if 'seconds' in query:
+			try:
+				seconds = float(query['seconds'][0])
+			except ValueError:
+				raise web.HTTPError(400)
+
+			#HTTP Status 400
+			if seconds <= 0 or seconds > self.max_seconds:
+				raise web.HTTPError(400)
+
+			#HTTP Status 409
+			if self.profiler.is_running():
+				raise web.HTTPError(409)
+
+			self.profiler.clear()
+			self.profiler.start()
+			time.sleep(seconds)
+			self.profiler.stop()
+
+		self.response.headers.set('Content-Type', collapsed_content_type)
+		self.response.headers.set('X-Profiler-Samples', str(self.profiler.samples))
+
+		return 200, self.profiler.collapsed()
+
+	def do_post(self):
+		action, query_string = self.groups
+
+		if action == 'start':
+			self.profiler.start()
+		elif action == 'stop':
+			self.profiler.stop()
+		elif action == 'clear':
+			self.profiler.clear()
+		#HTTP Status 404
+		else:
+			raise web.HTTPError(404)
+
+		return 204, ''
+
+def new(profiler=None, remote='/profile', handler=ProfilerHandler):
+	if profiler is None:
+		profiler = Profiler()
+
+	class GenProfilerHandler(handler):
+		pass
+
+	GenProfilerHandler.profiler = profiler
+
+	return {remote + '(?:/(start|stop|clear))?(?:\\?(.*))?': GenProfilerHandler}
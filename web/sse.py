@@ -0,0 +1,268 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+import web
+
+event_stream_content_type = 'text/event-stream'
+
+def format_event(data, event=None, id=None, retry=None):
+	lines = []
+
+	if id is not None:
+		lines.append('id: ' + str(id))
+	if event:
+		lines.append('event: ' + event)
+	if retry is not None:
+		lines.append('retry: ' + str(int(retry)))
+
+	#Each line of data needs its own field
+	for line in str(data).split('\n'):
+		lines.append('data: ' + line)
+
+	return '\n'.join(lines) + '\n\n'
+
+def format_chunk(data):
+	return ('{:x}'.format(len(data)) + '\r\n').encode(web.http_encoding) + data + '\r\n'.encode(web.http_encoding)
+
+#A comment line that keeps idle connections and proxies from timing out
+heartbeat_chunk = format_chunk(b':\n\n')
+
+class Subscriber(object):
+	def __init__(self, request, topic):
+		self.request = request
+		self.connection = request.connection
+		self.topic = topic
+
+		#Bytes that could not be sent yet
+		self.pending = bytearray()
+
+class Broadcaster(object):
+	def __init__(self, heartbeat=15, max_pending=262144):
+		self.heartbeat = heartbeat
+		self.max_pending = max_pending
+
+		#Topic -> set of subscribers
+		self.topics = {}
+
+		self.subscribers = 0
+		self.dropped = 0
+
+		self.selector = None
+
+		#Requests from other threads are queued and the broadcaster thread woken up to handle them
+		self.incoming = collections.deque()
+		self.wakeup_read, self.wakeup_write = socket.socketpair()
+		self.wakeup_read.setblocking(False)
+		self.wakeup_write.setblocking(False)
+
+		self.broadcaster_thread = None
+		self.broadcaster_shutdown = False
+
+	def start(self):
+		if self.is_running():
+			return
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+
+		self.broadcaster_shutdown = False
+
+		self.broadcaster_thread = threading.Thread(target=self.broadcaster, name='SSE-Broadcaster')
+		self.broadcaster_thread.start()
+
+	def stop(self, timeout=None):
+		if not self.is_running():
+			return
+
+		self.broadcaster_shutdown = True
+		self.wakeup()
+
+		self.broadcaster_thread.join(timeout)
+		self.broadcaster_thread = None
+
+	def close(self, timeout=None):
+		self.stop(timeout)
+
+		self.wakeup_read.close()
+		self.wakeup_write.close()
+
+	def is_running(self):
+		return bool(self.broadcaster_thread and self.broadcaster_thread.is_alive())
+
+	def wakeup(self):
+		try:
+			self.wakeup_write.send(b'\0')
+		except BlockingIOError:
+			#Already plenty of wakeups pending
+			pass
+
+	def subscribe(self, request, topic):
+		self.incoming.append((self.add, (request, topic)))
+		self.wakeup()
+
+	def publish(self, topic, data, event=None, id=None, retry=None):
+		#Encode once for every subscriber
+		chunk = format_chunk(format_event(data, event, id, retry).encode(web.default_encoding))
+
+		self.incoming.append((self.fan_out, (topic, chunk)))
+		self.wakeup()
+
+	def broadcaster(self):
+		next_heartbeat = time.monotonic() + self.heartbeat
+
+		try:
+			while not self.broadcaster_shutdown:
+				for key, mask in self.selector.select(max(0, next_heartbeat - time.monotonic())):
+					if key.fileobj is self.wakeup_read:
+						try:
+							while self.wakeup_read.recv(4096):
+								pass
+						except BlockingIOError:
+							pass
+					else:
+						if mask & selectors.EVENT_READ:
+							self.read(key.data)
+						if mask & selectors.EVENT_WRITE:
+							self.flush(key.data)
+
+				#Handle subscriptions and publishes from other threads
+				while self.incoming:
+					function, args = self.incoming.popleft()
+					function(*args)
+
+				if time.monotonic() >= next_heartbeat:
+					for subscribers in list(self.topics.values()):
+						for subscriber in list(subscribers):
+							self.write(subscriber, heartbeat_chunk)
+
+					next_heartbeat = time.monotonic() + self.heartbeat
+		finally:
+			#Close every connection cleanly with the last chunk
+			for subscribers in list(self.topics.values()):
+				for subscriber in list(subscribers):
+					if not subscriber.pending:
+						try:
+							subscriber.connection.send(format_chunk(b''))
+						except OSError:
+							pass
+
+					self.remove(subscriber)
+
+			self.selector.close()
+
+	def add(self, request, topic):
+		subscriber = Subscriber(request, topic)
+
+		#Only the broadcaster thread touches the connection from now on
+		subscriber.connection.setblocking(False)
+
+		self.selector.register(subscriber.connection, selectors.EVENT_READ, subscriber)
+		self.topics.setdefault(topic, set()).add(subscriber)
+
+		self.subscribers += 1
+
+	def fan_out(self, topic, chunk):
+		for subscriber in list(self.topics.get(topic, ())):
+			self.write(subscriber, chunk)
+
+	def write(self, subscriber, chunk):
+		#Queue behind anything not yet sent, dropping consumers that fall too far behind
+		if subscriber.pending:
+			if len(subscriber.pending) + len(chunk) > self.max_pending:
+				self.dropped += 1
+				self.remove(subscriber)
+			else:
+				subscriber.pending += chunk
+
+			return
+
+		try:
+			sent = subscriber.connection.send(chunk)
+		except web.would_block:
+			sent = 0
+		except OSError:
+			self.remove(subscriber)
+			return
+
+		if sent < len(chunk):
+			subscriber.pending += chunk[sent:]
+			self.selector.modify(subscriber.connection, selectors.EVENT_READ | selectors.EVENT_WRITE, subscriber)
+
+	def flush(self, subscriber):
+		try:
+			sent = subscriber.connection.send(subscriber.pending)
+		except web.would_block:
+			return
+		except OSError:
+			self.remove(subscriber)
+			return
+
+		del subscriber.pending[:sent]
+
+		if not subscriber.pending:
+			self.selector.modify(subscriber.connection, selectors.EVENT_READ, subscriber)
+
+	def read(self, subscriber):
+		#Clients don't send anything after subscribing so readable means gone (unless it was only TLS records)
+		try:
+			data = subscriber.connection.recv(4096)
+
+			#Anything else TLS already decrypted won't wake the selector again
+			while data and web.tls_pending(subscriber.connection):
+				data = subscriber.connection.recv(4096)
+		except web.would_block:
+			return
+		except OSError:
+			data = b''
+
+		if not data:
+			self.remove(subscriber)
+
+	def remove(self, subscriber):
+		subscribers = self.topics.get(subscriber.topic)
+		if not subscribers or subscriber not in subscribers:
+			return
+
+		subscribers.discard(subscriber)
+		if not subscribers:
+			del self.topics[subscriber.topic]
+
+		self.subscribers -= 1
+
+		self.selector.unregister(subscriber.connection)
+
+		try:
+			subscriber.connection.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		subscriber.request.close()
+		subscriber.connection.close()
+
+class SSEHandler(web.HTTPHandler):
+	broadcaster = None
+
+	def do_get(self):
+		topic = self.groups[0]
+
+		self.response.headers.set('Content-Type', event_stream_content_type)
+		self.response.headers.set('Cache-Control', 'no-cache')
+
+		#HTTP Status 503
+		if not self.broadcaster.is_running():
+			#Nothing would ever serve or close a connection handed to a stopped broadcaster
+			raise web.HTTPError(503)
+
+		#Park the connection with the broadcaster instead of holding this worker
+		return 200, web.Detach(lambda request: self.broadcaster.subscribe(request, topic))
+
+def new(broadcaster, remote='/events', handler=SSEHandler):
+	class GenSSEHandler(handler):
+		pass
+
+	GenSSEHandler.broadcaster = broadcaster
+
+	return {remote + '/([^?]+)(?:\\?.*)?': GenSSEHandler}
@@ -1,13 +1,22 @@
+import asyncio
+import collections
+import gzip
 import io
+import json
 import os
 import queue
 import re
+import selectors
+import shutil
+import signal
 import socket
 import socketserver
 import ssl
+import subprocess
 import sys
 import time
 import traceback
+import types
 import threading
 
 #Module details
@@ -17,6 +26,7 @@ version = '0.1rc3'
 #Server details
 server_version = name + '/' + version
 http_version = 'HTTP/1.1'
+http2_preface_line = 'PRI * HTTP/2.0\r\n'
 http_encoding = 'iso-8859-1'
 default_encoding = 'utf-8'
 
@@ -101,12 +111,110 @@ status_messages = {
 	511: 'Network Authentication Required',
 }
 
+def is_iterable(body):
+	#Strings and buffers are written whole and streams are read, anything else that iterates is streamed chunk by chunk
+	if isinstance(body, (str, bytes, bytearray, memoryview, io.IOBase)):
+		return False
+
+	return hasattr(body, '__iter__') or hasattr(body, '__aiter__')
+
+def iterate(body, encoding=default_encoding):
+	if hasattr(body, '__aiter__'):
+		iterator = iterate_async(body)
+	else:
+		iterator = iter(body)
+
+	try:
+		for chunk in iterator:
+			if isinstance(chunk, str):
+				chunk = chunk.encode(encoding)
+
+			yield chunk
+	finally:
+		#Make sure generators get cleaned up if the body is abandoned early
+		if hasattr(iterator, 'close'):
+			iterator.close()
+
+def iterate_async(body):
+	#Drive the async iterable on a private event loop since workers are plain threads
+	loop = asyncio.new_event_loop()
+	iterator = body.__aiter__()
+
+	try:
+		while True:
+			try:
+				yield loop.run_until_complete(iterator.__anext__())
+			except StopAsyncIteration:
+				break
+	finally:
+		if hasattr(iterator, 'aclose'):
+			loop.run_until_complete(iterator.aclose())
+
+		loop.close()
+
+def make_ssl_context(certfile, keyfile=None, alpn_protocols=('http/1.1',)):
+	#Server defaults (no compression, session tickets and cache for resumption) with anything older than TLS 1.2 turned off
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	context.minimum_version = ssl.TLSVersion.TLSv1_2
+
+	context.load_cert_chain(certfile, keyfile)
+
+	if alpn_protocols:
+		context.set_alpn_protocols(list(alpn_protocols))
+
+	return context
+
+#Errors from a non-blocking socket, TLS or not, that only mean to try again once it is ready
+would_block = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+def tls_pending(connection):
+	#Bytes TLS already decrypted, which a selector won't wake up for
+	if isinstance(connection, ssl.SSLSocket):
+		return connection.pending()
+
+	return 0
+
+def listen_fds():
+	#Take the variables out of the environment so processes started from this one don't claim the same sockets (like sd_listen_fds(1))
+	fd = os.environ.pop('WEB_LISTEN_FD', None)
+	pid = os.environ.pop('LISTEN_PID', None)
+	fds = os.environ.pop('LISTEN_FDS', '0')
+	os.environ.pop('LISTEN_FDNAMES', None)
+
+	#Listening socket handed over by a previous process (see HTTPServer.spawn)
+	if fd is not None:
+		return [int(fd)]
+
+	#Listening sockets passed by systemd socket activation, which start at fd 3
+	if pid != str(os.getpid()):
+		return []
+
+	return list(range(3, 3 + int(fds)))
+
+class Detach(object):
+	def __init__(self, callback):
+		#Called with the request once the head is written so the connection can be handed off from the worker
+		self.callback = callback
+
 class ResLock(object):
 	def __init__(self):
 		self.locks = {}
 		self.locks_count = {}
 		self.locks_lock = threading.Lock()
 
+		#Number of times and total seconds spent waiting on another request's lock
+		self.contended = 0
+		self.contended_time = 0
+
+	def contend(self, lock):
+		#Only time the slow path where the lock is already held
+		start = time.perf_counter()
+		lock.acquire()
+
+		with self.locks_lock:
+			self.contended += 1
+			self.contended_time += time.perf_counter() - start
+
 	def acquire(self, resource):
 		with self.locks_lock:
 			if resource not in self.locks:
@@ -117,7 +225,8 @@ class ResLock(object):
 				lock = self.locks[resource]
 				self.locks_count[resource] += 1
 
-		lock.acquire()
+		if not lock.acquire(False):
+			self.contend(lock)
 
 	def release(self, resource):
 		with self.locks_lock:
@@ -137,36 +246,199 @@ class ResLock(object):
 			except KeyError:
 				return
 
-		lock.acquire()
+		if not lock.acquire(False):
+			self.contend(lock)
 		lock.release()
 
+class LogFile(object):
+	def __init__(self, name, max_size=None, rotate_interval=None, backups=None, compress=False):
+		self.name = name
+
+		#Rotate once the file reaches max_size bytes or has been open for rotate_interval seconds, keeping at most backups rotated files
+		self.max_size = max_size
+		self.rotate_interval = rotate_interval
+		self.backups = backups
+		self.compress = compress
+
+		#Set to have the file reopened on the next write (e.g. from a signal handler)
+		self.reopen_requested = False
+
+		#Guards the file handle against being swapped out mid write and marks a rotation in progress so only one starts
+		self.file_lock = threading.Lock()
+		self.rotating = False
+
+		#Serializes compression and pruning of rotated files
+		self.cleanup_lock = threading.Lock()
+		self.cleanup_thread = None
+
+		os.makedirs(os.path.dirname(name), exist_ok=True)
+
+		self.open()
+
+	def open(self):
+		self.file = open(self.name, 'a', 1)
+
+		self.size = self.file.tell()
+		self.opened = time.time()
+
+	def swap(self):
+		#Open the new file before taking the lock so writers only wait for the handle to change
+		new = open(self.name, 'a', 1)
+		size = new.tell()
+
+		with self.file_lock:
+			old, self.file = self.file, new
+
+			self.size = size
+			self.opened = time.time()
+
+		old.close()
+
+	def reopen(self):
+		self.swap()
+
+	def should_rotate(self):
+		if self.rotating:
+			return False
+
+		if self.max_size and self.size >= self.max_size:
+			return True
+
+		#Do not bother rotating out an empty file
+		if self.rotate_interval and self.size and time.time() - self.opened >= self.rotate_interval:
+			return True
+
+		return False
+
+	def rotate(self):
+		#Rename, reopen, compress and prune in the background so writers (e.g. request workers) are not held up on the filesystem
+		self.rotating = True
+
+		self.cleanup_thread = threading.Thread(target=self.rotate_file, name='HTTPLog-Rotate', daemon=True)
+		self.cleanup_thread.start()
+
+	def rotate_file(self):
+		try:
+			#Rotated files are named by time so they sort and never need to be shifted
+			now = time.time()
+			rotated = self.name + '.' + time.strftime('%Y%m%d%H%M%S', time.localtime(now)) + '-' + '{:06d}'.format(int(now % 1 * 1000000))
+
+			#Writes keep going to the open file under its new name until the new one is swapped in
+			os.rename(self.name, rotated)
+
+			self.swap()
+		finally:
+			self.rotating = False
+
+		self.cleanup(rotated)
+
+	def rotated(self):
+		dirname, basename = os.path.split(self.name)
+
+		regex = re.compile(re.escape(basename) + '\\.\\d{14}-\\d{6}(\\.gz)?$')
+
+		return sorted(os.path.join(dirname, filename) for filename in os.listdir(dirname or '.') if regex.match(filename))
+
+	def cleanup(self, rotated):
+		with self.cleanup_lock:
+			if self.compress:
+				with open(rotated, 'rb') as source, gzip.open(rotated + '.gz.tmp', 'wb') as destination:
+					shutil.copyfileobj(source, destination)
+
+				os.rename(rotated + '.gz.tmp', rotated + '.gz')
+				os.remove(rotated)
+
+			if self.backups is not None:
+				for old in self.rotated()[:-self.backups or None]:
+					os.remove(old)
+
+	def write(self, string):
+		if self.reopen_requested:
+			self.reopen_requested = False
+			self.reopen()
+
+		with self.file_lock:
+			written = self.file.write(string)
+			self.size += written
+
+		#Check after writing so a full file is rotated without waiting for the next write
+		if self.should_rotate():
+			self.rotate()
+
+		return written
+
+	def flush(self):
+		with self.file_lock:
+			self.file.flush()
+
+	def close(self):
+		#Let a rotation in progress finish swapping files first
+		if self.cleanup_thread:
+			self.cleanup_thread.join()
+
+		with self.file_lock:
+			self.file.close()
+
 class HTTPLog(object):
-	def __init__(self, httpd_log, access_log):
+	structured = False
+
+	def __init__(self, httpd_log, access_log, structured=False, max_size=None, rotate_interval=None, backups=None, compress=False):
 		if httpd_log:
-			os.makedirs(os.path.dirname(httpd_log), exist_ok=True)
-			self.httpd_log = open(httpd_log, 'a', 1)
+			self.httpd_log = LogFile(httpd_log, max_size, rotate_interval, backups, compress)
 		else:
 			self.httpd_log = sys.stdout
 
 		self.httpd_log_lock = threading.Lock()
 
 		if access_log:
-			os.makedirs(os.path.dirname(access_log), exist_ok=True)
-			self.access_log = open(access_log, 'a', 1)
+			self.access_log = LogFile(access_log, max_size, rotate_interval, backups, compress)
 		else:
 			self.access_log = sys.stdout
 
 		self.access_log_lock = threading.Lock()
 
-	def timestamp(self):
-		return time.strftime('[%d/%b/%Y:%H:%M:%S %z]')
+		#Write JSON lines with timings instead of Common Log Format to the access log
+		self.structured = structured
+
+		#(second, formatted timestamp) of the last timestamp made
+		self.timestamp_cache = None, ''
+
+	def timestamp(self, when=None):
+		if when is None:
+			when = time.time()
+
+		#Only format the timestamp once a second
+		second = int(when)
+		cache = self.timestamp_cache
+		if cache[0] != second:
+			cache = second, time.strftime('[%d/%b/%Y:%H:%M:%S %z]', time.localtime(second))
+			self.timestamp_cache = cache
+
+		return cache[1]
+
+	def format_message(self, when, message):
+		return self.timestamp(when) + ' ' + message + '\n'
+
+	def format_request(self, when, host, request, code='-', size='-', rfc931='-', authuser='-', timing=None):
+		if self.structured:
+			if when is None:
+				when = time.time()
+
+			record = {'time': round(when, 6), 'host': host, 'rfc931': rfc931, 'authuser': authuser, 'request': request, 'code': code, 'size': size}
+
+			if timing:
+				record.update(timing)
+
+			return json.dumps(record, separators=(',', ':')) + '\n'
+
+		return host + ' ' + rfc931 + ' ' + authuser + ' ' + self.timestamp(when) + ' "' + request + '" ' + code + ' ' + size + '\n'
 
 	def write(self, string):
 		with self.httpd_log_lock:
 			self.httpd_log.write(string)
 
 	def message(self, message):
-		self.write(self.timestamp() + ' ' + message + '\n')
+		self.write(self.format_message(None, message))
 
 	def info(self, message):
 		self.message('INFO: ' + message)
@@ -184,8 +456,151 @@ class HTTPLog(object):
 		with self.access_log_lock:
 			self.access_log.write(string)
 
-	def request(self, host, request, code='-', size='-', rfc931='-', authuser='-'):
-		self.access_write(host + ' ' + rfc931 + ' ' + authuser + ' ' + self.timestamp() + ' "' + request + '" ' + code + ' ' + size + '\n')
+	def request(self, host, request, code='-', size='-', rfc931='-', authuser='-', timing=None):
+		self.access_write(self.format_request(None, host, request, code, size, rfc931, authuser, timing))
+
+	def flush(self):
+		with self.httpd_log_lock:
+			self.httpd_log.flush()
+
+		with self.access_log_lock:
+			self.access_log.flush()
+
+	def reopen(self):
+		#Only flag the files so this is safe to call from a signal handler
+		for log in (self.httpd_log, self.access_log):
+			if isinstance(log, LogFile):
+				log.reopen_requested = True
+
+	def reopen_on_signal(self, signum=getattr(signal, 'SIGHUP', None)):
+		signal.signal(signum, lambda signum, frame: self.reopen())
+
+class AsyncHTTPLog(HTTPLog):
+	def __init__(self, httpd_log, access_log, structured=False, max_queue=65536, block=False, batch_size=1024, **kwargs):
+		HTTPLog.__init__(self, httpd_log, access_log, structured, **kwargs)
+
+		#Records waiting for the writer thread, and whether to block or drop records when it is full
+		self.records = queue.Queue(max_queue)
+		self.block = block
+		self.batch_size = batch_size
+
+		self.dropped = 0
+		self.dropped_lock = threading.Lock()
+
+		self.closed = False
+
+		self.writer_thread = threading.Thread(target=self.writer, name='HTTPLog-Writer', daemon=True)
+		self.writer_thread.start()
+
+	def push(self, record):
+		try:
+			self.records.put(record, self.block)
+		except queue.Full:
+			with self.dropped_lock:
+				self.dropped += 1
+
+	def message(self, message):
+		if self.closed:
+			return HTTPLog.message(self, message)
+
+		self.push((self.format_message, time.time(), (message,)))
+
+	def request(self, host, request, code='-', size='-', rfc931='-', authuser='-', timing=None):
+		if self.closed:
+			return HTTPLog.request(self, host, request, code, size, rfc931, authuser, timing)
+
+		self.push((self.format_request, time.time(), (host, request, code, size, rfc931, authuser, timing)))
+
+	def writer(self):
+		while True:
+			records = [self.records.get()]
+
+			#Gather whatever else is waiting into the same batch
+			try:
+				while len(records) < self.batch_size:
+					records.append(self.records.get_nowait())
+			except queue.Empty:
+				pass
+
+			stop = None in records
+
+			#Always mark the batch done so flush never waits on records the writer gave up on
+			try:
+				self.write_batch(records)
+			finally:
+				for record in records:
+					self.records.task_done()
+
+			if stop:
+				return
+
+	def write_batch(self, records):
+		httpd_lines = []
+		access_lines = []
+
+		for record in records:
+			if record is None:
+				continue
+
+			formatter, when, args = record
+
+			#Leave out only the record that could not be formatted
+			try:
+				line = formatter(when, *args)
+			except Exception:
+				self.report('Failed to format log record')
+				continue
+
+			if formatter == self.format_request:
+				access_lines.append(line)
+			else:
+				httpd_lines.append(line)
+
+		with self.dropped_lock:
+			dropped = self.dropped
+			self.dropped = 0
+
+		if dropped:
+			httpd_lines.append(self.format_message(None, 'WARN: Dropped ' + str(dropped) + ' log records'))
+
+		#Write each batch at once and never let a failed write kill the writer
+		try:
+			if httpd_lines:
+				self.write(''.join(httpd_lines))
+		except Exception:
+			self.report('Failed to write ' + str(len(httpd_lines)) + ' log records')
+
+		try:
+			if access_lines:
+				self.access_write(''.join(access_lines))
+		except Exception:
+			self.report('Failed to write ' + str(len(access_lines)) + ' access log records')
+
+	def report(self, message):
+		#Nothing is there to raise to on the writer thread so tell stderr instead of losing records silently
+		try:
+			sys.stderr.write(self.format_message(None, 'ERROR: ' + message + ':\n\t' + traceback.format_exc().replace('\n', '\n\t')))
+		except Exception:
+			pass
+
+	def flush(self):
+		#Wait for the writer to catch up
+		if not self.closed:
+			self.records.join()
+
+		HTTPLog.flush(self)
+
+	def close(self):
+		if self.closed:
+			return
+
+		#Log synchronously from now on and tell the writer to finish what is queued and quit
+		self.closed = True
+
+		self.records.put(None)
+		self.writer_thread.join()
+
+		HTTPLog.flush(self)
 
 class HTTPHeaders(object):
 	def __init__(self):
@@ -271,8 +686,17 @@ class HTTPHandler(object):
 				self.check_continue()
 				self.response.wfile.write((http_version + ' 100 ' + status_messages[100] + '\r\n\r\n').encode(http_encoding))
 
+			self.request.expect_body(body_length)
 			self.request.body = self.request.rfile.read(body_length)
 
+			#HTTP Status 408
+			#Do not handle a body cut off for arriving too slowly and do not try to read another request from the connection
+			if len(self.request.body) < body_length and self.request.timed_out():
+				self.request.keepalive = False
+				raise HTTPError(408)
+
+			self.request.deadline = None
+
 		#Run the do_* method of the implementation
 		return getattr(self, 'do_' + self.method)()
 
@@ -326,6 +750,9 @@ class HTTPErrorHandler(HTTPHandler):
 		return self.error.code, status_message, message
 
 class HTTPResponse(object):
+	#Whether the connection can be handed off with Detach
+	detachable = True
+
 	def __init__(self, connection, client_address, server, request):
 		self.connection = connection
 		self.client_address = client_address
@@ -340,6 +767,11 @@ class HTTPResponse(object):
 
 		self.headers = HTTPHeaders()
 
+		#Timing of each stage of the response
+		self.started = time.perf_counter()
+		self.locked = None
+		self.responded = None
+
 		try:
 			try:
 				nonatomic = self.request.method.lower() in self.request.handler.nonatomic
@@ -353,6 +785,8 @@ class HTTPResponse(object):
 				else:
 					self.server.res_lock.acquire(self.request.resource)
 
+				self.locked = time.perf_counter()
+
 				#Get the raw response
 				raw_response = self.request.handler.respond()
 			except Exception as error:
@@ -384,6 +818,8 @@ class HTTPResponse(object):
 				if not nonatomic:
 					self.server.res_lock.release(self.request.resource)
 
+			self.responded = time.perf_counter()
+
 			#Get data from response
 			try:
 				status, response = raw_response
@@ -396,6 +832,19 @@ class HTTPResponse(object):
 				#Use chunked encoding if Content-Length not set
 				if not self.headers.get('Content-Length'):
 					self.headers.set('Transfer-Encoding', 'chunked')
+			elif is_iterable(response):
+				#Iterables are streamed as they are generated so use chunked encoding if Content-Length not set
+				if not self.headers.get('Content-Length'):
+					self.headers.set('Transfer-Encoding', 'chunked')
+
+				response = iterate(response)
+			elif isinstance(response, Detach):
+				if not self.detachable:
+					raise TypeError('Connection can not be detached')
+
+				#Whoever takes the connection writes the body so use chunked encoding if Content-Length not set (1xx responses have no body)
+				if status >= 200 and not self.headers.get('Content-Length'):
+					self.headers.set('Transfer-Encoding', 'chunked')
 			else:
 				#Convert response to bytes if necessary
 				if not isinstance(response, bytes):
@@ -413,8 +862,13 @@ class HTTPResponse(object):
 
 			self.server.log.exception()
 		finally:
+			#Close the connection after this response while draining (streams sharing a connection are left to their multiplexer)
+			if self.server.draining and self.detachable:
+				self.request.keepalive = False
+
 			#Set a few necessary headers (that should not be changed)
-			if not self.request.keepalive:
+			#A protocol switch keeps its Connection: Upgrade header
+			if not self.request.keepalive and status != 101:
 				self.headers.set('Connection', 'close')
 			self.headers.set('Server', server_version)
 			self.headers.set('Date', time.strftime('%a, %d %b %Y %H:%M:%S %Z', time.gmtime()))
@@ -422,14 +876,16 @@ class HTTPResponse(object):
 			#Prepare response_length
 			response_length = 0
 
+			#Only hand off the connection if the head made it out
+			detach = False
+
+			if self.responded is None:
+				self.responded = time.perf_counter()
+
 			#If writes fail, the streams are probably closed so log and ignore the error
 			try:
 				#Send HTTP response
-				self.wfile.write((http_version + ' ' + str(status) + ' ' + status_msg + '\r\n').encode(http_encoding))
-
-				#Have headers written
-				for header in self.headers:
-					self.wfile.write(header.encode(http_encoding))
+				self.write_head(status, status_msg)
 
 				#Write body
 				if isinstance(response, io.IOBase):
@@ -452,14 +908,42 @@ class HTTPResponse(object):
 								#If no Content-Length, used chunked encoding
 								while True:
 									chunk = response.read(stream_chunk_size)
-									#Write a hex representation (without any decorations) of the length of the chunk and the chunk separated by newlines
-									response_length += self.wfile.write(('{:x}'.format(len(chunk)) + '\r\n').encode(http_encoding) + chunk + '\r\n'.encode(http_encoding))
+									response_length += self.write_chunk(chunk)
 									#After chunk length is 0, break
 									if not chunk:
 										break
 					#Cleanup
 					finally:
 						response.close()
+				elif isinstance(response, types.GeneratorType):
+					#For an iterable, write each chunk as it is generated so only one chunk is held at a time
+					try:
+						#Check whether body needs to be written
+						if self.write_body:
+							content_length = self.headers.get('Content-Length')
+							if content_length:
+								#If there is a Content-Length, write no more than that much from the iterable
+								bytes_left = int(content_length)
+								for chunk in response:
+									chunk = chunk[:bytes_left]
+									bytes_left -= len(chunk)
+									response_length += self.wfile.write(chunk)
+									if not bytes_left:
+										break
+							else:
+								#If no Content-Length, used chunked encoding with each chunk flushed as it is written
+								for chunk in response:
+									#Skip empty chunks since they would end the body early
+									if not chunk:
+										continue
+									response_length += self.write_chunk(chunk)
+								response_length += self.write_chunk(b'')
+					#Cleanup, closing the generator even if the client disconnected
+					finally:
+						response.close()
+				elif isinstance(response, Detach):
+					#Leave the body to the callback unless only the head was wanted
+					detach = self.write_body
 				else:
 					#Check whether body needs to be written
 					if self.write_body and response:
@@ -468,9 +952,59 @@ class HTTPResponse(object):
 			except:
 				self.server.log.exception()
 
+				#The body may have been cut off so the connection can't be reused
+				self.request.keepalive = False
+
 			self.wfile.flush()
 
-			self.server.log.request(self.client_address[0], self.request.request_line, code=str(status), size=str(response_length))
+			if self.server.log.structured:
+				self.server.log.request(self.client_address[0], self.request.request_line, code=str(status), size=str(response_length), timing=self.timing(time.perf_counter()))
+			else:
+				self.server.log.request(self.client_address[0], self.request.request_line, code=str(status), size=str(response_length))
+
+			if self.server.metrics:
+				self.server.metrics.request(self.request, status, response_length, time.perf_counter() - (self.request.received or self.started))
+
+			if detach:
+				try:
+					response.callback(self.request)
+
+					#The worker must now leave the connection alone
+					self.request.detached = True
+				except:
+					self.server.log.exception()
+
+					self.request.keepalive = False
+
+	def write_head(self, status, status_msg):
+		self.wfile.write((http_version + ' ' + str(status) + ' ' + status_msg + '\r\n').encode(http_encoding))
+
+		#Have headers written
+		for header in self.headers:
+			self.wfile.write(header.encode(http_encoding))
+
+	def write_chunk(self, chunk):
+		#Write a hex representation (without any decorations) of the length of the chunk and the chunk separated by newlines in one write
+		return self.wfile.write(b''.join([('{:x}'.format(len(chunk)) + '\r\n').encode(http_encoding), chunk, '\r\n'.encode(http_encoding)]))
+
+	def timing(self, written):
+		def duration(start, end):
+			if start is None or end is None:
+				return None
+
+			return round(end - start, 6)
+
+		#Every stage from being queued by the server to the response being written
+		return {
+			'worker': self.request.worker,
+			'reused': self.request.count > 1,
+			'queue_time': duration(self.request.queued, self.request.dequeued),
+			'idle_time': duration(self.request.dequeued, self.request.received),
+			'parse_time': duration(self.request.received, self.started),
+			'lock_time': duration(self.started, self.locked),
+			'handler_time': duration(self.locked, self.responded),
+			'write_time': duration(self.responded, written),
+		}
 
 	def close(self):
 		self.wfile.close()
@@ -486,25 +1020,73 @@ class HTTPRequest(object):
 		#Disable nagle's algorithm
 		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
 
+		#TLS connections are accepted without a handshake which is done on the first handle
+		self.handshaken = not isinstance(self.connection, ssl.SSLSocket)
+
 		self.rfile = self.connection.makefile('rb', -1)
 
 		self.response = HTTPResponse(connection, client_address, server, self)
 
+		#Set by the server and its workers for timing requests
+		self.queued = None
+		self.dequeued = None
+		self.worker = None
+
+		#Number of requests received on this connection
+		self.count = 0
+		self.received = None
+
+		#Time by which the client must finish sending the head or body being read (see HTTPServer.reap)
+		self.deadline = None
+
+		#Set while the connection waits on the client for another request (see HTTPServer.admit)
+		self.idle = False
+
+		#Route pattern the request matched and size of its head
+		self.route = None
+		self.bytes_in = 0
+
+		self.detached = False
+
 	def handle(self, keepalive=True, initial_timeout=None):
 		#Default to no keepalive in case something happens while even trying ensure we have a request
 		self.keepalive = False
 
+		#Not received until a request line arrives
+		self.received = None
+
+		#Set if the response handed the connection off (see Detach)
+		self.detached = False
+
 		self.headers = HTTPHeaders()
 
+		if not self.handshaken and not self.handshake():
+			return
+
 		#If initial_timeout is set, only wait that long for the initial request line
 		if initial_timeout:
 			self.connection.settimeout(initial_timeout)
 		else:
 			self.connection.settimeout(self.timeout)
 
+		self.deadline = None
+
 		#Get request line
 		try:
-			request = self.rfile.readline(max_line_size + 1).decode(http_encoding)
+			#Wait for the first byte before starting the head deadline so idle keepalive connections only wait out their timeout
+			request = self.rfile.read(1)
+
+			if request:
+				#A request is arriving so the connection can no longer be evicted as idle
+				self.server.mark_busy(self)
+
+				#The timeout only applies to each read so bound the whole head for clients that trickle it in
+				if self.server.head_timeout:
+					self.deadline = time.perf_counter() + self.server.head_timeout
+
+				request += self.rfile.readline(max_line_size)
+
+			request = request.decode(http_encoding)
 		#If read hits timeout or has some other error, ignore the request
 		except:
 			return
@@ -513,6 +1095,17 @@ class HTTPRequest(object):
 		if not request:
 			return
 
+		#Hand connections that start with the HTTP/2 preface to the server's HTTP/2 multiplexer (see web.http2), which only speaks cleartext
+		if request == http2_preface_line and self.server.http2 and not isinstance(self.connection, ssl.SSLSocket):
+			self.detached = self.server.http2.attach(self)
+			return
+
+		self.received = time.perf_counter()
+		self.count += 1
+
+		self.route = None
+		self.bytes_in = len(request)
+
 		#We have a request, go back to normal timeout
 		if initial_timeout:
 			self.connection.settimeout(self.timeout)
@@ -525,6 +1118,10 @@ class HTTPRequest(object):
 		self.resource = ''
 
 		try:
+			#HTTP Status 408
+			if self.timed_out():
+				raise HTTPError(408)
+
 			#HTTP Status 414
 			if len(request) > max_line_size:
 				raise HTTPError(414)
@@ -548,6 +1145,10 @@ class HTTPRequest(object):
 			while True:
 				line = self.rfile.readline(max_line_size + 1).decode(http_encoding)
 
+				#HTTP Status 408
+				if self.timed_out():
+					raise HTTPError(408)
+
 				#Hit end of headers
 				if line == '\r\n':
 					break
@@ -567,32 +1168,76 @@ class HTTPRequest(object):
 				if line[-2:] != '\r\n' or ':' not in line:
 					raise HTTPError(400)
 
+				self.bytes_in += len(line)
+
 				self.headers.add(line)
 
 			#If we are requested to close the connection after we finish, do so
 			if self.headers.get('Connection') == 'close':
 				self.keepalive = False
+			#Close connections that have had their share of requests so one client can't keep a connection forever
+			elif self.server.max_requests and self.count >= self.server.max_requests:
+				self.keepalive = False
 			#Else since we are sure we have a request and have read all of the request data, keepalive for more later (if allowed)
 			else:
 				self.keepalive = keepalive
 
-			#Find a matching regex to handle the request with
-			for regex, handler in self.server.routes.items():
-				match = regex.match(self.resource)
-				if match:
-					self.handler = handler(self, self.response, match.groups())
-					break
-			#HTTP Status 404
-			#If loop is not broken (handler is not found), raise a 404
-			else:
-				raise HTTPError(404)
+			self.find_handler()
 		#Use DummyHandler so the error is raised again when ready for response
 		except Exception as error:
 			self.handler = DummyHandler(self, self.response, (), error)
 		finally:
+			self.deadline = None
+
 			#We finished listening and handling early errors and so let a response class now finish up the job of talking
 			self.response.handle()
 
+	def handshake(self):
+		#Do the TLS handshake here on a worker so a slow client can't hold up accepting other connections
+		self.connection.settimeout(self.server.handshake_timeout)
+
+		try:
+			self.connection.do_handshake()
+		#If the handshake times out or fails, the connection is closed
+		except OSError:
+			with self.server.handshake_lock:
+				self.server.handshake_failures += 1
+			return False
+
+		self.handshaken = True
+
+		return True
+
+	def expect_body(self, length):
+		#Give the client until the body would have arrived at the minimum rate before cutting it off (see HTTPServer.reap)
+		if self.server.min_body_rate:
+			self.deadline = time.perf_counter() + (self.timeout or 0) + length / self.server.min_body_rate
+
+	def timed_out(self):
+		return self.deadline is not None and time.perf_counter() > self.deadline
+
+	def find_handler(self):
+		#Find a matching regex to handle the request with
+		for regex, handler in self.server.routes.items():
+			match = regex.match(self.resource)
+			if match:
+				self.route = regex.pattern
+				self.handler = handler(self, self.response, match.groups())
+				break
+		#HTTP Status 404
+		#If loop is not broken (handler is not found), raise a 404
+		else:
+			raise HTTPError(404)
+
+	def pipelined(self):
+		#Check without waiting whether the client already sent another request behind this one
+		self.connection.settimeout(0)
+
+		try:
+			return bool(self.rfile.peek(1))
+		except OSError:
+			return False
+
 	def close(self):
 		self.rfile.close()
 		self.response.close()
@@ -600,12 +1245,46 @@ class HTTPRequest(object):
 class HTTPServer(socketserver.TCPServer):
 	allow_reuse_address = True
 
-	def __init__(self, address, routes, error_routes={}, keyfile=None, certfile=None, keepalive=5, timeout=20, num_threads=2, max_threads=6, max_queue=4, poll_interval=0.1, log=HTTPLog(None, None)):
+	def __init__(self, address, routes, error_routes={}, keyfile=None, certfile=None, keepalive=5, timeout=20, num_threads=2, max_threads=6, max_queue=4, poll_interval=0.1, log=HTTPLog(None, None), metrics=None, slow_timeout=None, max_pipeline=16, http2=None, ssl_context=None, handshake_timeout=5, sni=None, backlog=128, max_accept=64, defer_accept=None, fastopen=None, recv_buffer=None, send_buffer=None, fd=None, head_timeout=None, min_body_rate=None, max_requests=None, max_connections=None, max_connections_per_ip=None):
 		#Set the log first for use in server_bind
 		self.log = log
 
-		#Prepare a TCPServer
-		socketserver.TCPServer.__init__(self, address, None)
+		#Optional metrics registry (see web.metrics)
+		self.metrics = metrics
+
+		#Optional multiplexer that takes cleartext HTTP/2 connections (see web.http2)
+		self.http2 = http2
+
+		#Listen backlog and most connections accepted each time the listening socket is ready
+		self.request_queue_size = backlog
+		self.max_accept = max_accept
+
+		#Optional listening socket options (see server_bind)
+		self.defer_accept = defer_accept
+		self.fastopen = fastopen
+		self.recv_buffer = recv_buffer
+		self.send_buffer = send_buffer
+
+		#Connections accepted, times the listening socket was ready and accepts that failed
+		self.accepted = 0
+		self.accept_wakeups = 0
+		self.accept_errors = 0
+
+		#Prepare a TCPServer, taking over an inherited listening socket if given one (see listen_fds)
+		if fd is None:
+			socketserver.TCPServer.__init__(self, address, None)
+		else:
+			socketserver.TCPServer.__init__(self, address, None, False)
+
+			self.socket.close()
+			self.socket = socket.socket(fileno=fd)
+
+			try:
+				self.server_inherit()
+				self.server_activate()
+			except:
+				self.server_close()
+				raise
 
 		#Make route dictionaries
 		self.routes = {}
@@ -617,9 +1296,24 @@ class HTTPServer(socketserver.TCPServer):
 		for regex, handler in error_routes.items():
 			self.error_routes[re.compile('^' + regex + '$')] = handler
 
-		#Add SSL if necessary information specified
-		if keyfile and certfile:
-			self.socket = ssl.wrap_socket(self.socket, keyfile, certfile, server_side=True)
+		#Files the default context is loaded from (if not given one) so it can be reloaded
+		self.keyfile = keyfile
+		self.certfile = certfile
+
+		#Host name (or *.domain wildcard) -> SSLContext or (certfile, keyfile) to serve instead of the default by SNI
+		self.sni = sni or {}
+
+		self.ssl_context = None
+		self.sni_contexts = {}
+
+		#Longest a worker waits on a client to finish its TLS handshake and number of handshakes that failed or timed out
+		self.handshake_timeout = handshake_timeout
+		self.handshake_failures = 0
+		self.handshake_lock = threading.Lock()
+
+		#Add SSL if a context or the files for one are specified
+		if ssl_context or (keyfile and certfile):
+			self.reload_ssl(ssl_context)
 			self.log.info('Socket encrypted with SSL')
 			self.using_ssl = True
 		else:
@@ -635,12 +1329,54 @@ class HTTPServer(socketserver.TCPServer):
 
 		self.poll_interval = poll_interval
 
+		#Most pipelined requests handled back to back before the connection goes to the back of the queue
+		self.max_pipeline = max_pipeline
+
+		#Longest a client has to send a whole request head, slowest it may send a body (bytes per second) and most requests on one connection
+		self.head_timeout = head_timeout
+		self.min_body_rate = min_body_rate
+		self.max_requests = max_requests
+
+		#Most connections open in all and from one address, making room by closing the least recently used idle ones (see admit)
+		self.max_connections = max_connections
+		self.max_connections_per_ip = max_connections_per_ip
+
+		#Connection -> HTTPRequest from least to most recently idle and address -> number of connections open from it
+		self.connections = collections.OrderedDict()
+		self.connections_per_ip = {}
+		self.connections_lock = threading.RLock()
+
+		#Idle connections closed to make room for new ones and connections refused for lack of it
+		self.evicted = 0
+		self.refused = 0
+
+		#Requests running longer than this are logged with their stack
+		self.slow_timeout = slow_timeout
+
+		#Thread ident -> HTTPRequest currently being handled
+		self.inflight = {}
+		#(thread ident, received) of requests already reported as slow
+		self.slow_flagged = set()
+		self.slow_requests = 0
+		self.stuck_workers = 0
+
+		#(thread ident, deadline) of clients already cut off for missing a deadline and number cut off
+		self.reaped = set()
+		self.slow_clients = 0
+
 		#Threads and flags
 		self.server_thread = None
 
+		#Set while stopping so connections are closed after their current request instead of kept alive
+		self.draining = False
+
 		self.manager_thread = None
 		self.manager_shutdown = False
 
+		#Accept loop is run here instead of by socketserver so each wakeup can drain the backlog
+		self.serve_shutdown = False
+		self.serve_stopped = threading.Event()
+
 		self.worker_threads = None
 		self.worker_shutdown = None
 
@@ -656,6 +1392,9 @@ class HTTPServer(socketserver.TCPServer):
 
 		self.server_close()
 
+		#Make sure everything logged so far is written out
+		self.log.flush()
+
 	def start(self):
 		if self.is_running():
 			return
@@ -669,24 +1408,241 @@ class HTTPServer(socketserver.TCPServer):
 		if not self.is_running():
 			return
 
+		self.drain()
+
 		self.shutdown()
 		self.server_thread.join(timeout)
 		self.server_thread = None
 
+		#Let HTTP/2 sessions send what is left of their streams before they close
+		if self.http2:
+			self.http2.wait(timeout)
+
 		self.log.info('Server stopped')
 
 	def is_running(self):
 		return bool(self.server_thread and self.server_thread.is_alive())
 
 	def server_bind(self):
+		#Buffer sizes must be set before listening to affect window scaling and are inherited by accepted connections
+		if self.recv_buffer:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+		if self.send_buffer:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
+		#Only wake up for a connection once its client has sent something (in seconds)
+		if self.defer_accept:
+			self.set_listen_option('TCP_DEFER_ACCEPT', self.defer_accept)
+
+		#Let clients send their first request with the SYN (the value is the queue length for pending fast opens)
+		if self.fastopen:
+			self.set_listen_option('TCP_FASTOPEN', self.fastopen)
+
 		socketserver.TCPServer.server_bind(self)
 
 		host, port = self.server_address[:2]
 		self.log.info('Serving HTTP on ' + host + ':' + str(port))
 
+	def server_inherit(self):
+		#Options that apply to an already bound socket (a new backlog is taken by listening again)
+		if self.recv_buffer:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+		if self.send_buffer:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
+		if self.defer_accept:
+			self.set_listen_option('TCP_DEFER_ACCEPT', self.defer_accept)
+
+		self.server_address = self.socket.getsockname()
+
+		host, port = self.server_address[:2]
+		self.log.info('Serving HTTP on inherited socket ' + host + ':' + str(port))
+
+	def set_listen_option(self, option, value):
+		#These are only available on some platforms so skip them with a warning elsewhere
+		try:
+			self.socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+		except (AttributeError, OSError):
+			self.log.warn(option + ' is not supported and will not be used')
+
+	def server_activate(self):
+		socketserver.TCPServer.server_activate(self)
+
+		#Accept without blocking so everything waiting in the backlog can be drained at once
+		self.socket.setblocking(False)
+
+	def get_request(self):
+		connection, client_address = self.socket.accept()
+
+		#Some platforms have accepted connections inherit non-blocking mode from the listening socket
+		connection.setblocking(True)
+
+		return connection, client_address
+
+	def accept(self):
+		#Accept everything waiting (up to max_accept) each time the listening socket is ready instead of one connection
+		self.accept_wakeups += 1
+
+		for i in range(self.max_accept):
+			try:
+				connection, client_address = self.get_request()
+			#Backlog is drained
+			except BlockingIOError:
+				break
+			#Out of file descriptors or the client gave up before it was accepted
+			except OSError:
+				self.accept_errors += 1
+				break
+
+			self.accepted += 1
+
+			if self.verify_request(connection, client_address):
+				try:
+					self.process_request(connection, client_address)
+				except Exception:
+					self.handle_error(connection, client_address)
+					self.shutdown_request(connection)
+				except:
+					self.shutdown_request(connection)
+					raise
+			else:
+				self.shutdown_request(connection)
+
+	def handle_request(self):
+		#Wait for the listening socket then accept everything waiting, like a single pass of serve_forever
+		with selectors.DefaultSelector() as selector:
+			selector.register(self, selectors.EVENT_READ)
+
+			if selector.select(self.timeout):
+				self.accept()
+			else:
+				self.handle_timeout()
+
+	def reload_ssl(self, ssl_context=None):
+		#Load everything before swapping so a bad file leaves the current contexts in place
+		if not ssl_context:
+			ssl_context = make_ssl_context(self.certfile, self.keyfile)
+
+		sni_contexts = {}
+		for host, context in self.sni.items():
+			if not isinstance(context, ssl.SSLContext):
+				context = make_ssl_context(*context)
+
+			sni_contexts[host.lower()] = context
+
+		if sni_contexts:
+			ssl_context.sni_callback = self.select_ssl_context
+
+		#New connections are wrapped with whatever is current when accepted so open connections are left alone
+		self.sni_contexts = sni_contexts
+		self.ssl_context = ssl_context
+
+	def reload_ssl_on_signal(self, signum=getattr(signal, 'SIGUSR1', None)):
+		def reload(signum, frame):
+			#Keep serving with the current certificates if the new ones can't be loaded
+			try:
+				self.reload_ssl()
+				self.log.info('SSL certificates reloaded')
+			except Exception:
+				self.log.exception()
+
+		signal.signal(signum, reload)
+
+	def select_ssl_context(self, ssl_socket, server_name, ssl_context):
+		#Called during the handshake to switch to the context for the host name the client asked for
+		if not server_name:
+			return
+
+		server_name = server_name.lower()
+
+		sni_contexts = self.sni_contexts
+		context = sni_contexts.get(server_name) or sni_contexts.get('*.' + server_name.partition('.')[2])
+		if context:
+			ssl_socket.context = context
+
 	def process_request(self, connection, client_address):
+		#Wrap with the current context, leaving the handshake to a worker so a slow client can't hold up accept
+		if self.ssl_context:
+			connection = self.ssl_context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False)
+
 		#Create a new HTTPRequest and put it on the queue (handler, keepalive, initial_timeout)
-		self.request_queue.put((HTTPRequest(connection, client_address, self, self.request_timeout), (self.keepalive_timeout != None), None))
+		request = HTTPRequest(connection, client_address, self, self.request_timeout)
+		request.queued = time.perf_counter()
+
+		#Make room for the connection under the limits or turn it away
+		if not self.admit(request):
+			self.refused += 1
+
+			#Close the request's files too or they hold the connection open until garbage collected
+			request.close()
+			self.shutdown_request(connection)
+			return
+
+		self.request_queue.put((request, (self.keepalive_timeout != None), None))
+
+	def admit(self, request):
+		address = request.client_address[0]
+
+		with self.connections_lock:
+			if self.max_connections_per_ip and self.connections_per_ip.get(address, 0) >= self.max_connections_per_ip and not self.evict(address):
+				return False
+
+			if self.max_connections and len(self.connections) >= self.max_connections and not self.evict():
+				return False
+
+			self.connections[request.connection] = request
+			self.connections_per_ip[address] = self.connections_per_ip.get(address, 0) + 1
+
+		return True
+
+	def evict(self, address=None):
+		#Close the least recently used idle connection (from address if given), if any, so another can take its place
+		with self.connections_lock:
+			for connection, handler in self.connections.items():
+				if handler.idle and (address is None or handler.client_address[0] == address):
+					break
+			else:
+				return False
+
+			self.untrack(connection)
+			self.evicted += 1
+
+		#Whichever worker has or next gets the connection sees it closed and lets it go
+		try:
+			connection.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		return True
+
+	def mark_idle(self, handler):
+		#Move the connection to the back of the line for eviction now that it waits on another request
+		with self.connections_lock:
+			handler.idle = True
+
+			if handler.connection in self.connections:
+				self.connections.move_to_end(handler.connection)
+
+	def mark_busy(self, handler):
+		with self.connections_lock:
+			handler.idle = False
+
+	def untrack(self, connection):
+		with self.connections_lock:
+			handler = self.connections.pop(connection, None)
+			if handler is None:
+				return
+
+			address = handler.client_address[0]
+			self.connections_per_ip[address] -= 1
+			if not self.connections_per_ip[address]:
+				del self.connections_per_ip[address]
+
+	def shutdown_request(self, connection):
+		#Stop counting the connection against the limits
+		self.untrack(connection)
+
+		socketserver.TCPServer.shutdown_request(self, connection)
 
 	def serve_forever(self):
 		try:
@@ -694,11 +1650,31 @@ class HTTPServer(socketserver.TCPServer):
 			self.manager_thread = threading.Thread(target=self.manager, name='HTTPServer-Manager')
 			self.manager_thread.start()
 
-			socketserver.TCPServer.serve_forever(self, self.poll_interval)
+			self.serve_stopped.clear()
+			try:
+				with selectors.DefaultSelector() as selector:
+					selector.register(self, selectors.EVENT_READ)
+
+					while not self.serve_shutdown:
+						ready = selector.select(self.poll_interval)
+
+						#Check again in case shutdown was called while waiting
+						if self.serve_shutdown:
+							break
+
+						if ready:
+							self.accept()
+
+						self.service_actions()
+			finally:
+				self.serve_shutdown = False
+				self.serve_stopped.set()
 
 			#Wait for all tasks in the queue to finish
 			self.request_queue.join()
 		finally:
+			self.draining = False
+
 			#Tell manager to shutdown
 			self.manager_shutdown = True
 
@@ -708,6 +1684,11 @@ class HTTPServer(socketserver.TCPServer):
 			self.manager_shutdown = False
 			self.manager_thread = None
 
+	def shutdown(self):
+		#Stop the accept loop in serve_forever and wait for it to finish
+		self.serve_shutdown = True
+		self.serve_stopped.wait()
+
 	def manager(self):
 		try:
 			#Create each worker thread and store it in a list
@@ -740,6 +1721,13 @@ class HTTPServer(socketserver.TCPServer):
 						self.worker_threads.pop().join()
 						self.worker_shutdown = None
 
+				#Cut off clients too slow sending their requests
+				self.reap()
+
+				#Look for workers that are alive but stuck on a request
+				if self.slow_timeout:
+					self.watchdog()
+
 				time.sleep(self.poll_interval)
 		finally:
 			#Tell all workers to shutdown
@@ -752,6 +1740,86 @@ class HTTPServer(socketserver.TCPServer):
 			self.worker_shutdown = None
 			self.worker_threads = None
 
+	def reap(self):
+		now = time.perf_counter()
+
+		reaped = set()
+
+		for ident, handler in list(self.inflight.items()):
+			#Only connections the server still owns that are waiting on a client past its deadline (see HTTPRequest.timed_out)
+			deadline = handler.deadline
+			if deadline is None or now <= deadline or not handler.connection:
+				continue
+
+			reaped.add((ident, deadline))
+
+			#Cut off each client only once
+			if (ident, deadline) in self.reaped:
+				continue
+
+			self.slow_clients += 1
+
+			#Stop reading so the worker stops waiting and can still tell the client why, except TLS which can't be written after a shutdown
+			try:
+				handler.connection.shutdown(socket.SHUT_RDWR if isinstance(handler.connection, ssl.SSLSocket) else socket.SHUT_RD)
+			except OSError:
+				pass
+
+		#Forget clients that have finished
+		self.reaped = reaped
+
+	def watchdog(self):
+		now = time.perf_counter()
+		frames = sys._current_frames()
+
+		slow = set()
+
+		for ident, handler in list(self.inflight.items()):
+			#Only time requests once they are received, not while waiting on a keepalive connection
+			received = handler.received
+			if received is None or now - received < self.slow_timeout:
+				continue
+
+			slow.add((ident, received))
+
+			#Report each slow request only once
+			if (ident, received) in self.slow_flagged:
+				continue
+
+			self.slow_requests += 1
+
+			frame = frames.get(ident)
+			stack = ''.join(traceback.format_stack(frame)) if frame else ''
+
+			self.log.warn('Slow request on worker ' + str(handler.worker) + ' after ' + '{:.3f}'.format(now - received) + 's: "' + getattr(handler, 'request_line', '') + '" route ' + (handler.route or '-') + '\n\t' + stack.rstrip('\n').replace('\n', '\n\t'))
+
+		#Forget requests that have finished
+		self.slow_flagged = slow
+		self.stuck_workers = len(slow)
+
+	def spawn(self, args, **kwargs):
+		#Start a process (e.g. a new version of this one) that serves on the listening socket given by listen_fds so nothing is refused while this one drains
+		env = dict(kwargs.pop('env', None) or os.environ)
+		env['WEB_LISTEN_FD'] = str(self.socket.fileno())
+
+		return subprocess.Popen(args, env=env, pass_fds=(self.socket.fileno(),), **kwargs)
+
+	def drain(self):
+		#Finish requests in progress with Connection: close and close idle keepalive connections instead of waiting out their timeouts
+		self.draining = True
+
+		#HTTP/2 connections are handed off to the multiplexer and not in inflight so tell them to go away there
+		if self.http2:
+			self.http2.drain()
+
+		for handler in list(self.inflight.values()):
+			#Only connections waiting on another request (not new or handed off ones) are idle
+			if handler.received is None and handler.count and handler.connection:
+				try:
+					handler.connection.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
+
 	def worker(self, num):
 		while self.worker_shutdown != -1 and self.worker_shutdown != num:
 			try:
@@ -761,14 +1829,42 @@ class HTTPServer(socketserver.TCPServer):
 				#Continue loop to check for shutdown and try again
 				continue
 
+			handler.dequeued = time.perf_counter()
+			handler.worker = num
+
+			#While draining, close keepalive connections coming back around unless their next request is already here
+			if self.draining and initial_timeout is not None and not handler.pipelined():
+				handler.close()
+				self.shutdown_request(handler.connection)
+
+				self.request_queue.task_done()
+				continue
+
+			ident = threading.get_ident()
+			self.inflight[ident] = handler
+
 			#Handle request
 			try:
 				handler.handle(keepalive, initial_timeout)
+
+				#Handle requests the client pipelined behind it right away instead of sending each through the queue (responses stay in order)
+				pipelined = 1
+				while pipelined < self.max_pipeline and handler.keepalive and not handler.detached and handler.pipelined():
+					handler.queued = handler.dequeued = time.perf_counter()
+					handler.handle(keepalive, self.keepalive_timeout)
+					pipelined += 1
 			except:
 				self.log.exception()
+			finally:
+				del self.inflight[ident]
 
-			if handler.keepalive:
+			if handler.detached:
+				#The connection was handed off and is no longer the server's to close or limit
+				self.untrack(handler.connection)
+			elif handler.keepalive:
 				#Handle again
+				self.mark_idle(handler)
+				handler.queued = time.perf_counter()
 				self.request_queue.put((handler, keepalive, self.keepalive_timeout))
 			else:
 				#Close handler and request
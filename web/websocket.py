@@ -0,0 +1,645 @@
+import base64
+import collections
+import hashlib
+import selectors
+import socket
+import threading
+import time
+import zlib
+
+import web
+
+guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+version = '13'
+
+#Frame opcodes
+opcode_continuation = 0x0
+opcode_text = 0x1
+opcode_binary = 0x2
+opcode_close = 0x8
+opcode_ping = 0x9
+opcode_pong = 0xa
+
+#Close codes
+close_normal = 1000
+close_going_away = 1001
+close_protocol_error = 1002
+close_unsupported = 1003
+close_no_status = 1005
+close_abnormal = 1006
+close_invalid_data = 1007
+close_policy = 1008
+close_too_big = 1009
+close_internal_error = 1011
+
+#Trailer that each compressed message ends with and that is left off the wire
+deflate_trailer = b'\x00\x00\xff\xff'
+
+class WebSocketError(Exception):
+	def __init__(self, code, reason=''):
+		self.code = code
+		self.reason = reason
+
+def accept_key(key):
+	return base64.b64encode(hashlib.sha1((key + guid).encode(web.http_encoding)).digest()).decode(web.http_encoding)
+
+def mask(data, key):
+	#XOR the whole payload at once as one big integer instead of byte by byte
+	length = len(data)
+	if not length:
+		return b''
+
+	key = (key * (length // 4 + 1))[:length]
+
+	return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+def build_frame(opcode, payload, fin=True, rsv1=False):
+	head = bytearray([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+
+	length = len(payload)
+	if length < 126:
+		head.append(length)
+	elif length < 65536:
+		head.append(126)
+		head += length.to_bytes(2, 'big')
+	else:
+		head.append(127)
+		head += length.to_bytes(8, 'big')
+
+	return bytes(head) + payload
+
+def parse_frame(buffer, max_size=None):
+	#Returns (fin, rsv1, opcode, payload, length of frame) or None if the frame is not all here yet
+	if len(buffer) < 2:
+		return None
+
+	fin = bool(buffer[0] & 0x80)
+	rsv1 = bool(buffer[0] & 0x40)
+	opcode = buffer[0] & 0x0f
+
+	#Clients must mask every frame
+	if not buffer[1] & 0x80:
+		raise WebSocketError(close_protocol_error, 'Unmasked frame')
+
+	if buffer[0] & 0x30:
+		raise WebSocketError(close_protocol_error, 'Reserved bits set')
+
+	length = buffer[1] & 0x7f
+	offset = 2
+
+	if length == 126:
+		if len(buffer) < 4:
+			return None
+
+		length = int.from_bytes(buffer[2:4], 'big')
+		offset = 4
+	elif length == 127:
+		if len(buffer) < 10:
+			return None
+
+		length = int.from_bytes(buffer[2:10], 'big')
+		offset = 10
+
+	if opcode >= opcode_close:
+		#Control frames can't be fragmented or long
+		if not fin or length > 125:
+			raise WebSocketError(close_protocol_error, 'Bad control frame')
+	elif opcode > opcode_binary:
+		raise WebSocketError(close_protocol_error, 'Unknown opcode')
+
+	#Fail before buffering a frame that could never be accepted
+	if max_size and length > max_size:
+		raise WebSocketError(close_too_big)
+
+	if len(buffer) < offset + 4 + length:
+		return None
+
+	key = bytes(buffer[offset:offset + 4])
+	payload = mask(bytes(buffer[offset + 4:offset + 4 + length]), key)
+
+	return fin, rsv1, opcode, payload, offset + 4 + length
+
+def parse_extensions(header):
+	#Extension offers in order of preference -> list of (name, {param: value})
+	offers = []
+
+	for offer in header.split(','):
+		params = [param.strip() for param in offer.split(';')]
+		if not params[0]:
+			continue
+
+		values = {}
+		for param in params[1:]:
+			name, equals, value = param.partition('=')
+			values[name.strip()] = value.strip().strip('"') if equals else None
+
+		offers.append((params[0], values))
+
+	return offers
+
+class Multiplexer(object):
+	def __init__(self, max_pending=1048576, close_timeout=5, poll_interval=0.1):
+		self.max_pending = max_pending
+		self.close_timeout = close_timeout
+		self.poll_interval = poll_interval
+
+		#Open handlers
+		self.handlers = set()
+
+		self.selector = None
+
+		#Requests from other threads are queued and the multiplexer thread woken up to handle them
+		self.incoming = collections.deque()
+		self.wakeup_read, self.wakeup_write = socket.socketpair()
+		self.wakeup_read.setblocking(False)
+		self.wakeup_write.setblocking(False)
+
+		self.multiplexer_thread = None
+		self.multiplexer_shutdown = False
+
+	def start(self):
+		if self.is_running():
+			return
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+
+		self.multiplexer_shutdown = False
+
+		self.multiplexer_thread = threading.Thread(target=self.multiplexer, name='WebSocket-Multiplexer')
+		self.multiplexer_thread.start()
+
+	def stop(self, timeout=None):
+		if not self.is_running():
+			return
+
+		self.multiplexer_shutdown = True
+		self.wakeup()
+
+		self.multiplexer_thread.join(timeout)
+		self.multiplexer_thread = None
+
+	def close(self, timeout=None):
+		self.stop(timeout)
+
+		self.wakeup_read.close()
+		self.wakeup_write.close()
+
+	def is_running(self):
+		return bool(self.multiplexer_thread and self.multiplexer_thread.is_alive())
+
+	def wakeup(self):
+		try:
+			self.wakeup_write.send(b'\0')
+		except BlockingIOError:
+			#Already plenty of wakeups pending
+			pass
+
+	def attach(self, handler, leftover=b''):
+		self.incoming.append((self.add, (handler, leftover)))
+		self.wakeup()
+
+	def write(self, handler, data):
+		self.incoming.append((self.send, (handler, data)))
+		self.wakeup()
+
+	def multiplexer(self):
+		try:
+			while not self.multiplexer_shutdown:
+				for key, mask in self.selector.select(self.poll_interval):
+					if key.fileobj is self.wakeup_read:
+						try:
+							while self.wakeup_read.recv(4096):
+								pass
+						except BlockingIOError:
+							pass
+					else:
+						if mask & selectors.EVENT_READ:
+							self.read(key.data)
+						#Reading may have closed the connection
+						if mask & selectors.EVENT_WRITE and key.data in self.handlers:
+							self.flush(key.data)
+
+				#Handle attaches and writes from other threads and from callbacks
+				while self.incoming:
+					function, args = self.incoming.popleft()
+					function(*args)
+
+				#Give up on peers that never answer a close
+				now = time.monotonic()
+				for handler in list(self.handlers):
+					if handler.close_deadline and now >= handler.close_deadline:
+						self.remove(handler, close_abnormal, 'Close timed out')
+		finally:
+			for handler in list(self.handlers):
+				if not handler.close_sent and not handler.pending:
+					try:
+						handler.connection.send(build_frame(opcode_close, close_going_away.to_bytes(2, 'big')))
+					except OSError:
+						pass
+
+				self.remove(handler, close_going_away, 'Server shutting down')
+
+			self.selector.close()
+
+	def add(self, handler, leftover):
+		handler.connection.setblocking(False)
+
+		self.selector.register(handler.connection, selectors.EVENT_READ, handler)
+		self.handlers.add(handler)
+
+		self.call(handler, handler.on_open)
+
+		#Frames that arrived with the handshake
+		if leftover and handler in self.handlers:
+			self.feed(handler, leftover)
+
+		#And ones TLS already decrypted, which won't wake the selector
+		if web.tls_pending(handler.connection) and handler in self.handlers:
+			self.read(handler)
+
+	def read(self, handler):
+		while True:
+			try:
+				data = handler.connection.recv(65536)
+			except web.would_block:
+				return
+			except OSError:
+				data = b''
+
+			if not data:
+				self.remove(handler, close_abnormal, '')
+				return
+
+			self.feed(handler, data)
+
+			#Keep going while TLS has decrypted more than was taken, since the selector won't wake up for it
+			if not web.tls_pending(handler.connection) or handler not in self.handlers:
+				return
+
+	def feed(self, handler, data):
+		try:
+			handler.feed(data)
+		except WebSocketError as error:
+			handler.fail(error.code, error.reason)
+		except Exception:
+			handler.request.server.log.exception()
+			handler.fail(close_internal_error)
+
+	def call(self, handler, function, *args):
+		#Callbacks run on the multiplexer thread so an error must only take down its own connection
+		try:
+			function(*args)
+		except Exception:
+			handler.request.server.log.exception()
+			handler.fail(close_internal_error)
+
+	def send(self, handler, data):
+		if handler not in self.handlers:
+			return
+
+		#Queue behind anything not yet sent, dropping peers that fall too far behind
+		if handler.pending:
+			if len(handler.pending) + len(data) > self.max_pending:
+				self.remove(handler, close_policy, 'Too slow')
+			else:
+				handler.pending += data
+
+			return
+
+		try:
+			sent = handler.connection.send(data)
+		except web.would_block:
+			sent = 0
+		except OSError:
+			self.remove(handler, close_abnormal, '')
+			return
+
+		if sent < len(data):
+			handler.pending += data[sent:]
+			self.selector.modify(handler.connection, selectors.EVENT_READ | selectors.EVENT_WRITE, handler)
+		elif handler.close_received and handler.close_sent:
+			self.remove(handler, handler.close_code, handler.close_reason)
+
+	def flush(self, handler):
+		try:
+			sent = handler.connection.send(handler.pending)
+		except web.would_block:
+			return
+		except OSError:
+			self.remove(handler, close_abnormal, '')
+			return
+
+		del handler.pending[:sent]
+
+		if not handler.pending:
+			if handler.close_received and handler.close_sent:
+				self.remove(handler, handler.close_code, handler.close_reason)
+			else:
+				self.selector.modify(handler.connection, selectors.EVENT_READ, handler)
+
+	def remove(self, handler, code, reason):
+		if handler not in self.handlers:
+			return
+
+		self.handlers.discard(handler)
+		self.selector.unregister(handler.connection)
+
+		try:
+			handler.connection.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+		handler.request.close()
+		handler.connection.close()
+
+		handler.closed = True
+
+		try:
+			handler.on_close(code, reason)
+		except Exception:
+			handler.request.server.log.exception()
+
+class WebSocketHandler(web.HTTPHandler):
+	multiplexer = None
+
+	max_message_size = 16777216 #16 MB
+
+	#Negotiate permessage-deflate and compress outgoing messages at least this long
+	deflate = True
+	deflate_threshold = 128
+
+	#Subprotocols in order of preference
+	subprotocols = []
+
+	def do_get(self):
+		#HTTP Status 400
+		if self.request.headers.get('Upgrade', '').lower() != 'websocket' or 'upgrade' not in [token.strip() for token in self.request.headers.get('Connection', '').lower().split(',')]:
+			raise web.HTTPError(400)
+
+		key = self.request.headers.get('Sec-WebSocket-Key')
+
+		#HTTP Status 400
+		try:
+			if len(base64.b64decode(key, validate=True)) != 16:
+				raise ValueError()
+		except (TypeError, ValueError):
+			raise web.HTTPError(400)
+
+		#HTTP Status 426
+		if self.request.headers.get('Sec-WebSocket-Version') != version:
+			error_headers = web.HTTPHeaders()
+			error_headers.set('Sec-WebSocket-Version', version)
+			raise web.HTTPError(426, headers=error_headers)
+
+		self.response.headers.set('Upgrade', 'websocket')
+		self.response.headers.set('Connection', 'Upgrade')
+		self.response.headers.set('Sec-WebSocket-Accept', accept_key(key))
+
+		#Pick the first subprotocol we speak in the order the client offered them
+		self.subprotocol = None
+		for subprotocol in self.request.headers.get('Sec-WebSocket-Protocol', '').split(','):
+			if subprotocol.strip() in self.subprotocols:
+				self.subprotocol = subprotocol.strip()
+				self.response.headers.set('Sec-WebSocket-Protocol', self.subprotocol)
+				break
+
+		#Accept permessage-deflate without context takeover so each message is compressed on its own
+		self.compress = False
+		if self.deflate:
+			for name, params in parse_extensions(self.request.headers.get('Sec-WebSocket-Extensions', '')):
+				if name == 'permessage-deflate' and params.get('server_max_window_bits') in (None, '15'):
+					self.compress = True
+					self.response.headers.set('Sec-WebSocket-Extensions', 'permessage-deflate; server_no_context_takeover; client_no_context_takeover')
+					break
+
+		#HTTP Status 503
+		if not self.multiplexer.is_running():
+			#Nothing would ever serve or close a connection handed to a stopped multiplexer
+			raise web.HTTPError(503)
+
+		return 101, web.Detach(self.attach)
+
+	def attach(self, request):
+		self.connection = request.connection
+
+		#Received bytes not yet parsed into frames
+		self.buffer = bytearray()
+		#Bytes not yet sent
+		self.pending = bytearray()
+
+		#Payloads of the fragmented message being received
+		self.fragments = []
+		self.fragments_size = 0
+		self.fragments_opcode = None
+		self.fragments_compressed = False
+
+		self.close_sent = False
+		self.close_received = False
+		self.close_deadline = None
+		self.close_code = close_no_status
+		self.close_reason = ''
+
+		self.closed = False
+		self.failed = False
+
+		#Take anything the request file read past the handshake without blocking
+		request.connection.setblocking(False)
+		try:
+			leftover = request.rfile.read1(65536)
+		#TLS raises instead of returning nothing when no data is ready
+		except web.would_block:
+			leftover = b''
+
+		self.multiplexer.attach(self, leftover)
+
+	def feed(self, data):
+		if self.failed:
+			return
+
+		self.buffer += data
+
+		while not self.closed and not self.failed:
+			frame = parse_frame(self.buffer, self.max_message_size)
+			if not frame:
+				break
+
+			fin, rsv1, opcode, payload, length = frame
+			del self.buffer[:length]
+
+			self.frame(fin, rsv1, opcode, payload)
+
+	def frame(self, fin, rsv1, opcode, payload):
+		if opcode >= opcode_close:
+			if rsv1:
+				raise WebSocketError(close_protocol_error, 'Compressed control frame')
+
+			if opcode == opcode_close:
+				self.receive_close(payload)
+			elif opcode == opcode_ping:
+				self.multiplexer.send(self, build_frame(opcode_pong, payload))
+				self.multiplexer.call(self, self.on_ping, payload)
+			else:
+				self.multiplexer.call(self, self.on_pong, payload)
+
+			return
+
+		#Ignore data after a close was received
+		if self.close_received:
+			return
+
+		if opcode == opcode_continuation:
+			if self.fragments_opcode is None:
+				raise WebSocketError(close_protocol_error, 'Unexpected continuation')
+			if rsv1:
+				raise WebSocketError(close_protocol_error, 'Compressed continuation')
+		else:
+			if self.fragments_opcode is not None:
+				raise WebSocketError(close_protocol_error, 'Expected continuation')
+			if rsv1 and not self.compress:
+				raise WebSocketError(close_protocol_error, 'Compression not negotiated')
+
+			self.fragments_opcode = opcode
+			self.fragments_compressed = rsv1
+
+		self.fragments.append(payload)
+		self.fragments_size += len(payload)
+
+		if self.fragments_size > self.max_message_size:
+			raise WebSocketError(close_too_big)
+
+		if not fin:
+			return
+
+		message = b''.join(self.fragments)
+		opcode = self.fragments_opcode
+		compressed = self.fragments_compressed
+
+		self.fragments = []
+		self.fragments_size = 0
+		self.fragments_opcode = None
+		self.fragments_compressed = False
+
+		if compressed:
+			#Limit the inflated size too so a small message can't expand without bound
+			decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+			try:
+				message = decompressor.decompress(message + deflate_trailer, self.max_message_size + 1)
+			except zlib.error:
+				raise WebSocketError(close_invalid_data, 'Bad compressed data')
+
+			if len(message) > self.max_message_size:
+				raise WebSocketError(close_too_big)
+
+		if opcode == opcode_text:
+			try:
+				message = message.decode('utf-8')
+			except UnicodeDecodeError:
+				raise WebSocketError(close_invalid_data, 'Invalid UTF-8')
+
+		self.multiplexer.call(self, self.on_message, message)
+
+	def receive_close(self, payload):
+		if len(payload) == 1:
+			raise WebSocketError(close_protocol_error, 'Bad close frame')
+
+		code = close_no_status
+		reason = ''
+		if payload:
+			code = int.from_bytes(payload[:2], 'big')
+
+			#Codes that must never be sent or are not assigned
+			if code < 1000 or code in (1004, close_no_status, close_abnormal, 1015) or 1016 <= code < 3000 or code >= 5000:
+				raise WebSocketError(close_protocol_error, 'Bad close code')
+
+			try:
+				reason = payload[2:].decode('utf-8')
+			except UnicodeDecodeError:
+				raise WebSocketError(close_invalid_data, 'Invalid UTF-8')
+
+		self.close_received = True
+		self.close_code = code
+		self.close_reason = reason
+
+		if self.close_sent:
+			#Our close was answered so the connection is done once everything is sent
+			if not self.pending:
+				self.multiplexer.remove(self, code, reason)
+		else:
+			#Echo the close and finish once it is sent
+			self.close_sent = True
+			self.multiplexer.send(self, build_frame(opcode_close, payload[:2]))
+
+	def fail(self, code, reason=''):
+		#Stop parsing since nothing more from the peer can be trusted
+		self.failed = True
+
+		if self.close_sent:
+			self.multiplexer.remove(self, code, reason)
+			return
+
+		#Send the close and drop the connection once it is out
+		self.close_received = True
+		self.close_sent = True
+		self.close_code = code
+		self.close_reason = reason
+		self.close_deadline = time.monotonic() + self.multiplexer.close_timeout
+
+		self.multiplexer.send(self, build_frame(opcode_close, code.to_bytes(2, 'big') + reason.encode('utf-8')[:123]))
+
+	def send(self, message):
+		if isinstance(message, str):
+			opcode = opcode_text
+			payload = message.encode('utf-8')
+		else:
+			opcode = opcode_binary
+			payload = bytes(message)
+
+		#Compress each message separately since there is no context takeover
+		rsv1 = False
+		if self.compress and len(payload) >= self.deflate_threshold:
+			compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+			payload = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			payload = payload[:-len(deflate_trailer)]
+			rsv1 = True
+
+		self.multiplexer.write(self, build_frame(opcode, payload, rsv1=rsv1))
+
+	def ping(self, data=b''):
+		self.multiplexer.write(self, build_frame(opcode_ping, data))
+
+	def close(self, code=close_normal, reason=''):
+		self.multiplexer.incoming.append((self.start_close, (code, reason)))
+		self.multiplexer.wakeup()
+
+	def start_close(self, code, reason):
+		if self.closed or self.close_sent:
+			return
+
+		self.close_sent = True
+		self.close_deadline = time.monotonic() + self.multiplexer.close_timeout
+
+		self.multiplexer.send(self, build_frame(opcode_close, code.to_bytes(2, 'big') + reason.encode('utf-8')[:123]))
+
+	def on_open(self):
+		pass
+
+	def on_message(self, message):
+		pass
+
+	def on_ping(self, data):
+		pass
+
+	def on_pong(self, data):
+		pass
+
+	def on_close(self, code, reason):
+		pass
+
+def new(multiplexer, remote, handler):
+	class GenWebSocketHandler(handler):
+		pass
+
+	GenWebSocketHandler.multiplexer = multiplexer
+
+	return {remote: GenWebSocketHandler}